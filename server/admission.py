@@ -0,0 +1,194 @@
+"""Admission control of the ingest path. Watches how many ingest requests are in flight, how long they waited to be
+handled, how long storing their entries takes and how much memory the process uses. Once any of them goes over its
+limit, low priority severities are progressively sampled and then dropped, following
+'defaults["ADMISSION"]["PRIORITY"]'. Severities on 'defaults["ADMISSION"]["ALWAYS"]' are always admitted.
+With a single sync worker, requests never overlap, so an overload shows as queueing instead: the wait is read from the
+'X-Request-Start' header routers stamp requests with (milliseconds since the epoch on Heroku, 't=<microseconds>' on
+nginx). Without it, only the store time and memory are watched
+"""
+import os
+import random
+import threading
+import time
+
+import psutil
+
+from entry_manager import log_internal_echo
+from metrics import Counter, registry
+from server_config import defaults, logger_config
+
+shed_count = Counter("shed_total", "Entries dropped by admission control, by severity", ("severity",))
+registry.append(shed_count)
+
+in_flight = 0           # Ingest requests currently being handled
+latency_avg = 0.0       # Exponentially weighted average of the time taken storing an ingest request, in seconds
+queue_wait_avg = 0.0    # Exponentially weighted average of the time ingest requests waited to be handled, in seconds
+memory_rss = 0          # Last sampled resident memory of the process, in bytes
+memory_sampled = 0.0    # When 'memory_rss' was sampled ('time.monotonic()')
+shed_level = 0.0        # 0 admits everything, 1 drops every severity that can be dropped
+shedding_since = None   # When shedding started, if it's going on
+drops = {}              # Entries dropped per severity, since the server started. {severity: count}
+episode_drops = 0       # Entries dropped since shedding last started
+state_lock = threading.Lock()
+process = psutil.Process(os.getpid())     # Bound again on fork ('forget'), or workers would sample the master
+
+
+def queue_wait(request_start: str):
+    """
+    Reads how long a request waited before being handled
+    :param request_start: The 'X-Request-Start' header: milliseconds or seconds since the epoch, or 't=<microseconds>'
+    :return: The wait, in seconds, or None if the header is missing or can't be trusted
+    """
+    if not request_start:
+        return None
+    try:
+        stamp = float(request_start.strip().removeprefix("t="))
+    except ValueError:
+        return None
+    if stamp > 1e14:        # Microseconds
+        stamp /= 1e6
+    elif stamp > 1e11:      # Milliseconds
+        stamp /= 1e3
+    wait = time.time() - stamp
+    return max(0.0, wait) if wait < 3600 else None  # Anything longer is a skewed clock
+
+
+def ingest_started(request_start: str = None):
+    """
+    Marks an ingest request as in flight, folding how long it waited into the average
+    :param request_start: The request's 'X-Request-Start' header, if any
+    """
+    global in_flight, queue_wait_avg
+    wait = queue_wait(request_start)
+    with state_lock:
+        in_flight += 1
+        if wait is not None:
+            queue_wait_avg += (wait - queue_wait_avg) * defaults["ADMISSION"]["LATENCY_WEIGHT"]
+
+
+def ingest_finished():
+    """Marks an ingest request as done"""
+    global in_flight
+    with state_lock:
+        in_flight -= 1
+    refresh()   # Shedding may stop even if nothing sheddable comes anymore
+
+
+def ingest_stored(start: float):
+    """
+    Folds the time taken storing an ingest request into the average. Only the store is timed: answering (rendering a
+    page, for browsers) isn't an ingest cost
+    :param start: 'time.perf_counter()' before the entries were handed to the store
+    """
+    global latency_avg
+    elapsed = time.perf_counter() - start
+    with state_lock:
+        latency_avg += (elapsed - latency_avg) * defaults["ADMISSION"]["LATENCY_WEIGHT"]
+
+
+def overload() -> float:
+    """
+    Returns how overloaded the server is, as the highest ratio between a signal and its limit. Up to 1 means not
+    overloaded at all
+    """
+    global memory_rss, memory_sampled
+    limits = defaults["ADMISSION"]
+    now = time.monotonic()
+    if now - memory_sampled >= limits["MEMORY_INTERVAL"]:
+        memory_sampled = now
+        try:
+            memory_rss = process.memory_info().rss
+        except psutil.Error:
+            pass    # Just keep the last sample
+    return max(in_flight / limits["MAX_IN_FLIGHT"],
+               latency_avg / limits["MAX_LATENCY"],
+               queue_wait_avg / limits["MAX_QUEUE_WAIT"],
+               memory_rss / (limits["MAX_MEMORY_MB"] * 1024 * 1024))
+
+
+def refresh() -> float:
+    """
+    Recomputes the shed level from the signals, making an entry when shedding starts or stops
+    :return: The shed level, from 0 to 1
+    """
+    global shed_level, shedding_since, episode_drops
+    level = min(1.0, max(0.0, (overload() - 1) / (defaults["ADMISSION"]["HARD_RATIO"] - 1)))
+    change = None
+    with state_lock:
+        shed_level = level
+        if level > 0 and shedding_since is None:
+            shedding_since = time.monotonic()
+            episode_drops = 0
+            change = "started"
+        elif level == 0 and shedding_since is not None:
+            change = {"duration_s": round(time.monotonic() - shedding_since, 3), "dropped": episode_drops}
+            shedding_since = None
+    if change == "started":     # Outside the lock: entries take the store lock
+        log_internal_echo(severity="Attention", sender=__name__, comment="Load shedding started", body=snapshot())
+    elif change is not None:
+        log_internal_echo(severity="Information", sender=__name__, comment="Load shedding stopped",
+                          body=dict(snapshot(), **change))
+    return level
+
+
+def admission_chance(severity: str, level: float) -> float:
+    """
+    Returns the chance of an entry of 'severity' being admitted at 'level'. Each sheddable severity fades out over its
+    own slice of the level, lowest priority first. Severities outside of the priority list are the first to go
+    :param severity: The entry's severity, already casefolded
+    :param level: The current shed level, from 0 to 1
+    """
+    priority = defaults["ADMISSION"]["PRIORITY"]
+    tier = priority.index(severity) + 1 if severity in priority else 0
+    return min(1.0, max(0.0, (tier + 1) - level * (len(priority) + 1)))
+
+
+def admit(severity) -> bool:
+    """
+    Decides if an entry of 'severity' should be stored. Also starts or stops shedding, making an entry about it
+    :param severity: The entry's severity
+    :return: True if the entry should be stored, False if it should be dropped
+    """
+    global episode_drops
+    if logger_config["SHEDDING"] is False:
+        return True
+    level = refresh()
+    severity = str(severity).casefold()
+    if severity in defaults["ADMISSION"]["ALWAYS"]:
+        return True
+    if level == 0 or random.random() < admission_chance(severity, level):
+        return True
+    with state_lock:
+        drops[severity] = drops.get(severity, 0) + 1
+        episode_drops += 1
+    shed_count.inc((severity,))
+    return False
+
+
+def signals() -> dict:
+    """Returns the current admission control state, as reported on '/server/status'"""
+    if logger_config["SHEDDING"] is True:
+        refresh()
+    return snapshot()
+
+
+def snapshot() -> dict:
+    return {"in_flight": in_flight,
+            "latency_ms": round(latency_avg * 1000, 3),
+            "queue_wait_ms": round(queue_wait_avg * 1000, 3),
+            "memory_mb": round(memory_rss / (1024 * 1024), 1),
+            "shed_level": round(shed_level, 3),
+            "shedding": shedding_since is not None,
+            "dropped": dict(drops)}
+
+
+def forget():
+    """After a fork, the child samples its own memory, and doesn't inherit a lock another thread may have held"""
+    global process, memory_rss, memory_sampled, state_lock
+    process = psutil.Process(os.getpid())
+    memory_rss = 0
+    memory_sampled = 0.0
+    state_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=forget)
@@ -0,0 +1,314 @@
+"""Alert rules evaluated on ingest, enabled by 'logger_config["ALERTS"]'. A rule counts the entries of a severity and/or
+a sender (and, optionally, whose comment matches a regular expression) over a sliding window, and triggers an action
+once more than 'threshold' of them arrive within 'window' seconds:
+  - "webhook": POSTs the event as JSON to 'url' (a local endpoint, unless 'defaults["ALERTS"]["LOCAL_ONLY"]' is False)
+  - "entry": adds an internal entry flagging it, of 'flag_severity'
+  - "counter": only counts it, as shown on '/server/status'
+Rules come from 'defaults["ALERTS"]["RULES"]', or are set on '/set' with '{"type": "rule", "name": "errors", ...}'
+(and dropped with '{"type": "rule", "name": "errors", "drop": true}'). For example, more than 50 errors from the same
+sender within a minute:
+    {"name": "error_burst", "severity": "error", "per_sender": true, "threshold": 50, "window": 60, "action": "entry"}
+Rules are indexed by their severity and sender, so an entry only reaches the rules that could match it, whatever their
+number. Counts are kept on a ring of 'BUCKETS' buckets per window, so each entry costs the same however busy the window
+is, and a count is off at most by the entries of one bucket. Once triggered, a rule (or a sender of a 'per_sender'
+rule) is quiet for 'cooldown' seconds (the window, by default). Actions run on their own thread, away from ingest.
+Patterns are matched on another thread ('match_run'), never on ingest: a slow pattern (they're capped at
+'MAX_PATTERN') only delays its own rules. Entries it can't keep up with are skipped, and counted as such.
+Internal entries and replicated ones aren't evaluated: each node alerts on what it takes. Rules set on '/set' are kept
+on snapshots ('snapshot').
+Every function here, but 'match_run' and 'dispatch_run', must be called under the store lock. The counts of a rule
+with a pattern are only touched by 'match_run'
+"""
+import ipaddress
+import json
+import os
+import queue
+import re
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from server_config import defaults, print_verbose
+
+ACTIONS = ("webhook", "entry", "counter")
+
+rules = {}          # Every rule, as {name: Rule}
+index = {}          # The same rules, as {(casefolded severity or None, sender or None): [rules]}
+actions = queue.Queue(defaults["ALERTS"]["QUEUE_MAX"])  # Actions waiting to run, as (rule, event)
+dispatcher = None   # The thread running them, started with the first one (again, if it died)
+dropped = 0         # Actions dropped because the queue was full
+pending = queue.Queue(defaults["ALERTS"]["QUEUE_MAX"])  # Entries waiting for patterns, with the rules to try
+matcher = None      # The thread matching them, started with the first one (again, if it died)
+skipped = 0         # Entries not matched against patterns because the queue was full
+threads_lock = threading.Lock()     # Guards starting the threads, and the counters above
+
+
+class SlidingCount:
+    __slots__ = ("width", "buckets", "head", "total", "quiet_until")
+
+    def __init__(self, window: float, buckets: int):
+        """
+        Counts the events of the last 'window' seconds, on a ring of 'buckets' buckets
+        """
+        self.width = window / buckets
+        self.buckets = [0] * buckets
+        self.head = None            # Number of the newest bucket ('time.monotonic()' divided by the width)
+        self.total = 0
+        self.quiet_until = 0.0      # 'time.monotonic()' until which a trigger is ignored
+
+    def add(self, now: float) -> int:
+        """Counts an event at 'now' ('time.monotonic()'), and returns how many there were within the window"""
+        slot = int(now / self.width)
+        size = len(self.buckets)
+        if self.head is None or slot - self.head >= size:   # Everything counted expired
+            self.buckets = [0] * size
+            self.total = 0
+        else:
+            while self.head < slot:     # At most once per bucket, however many events
+                self.head += 1
+                self.total -= self.buckets[self.head % size]
+                self.buckets[self.head % size] = 0
+        self.head = slot
+        self.buckets[slot % size] += 1
+        self.total += 1
+        return self.total
+
+
+class Rule:
+    def __init__(self, name: str, severity: str = None, sender: str = None, pattern: str = None,
+                 ignore_case: bool = True, threshold: int = 0, window: float = 60, per_sender: bool = False,
+                 action: str = "counter", url: str = None, flag_severity: str = "Attention", cooldown: float = None):
+        """
+        Raises 'ValueError' if any value is invalid
+        :param name: Unique name of the rule
+        :param severity: Severity of the entries counted. None for any
+        :param sender: Sender of the entries counted. None for any
+        :param pattern: A regular expression the comment must match. None for any
+        :param threshold: The rule triggers once more than this many entries are counted within the window
+        :param window: Seconds entries are counted for
+        :param per_sender: If True, each sender is counted (and triggers) on its own
+        :param action: "webhook", "entry" or "counter"
+        :param url: Where the events are POSTed to. Only for "webhook"
+        :param flag_severity: Severity of the internal entries added. Only for "entry"
+        :param cooldown: Seconds a rule stays quiet once triggered. None for 'window'
+        """
+        if not isinstance(name, str) or name == "":
+            raise ValueError(f"Rule name '{name}' is invalid")
+        if pattern is not None and (not isinstance(pattern, str) or len(pattern) > defaults["ALERTS"]["MAX_PATTERN"]):
+            raise ValueError(f"Rule '{name}' pattern must be text of at most {defaults['ALERTS']['MAX_PATTERN']} "
+                             f"characters")
+        if action not in ACTIONS:
+            raise ValueError(f"Rule action '{action}' isn't one of {', '.join(ACTIONS)}")
+        if int(threshold) < 0 or float(window) <= 0:
+            raise ValueError(f"Rule '{name}' needs a positive window and threshold")
+        if action == "webhook":
+            webhook_check(url)
+        self.name = name
+        self.severity = None if severity is None else str(severity).casefold()
+        self.sender = sender
+        self.pattern = pattern
+        try:
+            self.regex = None if pattern is None else re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        except re.error as exc:
+            raise ValueError(f"Rule '{name}' pattern is invalid ({exc})")
+        self.threshold = int(threshold)
+        self.window = float(window)
+        self.per_sender = per_sender is True
+        self.action = action
+        self.url = url
+        self.flag_severity = flag_severity
+        self.cooldown = self.window if cooldown is None else float(cooldown)
+        self.spec = None        # The JSON description it was made from, if any. Kept on snapshots
+        self.counts = OrderedDict()     # {sender or None: SlidingCount}, least recently counted first
+        self.matched = 0        # Entries counted
+        self.fired = 0          # Times triggered
+        self.delivered = 0      # Actions that ran
+        self.failures = 0       # Actions that failed
+
+    @classmethod
+    def parse(cls, spec: dict):
+        """Makes a rule from its JSON description. Raises 'ValueError' if it's invalid"""
+        if not isinstance(spec, dict):
+            raise ValueError("A rule must be an object")
+        fields = {key: value for key, value in spec.items() if key not in ("type", "drop")}
+        try:
+            rule = cls(**fields)
+        except TypeError as exc:    # Unknown or missing fields
+            raise ValueError(f"Rule '{spec.get('name')}' is invalid ({exc})")
+        rule.spec = fields
+        return rule
+
+    def count(self, s_from: str, severity: str, comment, now: float):
+        """Counts an entry that matched the rule, triggering it if it's over its threshold"""
+        self.matched += 1
+        group = s_from if self.per_sender else None
+        count = self.counts.get(group)
+        if count is None:
+            count = self.counts[group] = SlidingCount(self.window, defaults["ALERTS"]["BUCKETS"])
+            if len(self.counts) > defaults["ALERTS"]["MAX_GROUPS"]:
+                self.counts.popitem(last=False)
+        elif self.per_sender:
+            self.counts.move_to_end(group)
+        total = count.add(now)
+        if total > self.threshold and now >= count.quiet_until:
+            count.quiet_until = now + self.cooldown
+            self.fired += 1
+            event = {"rule": self.name, "sender": s_from, "severity": severity, "comment": comment, "count": total,
+                     "threshold": self.threshold, "window": self.window, "at": time.time()}
+            if self.action == "counter":
+                self.delivered += 1
+            else:
+                dispatch(self, event)
+
+    def stats(self) -> dict:
+        return {"action": self.action, "matched": self.matched, "fired": self.fired, "delivered": self.delivered,
+                "failures": self.failures, "groups": len(self.counts)}
+
+
+def webhook_check(url: str):
+    """Raises 'ValueError' if 'url' can't take webhooks"""
+    parts = urlsplit(url) if isinstance(url, str) else None
+    if parts is None or parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError(f"Webhook url '{url}' is invalid")
+    if defaults["ALERTS"]["LOCAL_ONLY"] is True:
+        try:
+            local = ipaddress.ip_address(parts.hostname).is_loopback
+        except ValueError:  # Not an address
+            local = parts.hostname == "localhost"
+        if not local:
+            raise ValueError(f"Webhook url '{url}' isn't a local endpoint")
+
+
+def reindex():
+    global index
+    fresh = {}
+    for rule in rules.values():
+        fresh.setdefault((rule.severity, rule.sender), []).append(rule)
+    index = fresh
+
+
+def declare(spec: dict) -> Rule:
+    """
+    Sets a rule, replacing the one of the same name (and its counts), if any. Raises 'ValueError' if it's invalid
+    :param spec: The rule, as described in 'Rule'
+    """
+    rule = Rule.parse(spec)
+    if rule.name not in rules and len(rules) >= defaults["ALERTS"]["MAX_RULES"]:
+        raise ValueError(f"At most {defaults['ALERTS']['MAX_RULES']} rules can be set")
+    rules[rule.name] = rule
+    reindex()
+    return rule
+
+
+def drop(name: str) -> bool:
+    """Drops a rule. Returns False if there was none of that name"""
+    if rules.pop(name, None) is None:
+        return False
+    reindex()
+    return True
+
+
+def observe(s_from: str, severity: str, comment):
+    """Evaluates the rules that could match an entry just taken"""
+    if not index:
+        return
+    now = time.monotonic()
+    severity_key = str(severity).casefold()
+    patterned = []
+    for key in ((severity_key, s_from), (severity_key, None), (None, s_from), (None, None)):
+        matching = index.get(key)
+        if matching is not None:
+            for rule in matching:
+                if rule.regex is None:
+                    rule.count(s_from, severity, comment, now)
+                else:
+                    patterned.append(rule)
+    if patterned:
+        match(patterned, s_from, severity, comment, now)
+
+
+def match(patterned: list, s_from: str, severity: str, comment, now: float):
+    """Queues an entry to be matched against the patterns of 'patterned' rules"""
+    global matcher, skipped
+    with threads_lock:
+        if matcher is None or not matcher.is_alive():
+            matcher = threading.Thread(target=match_run, name="alert_matcher", daemon=True)
+            matcher.start()
+        try:
+            pending.put_nowait((patterned, s_from, severity, comment, now))
+        except queue.Full:
+            skipped += 1
+
+
+def match_run():
+    """Counts the queued entries on the rules whose pattern they match"""
+    while True:
+        patterned, s_from, severity, comment, now = pending.get()
+        text = str(comment)
+        for rule in patterned:
+            try:
+                if rules.get(rule.name) is rule and rule.regex.search(text) is not None:    # Unless dropped since
+                    rule.count(s_from, severity, comment, now)
+            except Exception as exc:    # The thread must outlive any entry
+                print_verbose(sender=__name__, message=f"Rule '{rule.name}' couldn't be evaluated: '{exc}'")
+
+
+def dispatch(rule: Rule, event: dict):
+    """Queues the action of a triggered rule"""
+    global dispatcher, dropped
+    with threads_lock:
+        if dispatcher is None or not dispatcher.is_alive():
+            dispatcher = threading.Thread(target=dispatch_run, name="alert_dispatcher", daemon=True)
+            dispatcher.start()
+        try:
+            actions.put_nowait((rule, event))
+        except queue.Full:
+            dropped += 1
+
+
+def dispatch_run():
+    """Runs the queued actions, one at a time"""
+    import entry_manager    # Imports this module
+    while True:
+        rule, event = actions.get()
+        try:
+            if rule.action == "webhook":
+                req = urllib.request.Request(rule.url, data=json.dumps(event, default=str).encode(), method="POST",
+                                             headers={"Content-Type": "application/json"})
+                with urllib.request.urlopen(req, timeout=defaults["ALERTS"]["TIMEOUT"]) as response:
+                    response.read()
+            else:
+                entry_manager.log_internal(severity=rule.flag_severity, body=event,
+                                           comment=f"Rule '{rule.name}' triggered: {event['count']} entries in "
+                                                   f"{event['window']:g}s")
+            rule.delivered += 1
+        except Exception as exc:    # Not only 'OSError': a bad reply raises 'http.client.HTTPException'
+            rule.failures += 1
+            print_verbose(sender=__name__, message=f"Action of rule '{rule.name}' failed: '{exc}'")
+
+
+def forget():
+    """After a fork, the child doesn't have the parent's threads, nor can it share their queues"""
+    global dispatcher, actions, matcher, pending, threads_lock
+    dispatcher = matcher = None
+    actions = queue.Queue(defaults["ALERTS"]["QUEUE_MAX"])
+    pending = queue.Queue(defaults["ALERTS"]["QUEUE_MAX"])
+    threads_lock = threading.Lock()
+
+
+def specs() -> list:
+    """Returns the JSON description of every rule, as kept on snapshots"""
+    return [rule.spec for rule in rules.values() if rule.spec is not None]
+
+
+def stats() -> dict:
+    return {"rules": len(rules), "fired": sum(rule.fired for rule in rules.values()), "queued": actions.qsize(),
+            "dropped": dropped, "matching": pending.qsize(), "skipped": skipped,
+            "by_rule": {name: rule.stats() for name, rule in rules.items()}}
+
+
+for boot_rule in defaults["ALERTS"]["RULES"]:
+    declare(boot_rule)
+os.register_at_fork(after_in_child=forget)
@@ -0,0 +1,111 @@
+"""Build step of the static assets. Each file on 'static' is copied to 'static/dist' with a content hash on its name,
+next to its gzip (and brotli, if available) precompressed versions, and listed on 'static/dist/manifest.json'.
+Hashed assets never change, so they're served with long-lived cache headers. Run it before starting the server:
+    python assets.py
+If it wasn't run, pages keep linking the plain (uncached) assets
+"""
+import hashlib
+import json
+import mimetypes
+import os
+import zlib
+
+import flask
+from flask import Blueprint, request, send_from_directory, url_for
+
+from server_config import logger_config, print_verbose
+
+try:
+    import brotli
+except ImportError:  # Optional dependency. Without it, only gzip is precompressed
+    brotli = None
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST_FOLDER = os.path.join(STATIC_FOLDER, "dist")
+MANIFEST = os.path.join(DIST_FOLDER, "manifest.json")
+CACHE_FOREVER = "public, max-age=31536000, immutable"
+
+static_dist = Blueprint("static_dist", __name__)
+manifest = {}       # {logical name: hashed name}
+
+
+def build_assets() -> dict:
+    """
+    Hashes and precompresses every static asset, writing 'static/dist' and its manifest
+    :return: The manifest, as '{logical name: hashed name}'
+    """
+    out = {}
+    os.makedirs(DIST_FOLDER, exist_ok=True)
+    for root, dirs, files in os.walk(STATIC_FOLDER):
+        if os.path.abspath(root).startswith(DIST_FOLDER):
+            continue
+        for name in files:
+            path = os.path.join(root, name)
+            logical = os.path.relpath(path, STATIC_FOLDER).replace(os.sep, "/")
+            with open(path, "rb") as file:
+                data = file.read()
+            stem, ext = os.path.splitext(logical)
+            hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+            target = os.path.join(DIST_FOLDER, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            write_file(target, data)
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 31)     # Best level, it's done only once
+            write_file(target + ".gz", compressor.compress(data) + compressor.flush())
+            if brotli is not None:
+                write_file(target + ".br", brotli.compress(data, quality=11))
+            out[logical] = hashed
+    write_file(MANIFEST, json.dumps(out, indent=2).encode())
+    print_verbose(sender=__name__, message=f"Built {len(out)} static assets")
+    return out
+
+
+def write_file(path: str, data: bytes):
+    """Writes 'data' onto 'path' through a temporary file, so a running server never reads a partial file"""
+    with open(path + ".tmp", "wb") as file:
+        file.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def asset_url(name: str) -> str:
+    """Returns the url of the static asset 'name', hashed if it was built"""
+    if name in manifest:
+        return url_for("static_dist.serve_asset", filename=manifest[name])
+    return url_for("static", filename=name)
+
+
+@static_dist.route("/static/dist/<path:filename>")
+def serve_asset(filename):
+    encodings = []
+    if os.path.exists(os.path.join(DIST_FOLDER, filename + ".br")):
+        encodings.append("br")
+    if os.path.exists(os.path.join(DIST_FOLDER, filename + ".gz")):
+        encodings.append("gzip")
+    encoding = request.accept_encodings.best_match(encodings) if encodings else None
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    if encoding is None:
+        response = send_from_directory(DIST_FOLDER, filename, mimetype=mimetype)
+    else:
+        suffix = ".br" if encoding == "br" else ".gz"
+        response = send_from_directory(DIST_FOLDER, filename + suffix, mimetype=mimetype)
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Cache-Control"] = CACHE_FOREVER
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def init_app(app: flask.Flask):
+    """Loads the manifest (if it was built) and exposes 'asset_url' to the templates"""
+    global manifest
+    try:
+        with open(MANIFEST) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = {}
+        print_verbose(sender=__name__, message="Static assets weren't built. Serving them without caching")
+    app.register_blueprint(static_dist)
+    app.add_template_global(asset_url)
+
+
+if __name__ == "__main__":
+    logger_config["VERBOSE"] = True
+    build_assets()
@@ -0,0 +1,263 @@
+"""Async serving mode. Wraps the Flask app on an ASGI application, so it can be served by an asyncio server:
+    uvicorn async_server:app --host 0.0.0.0 --port $PORT
+    gunicorn async_server:app -k uvicorn.workers.UvicornWorker -w 1 --preload
+Every route (ingest, status, pages...) is still answered by the Flask views, on a small thread pool. Clients that wait
+for new entries are held on the event loop instead, costing a coroutine and no thread while idle:
+  - 'GET /log/delta?since=<id>&wait=<seconds>': long-poll. Answers as soon as there are entries after 'since', or
+    with an empty delta once 'wait' expires
+  - 'GET /log/stream?since=<id>': Server-Sent Events. Each event is a '/log/delta' (as JSON), with 'last_id' as the
+    event id, so reconnecting clients resume through 'Last-Event-ID'
+Both take the same 'f' and 'ftgt' filters as '/log', and go through the same login checks. The store is shared with
+the Flask app, as both run on the same process
+"""
+import asyncio
+import io
+import math
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode
+
+import flask
+
+from entry_manager import log_revision
+from server_config import defaults, print_verbose
+from startup import app as wsgi_app
+
+
+class AsyncServer:
+    def __init__(self, flask_app: flask.Flask):
+        self.flask_app = flask_app
+        self.pool = ThreadPoolExecutor(max_workers=defaults["ASYNC"]["WORKERS"], thread_name_prefix="async_wsgi")
+        self.revision = log_revision()
+        self.changed = None     # Set (and replaced) whenever the store revision moves
+        self.watcher = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        self.watch()
+        if scope["method"] == "GET" and scope["path"] == "/log/stream":
+            return await self.stream(scope, receive, send)
+        if scope["method"] == "GET" and scope["path"] == "/log/delta" and "wait" in query(scope):
+            return await self.long_poll(scope, receive, send)
+        body = await read_body(receive)
+        await send_response(send, await self.call_wsgi(scope, body))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.watch()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.watcher is not None:
+                    self.watcher.cancel()
+                self.pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def watch(self):
+        """Starts watching the store revision, if not yet. A single task polls it for every waiting client"""
+        if self.watcher is None:
+            self.changed = asyncio.Event()
+            self.watcher = asyncio.get_running_loop().create_task(self.watch_revision())
+
+    async def watch_revision(self):
+        while True:
+            await asyncio.sleep(defaults["ASYNC"]["POLL_INTERVAL"])
+            revision = log_revision()
+            if revision != self.revision:
+                self.revision = revision
+                self.changed.set()
+                self.changed = asyncio.Event()
+
+    async def wait_change(self, revision: int, timeout: float, disconnect: asyncio.Future) -> bool:
+        """
+        Waits until the store revision moves past 'revision', 'timeout' expires or the client leaves
+        :return: True if the revision moved
+        """
+        if self.revision != revision:
+            return True
+        changed = asyncio.ensure_future(self.changed.wait())
+        try:
+            await asyncio.wait((changed, disconnect), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            changed.cancel()
+        return self.revision != revision
+
+    async def call_wsgi(self, scope, body: bytes, path: str = None, query_string: str = None,
+                        headers: dict = None) -> tuple:
+        """
+        Runs the Flask app on the thread pool
+        :param path: Overrides the request path
+        :param query_string: Overrides the query string
+        :param headers: Overrides (or, if None, removes) these request headers
+        """
+        environ = wsgi_environ(scope, body, path, query_string, headers)
+        return await asyncio.get_running_loop().run_in_executor(self.pool, run_wsgi, self.flask_app, environ)
+
+    async def long_poll(self, scope, receive, send):
+        args = query(scope)
+        try:
+            wait = float(args.pop("wait"))
+        except ValueError:
+            wait = 0
+        if not math.isfinite(wait):     # 'nan' would never expire
+            wait = 0
+        wait = min(max(wait, 0), defaults["ASYNC"]["MAX_WAIT"])
+        disconnect = asyncio.ensure_future(wait_disconnect(receive))
+        deadline = asyncio.get_running_loop().time() + wait
+        try:
+            while True:
+                revision = self.revision
+                response = await self.call_wsgi(scope, b"", query_string=urlencode(args))
+                remaining = deadline - asyncio.get_running_loop().time()
+                if response[0] != 200 or header(response, "X-Delta-Count") != "0" or remaining <= 0 or \
+                        disconnect.done():
+                    break
+                await self.wait_change(revision, remaining, disconnect)
+        finally:
+            disconnect.cancel()
+        await send_response(send, response)
+
+    async def stream(self, scope, receive, send):
+        args = query(scope)
+        last_event = dict(scope["headers"]).get(b"last-event-id")
+        if last_event is not None:
+            args["since"] = last_event.decode("latin-1")
+        # Events are always plain JSON. The stream itself isn't compressed, each event must reach the client as it is
+        overrides = {"accept": "application/json", "accept-encoding": None}
+        disconnect = asyncio.ensure_future(wait_disconnect(receive))
+        started = False
+        try:
+            while not disconnect.done():
+                revision = self.revision
+                response = await self.call_wsgi(scope, b"", path="/log/delta", query_string=urlencode(args),
+                                                headers=overrides)
+                if response[0] != 200:
+                    if not started:     # Not logged in, bad filter... Answered just like '/log/delta' would
+                        await send_response(send, response)
+                    break
+                if not started:
+                    await send({"type": "http.response.start", "status": 200,
+                                "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"),
+                                            (b"x-accel-buffering", b"no")]})
+                    started = True
+                if header(response, "X-Delta-Count") != "0":
+                    args["since"] = header(response, "X-Delta-Last-Id")
+                    await send({"type": "http.response.body", "more_body": True,
+                                "body": b"id: " + args["since"].encode() + b"\ndata: " + response[2] + b"\n\n"})
+                    if header(response, "X-Delta-More") == "1":
+                        continue
+                if not await self.wait_change(revision, defaults["ASYNC"]["KEEPALIVE"], disconnect) and \
+                        not disconnect.done():
+                    await send({"type": "http.response.body", "body": b": keep-alive\n\n", "more_body": True})
+        except OSError:     # The client is gone
+            print_verbose(sender=__name__, message="Stream client left")
+        finally:
+            disconnect.cancel()
+        if started and not disconnect.done():
+            await send({"type": "http.response.body", "body": b""})
+
+
+def query(scope) -> dict:
+    return dict(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+
+
+def header(response: tuple, name: str) -> str:
+    name = name.lower()
+    for key, value in response[1]:
+        if key.lower() == name:
+            return value
+    return None
+
+
+async def read_body(receive) -> bytes:
+    body = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(body)
+
+
+async def wait_disconnect(receive):
+    """Completes once the client disconnects. Only for requests without a body, or whose body was already read"""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_response(send, response: tuple):
+    status, headers, body = response
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def wsgi_environ(scope, body: bytes, path: str = None, query_string: str = None, headers: dict = None) -> dict:
+    """Builds the WSGI environ of an ASGI request"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("Unknown", 0)
+    environ = {"REQUEST_METHOD": scope["method"],
+               "SCRIPT_NAME": scope.get("root_path", ""),
+               "PATH_INFO": path if path is not None else scope["path"],
+               "QUERY_STRING": query_string if query_string is not None else scope["query_string"].decode("latin-1"),
+               "SERVER_NAME": server[0],
+               "SERVER_PORT": str(server[1]),
+               "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+               "REMOTE_ADDR": client[0],
+               "REMOTE_PORT": str(client[1]),
+               "CONTENT_LENGTH": str(len(body)),
+               "wsgi.version": (1, 0),
+               "wsgi.url_scheme": scope.get("scheme", "http"),
+               "wsgi.input": io.BytesIO(body),
+               "wsgi.errors": sys.stderr,
+               "wsgi.multithread": True,
+               "wsgi.multiprocess": False,
+               "wsgi.run_once": False}
+    for key, value in scope["headers"]:
+        key = key.decode("latin-1")
+        if headers is not None and key in headers:
+            continue
+        name = key.upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        value = value.decode("latin-1")
+        environ[name] = environ[name] + "," + value if name in environ and name.startswith("HTTP_") else value
+    for key, value in (headers or {}).items():
+        if value is not None:
+            environ["HTTP_" + key.upper().replace("-", "_")] = value
+    return environ
+
+
+def run_wsgi(wsgi_app, environ: dict) -> tuple:
+    """
+    Calls a WSGI app and collects its whole response
+    :return: A '(status code, [(header, value)], body)' tuple
+    """
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(" ", 1)[0]), headers]
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return started[0], started[1], body
+
+
+app = AsyncServer(wsgi_app)
+
+if __name__ == "__main__":
+    import os
+    import uvicorn  # Only needed to run it directly. Any ASGI server works
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", defaults["FALLBACK"]["PORT"])),
+                log_level="warning")
@@ -0,0 +1,292 @@
+"""Reproducible load and latency benchmark for the log server.
+Boots the app through 'create_app' with the database and login disabled, fills the store with seeded,
+'fill_simulate'-style entries and drives it through Flask's test client. Results are emitted as JSON so runs can be
+stored and compared against each other, flagging regressions. Every timed request must be answered with a 200 (and
+every batched entry stored), or the run fails with exit code 2 instead of reporting the timings of a broken route.
+
+Usage (from the 'server' folder):
+    python benchmark.py --sizes 10000,100000,1000000 --output bench.json
+    python benchmark.py --sizes 10000 --compare bench.json --threshold 0.2
+    python benchmark.py --sizes 100000 --set COLUMNAR=true
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from server_config import logger_config, defaults
+
+BENCH_SENDERS = 12          # How many distinct senders the generated workload uses
+BENCH_SEED = 205            # Default seed, so two runs generate the very same workload
+WIRE_BODY_SIZES = (64, 1024, 16384)     # Approximate body sizes (JSON bytes) compared between wire formats
+WIRE_BATCH = 100            # Entries per 'POST /log' batch when comparing wire formats
+
+
+def entry_generator(amount: int, severities: dict, known_list: dict, seed: int = BENCH_SEED):
+    """
+    Seeded version of 'utils.fill_simulate'. Yields 'amount' entries as dicts ready to be sent to 'POST /log'
+    :param amount: Amount of entries to generate
+    :param severities: A dictionary of severities to use
+    :param known_list: A dictionary of known users to use
+    :param seed: The seed of the random generator. Same seed, same entries
+    """
+    rng = random.Random(seed)
+    users = sorted(known_list.keys())
+    sev = sorted(severities.keys())
+    for i in range(amount):
+        yield {"from": rng.choice(users), "severity": rng.choice(sev), "comment": "Simulated Navigation Test",
+               "body": {rng.getrandbits(64).to_bytes(8, "big").hex(): rng.getrandbits(64).to_bytes(8, "big").hex()}}
+
+
+def wire_body(size: int, rng: random.Random) -> dict:
+    """Builds a body of about 'size' bytes once encoded as JSON, with a mix of strings, numbers and a nested list"""
+    body = {"seq": rng.getrandbits(32), "ok": True, "ratio": rng.random(), "tags": ["bench", "wire"]}
+    while len(json.dumps(body)) < size:
+        body[rng.getrandbits(64).to_bytes(8, "big").hex()] = [rng.getrandbits(64).to_bytes(8, "big").hex(),
+                                                              rng.getrandbits(31)]
+    return body
+
+
+def bench_senders():
+    """Returns the known sender list used by the benchmark, as '{url: (color, backcolor, name)}'"""
+    return {f"bench-{i:02}.local": (None, None, f"Bench {i:02}") for i in range(BENCH_SENDERS)}
+
+
+def timings(func, repeat: int) -> dict:
+    """
+    Calls 'func' 'repeat' times and summarizes the elapsed times
+    :param func: A callable without arguments
+    :param repeat: How many times 'func' is called
+    :return: A dict with the mean, p50, p95 and max latency, in milliseconds
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {"mean": statistics.fmean(samples),
+            "p50": samples[len(samples) // 2],
+            "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            "max": samples[-1]}
+
+
+class Benchmark:
+    def __init__(self, seed: int = BENCH_SEED, config: dict = None):
+        logger_config.update(config or {})
+        # The benchmark always runs in-memory only and without login, so no database is needed
+        logger_config["VERBOSE"] = False
+        logger_config["USE_DB"] = False
+        logger_config["LOGIN"] = False
+        defaults["ARCHIVE"]["GRACE"] = 0    # Purged entries are freed right away, see 'purge'
+        from server_boot import create_app
+        import entry_manager
+        self.em = entry_manager
+        self.app = create_app()
+        self.client = self.app.test_client()
+        self.seed = seed
+        self.senders = bench_senders()
+        self.metrics = {}
+        for url, (color, backcolor, name) in self.senders.items():
+            self.em.add_server(url, color, backcolor, name, log_suppress=True)
+
+    def request(self, method: str, route: str, **kwargs):
+        """
+        Sends a request through the test client. Raises 'RuntimeError' unless it's answered with a 200, so a failing
+        route is never timed as a fast one
+        """
+        response = self.client.open(route, method=method, **kwargs)
+        if response.status_code != 200:
+            raise RuntimeError(f"'{method} {route}' answered {response.status_code}: "
+                               f"'{response.get_data(as_text=True)[:200]}'")
+        return response
+
+    def record(self, name: str, value: float, unit: str, better: str = "lower"):
+        """Stores a single metric. 'better' tells the comparison if lower or higher values are an improvement"""
+        self.metrics[name] = {"value": round(value, 4), "unit": unit, "better": better}
+
+    def purge(self):
+        """Empties the store, and waits for the old entries to be freed, so they don't weigh on what's measured next"""
+        self.em.log_purge(archive=False)
+        self.em.reap_queue.join()
+
+    def fill(self, amount: int):
+        """Purges the store and fills it with 'amount' generated entries, bypassing the HTTP layer"""
+        self.purge()
+        with self.app.test_request_context():
+            for entry in entry_generator(amount, self.em.severities, self.senders, self.seed):
+                self.em.log_add(s_from=entry["from"], severity=entry["severity"], comment=entry["comment"],
+                                body=entry["body"])
+
+    def bench_ingest(self, amount: int):
+        """Measures 'POST /log' throughput, starting from an empty store"""
+        self.purge()
+        payloads = list(entry_generator(amount, self.em.severities, self.senders, self.seed))
+        start = time.perf_counter()
+        for payload in payloads:
+            self.request("POST", "/log", json=payload)
+        elapsed = time.perf_counter() - start
+        self.record("ingest.post_log.throughput", amount / elapsed, "entries/s", better="higher")
+        self.record("ingest.post_log.mean", elapsed * 1000 / amount, "ms")
+
+    def bench_bytes_per_entry(self, amount: int):
+        """Measures how many bytes each stored entry costs, through 'tracemalloc'"""
+        self.purge()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        self.fill(amount)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        self.record("store.bytes_per_entry", (after - before) / amount, "bytes")
+
+    def bench_render(self, size: int, repeat: int):
+        """Measures the rendering latency of '/log' and '/log/old', with and without filters, at 'size' entries"""
+        self.fill(size)
+        a_sender = sorted(self.senders.keys())[0]
+        filters = {"none": "", "severity": "?f=severity&ftgt=error", "from": f"?f=from&ftgt={a_sender}"}
+        for route in ("/log", "/log/old"):
+            for filter_name, query in filters.items():
+                stats = timings(lambda: self.request("GET", route + query), repeat)
+                for stat, value in stats.items():
+                    self.record(f"render{route.replace('/', '.')}.{filter_name}.{size}.{stat}", value, "ms")
+        stats = timings(lambda: self.request("GET", "/server/status"), repeat * 10)
+        for stat, value in stats.items():
+            self.record(f"status.{size}.{stat}", value, "ms")
+
+    def bench_wire(self, repeat: int):
+        """Compares the parse and serialize cost of JSON and MessagePack, then ingest through 'POST /log' batches"""
+        import wire
+        if wire.msgpack is None:
+            progress("'msgpack' isn't installed, skipping the wire format comparison")
+            return
+        codecs = {"json": (lambda obj: json.dumps(obj).encode(), json.loads, wire.JSON),
+                  "msgpack": (lambda obj: wire.msgpack.packb(obj, use_bin_type=True),
+                              lambda data: wire.msgpack.unpackb(data, raw=False), wire.MSGPACK)}
+        rng = random.Random(self.seed)
+        a_sender = sorted(self.senders.keys())[0]
+        for size in WIRE_BODY_SIZES:
+            entry = {"from": a_sender, "severity": "information", "comment": "Wire Format Test",
+                     "body": wire_body(size, rng)}
+            for name, (dumps, loads, mimetype) in codecs.items():
+                data = dumps(entry)
+                self.record(f"wire.{name}.{size}.bytes", len(data), "bytes")
+                # Each sample runs 100 times, so the mean in ms is also the cost of one call in units of 10us
+                encode = timings(lambda: [dumps(entry) for _ in range(100)], repeat)["mean"] * 10
+                decode = timings(lambda: [loads(data) for _ in range(100)], repeat)["mean"] * 10
+                self.record(f"wire.{name}.{size}.encode", encode, "us")
+                self.record(f"wire.{name}.{size}.decode", decode, "us")
+                batch = dumps([entry] * WIRE_BATCH)
+                accept = {"Accept": mimetype}
+                self.purge()
+
+                def post_batch():
+                    stored = loads(self.request("POST", "/log", data=batch, content_type=mimetype,
+                                                headers=accept).get_data())["stored"]
+                    if stored != WIRE_BATCH:    # Dropped or rejected entries would be timed as stored ones
+                        raise RuntimeError(f"Only {stored} of {WIRE_BATCH} batched entries were stored")
+
+                elapsed = timings(post_batch, repeat)["mean"]
+                self.record(f"ingest.batch.{name}.{size}.throughput", WIRE_BATCH * 1000 / elapsed, "entries/s",
+                            better="higher")
+
+    def run(self, sizes, ingest: int, repeat: int, memory_sample: int) -> dict:
+        """Runs the full suite and returns the report"""
+        progress(f"Ingesting {ingest} entries through 'POST /log'")
+        self.bench_ingest(ingest)
+        progress(f"Measuring bytes per entry over {memory_sample} entries")
+        self.bench_bytes_per_entry(memory_sample)
+        progress("Comparing wire formats")
+        self.bench_wire(repeat)
+        for size in sizes:
+            progress(f"Rendering pages with {size} entries stored")
+            self.bench_render(size, repeat)
+        self.purge()
+        return {"meta": {"date": datetime.now().isoformat(timespec="seconds"),
+                         "version": defaults["INTERNAL"]["VERSION"],
+                         "python": platform.python_version(),
+                         "platform": platform.platform(),
+                         "seed": self.seed,
+                         "sizes": sizes,
+                         "repeat": repeat,
+                         "config": {key: value for key, value in logger_config.items() if isinstance(value, bool)}},
+                "metrics": self.metrics}
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+    """
+    Compares two reports and lists every metric that got worse than 'threshold'
+    :param report: The current report
+    :param baseline: A report from a previous run
+    :param threshold: Relative change tolerated before flagging (0.2 = 20%)
+    :return: A list of dicts describing each regression
+    """
+    regressions = []
+    for name, metric in report["metrics"].items():
+        if name not in baseline.get("metrics", {}):
+            continue
+        old = baseline["metrics"][name]["value"]
+        new = metric["value"]
+        if old == 0:
+            continue
+        change = (new - old) / old
+        if metric["better"] == "higher":
+            change = -change
+        if change > threshold:
+            regressions.append({"metric": name, "baseline": old, "current": new, "unit": metric["unit"],
+                                "change": round(change, 4)})
+    return regressions
+
+
+def progress(message: str):
+    """Progress is sent to stderr, so stdout only holds the JSON report"""
+    print(f"[{datetime.now().strftime('%H:%M:%S')}][BENCHMARK] {message}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Log server load and latency benchmark")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="Comma separated store sizes to render pages at (Dft: 10000,100000,1000000)")
+    parser.add_argument("--ingest", type=int, default=2000, help="Entries sent through 'POST /log' (Dft: 2000)")
+    parser.add_argument("--repeat", type=int, default=20, help="Requests per measured route (Dft: 20)")
+    parser.add_argument("--memory-sample", type=int, default=10000,
+                        help="Entries used to measure bytes per entry (Dft: 10000)")
+    parser.add_argument("--seed", type=int, default=BENCH_SEED, help="Workload seed")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=true|false",
+                        help="Sets a boolean 'logger_config' option before booting, e.g. COLUMNAR=true")
+    parser.add_argument("--output", help="Writes the JSON report to this file, instead of stdout")
+    parser.add_argument("--compare", help="A previous JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative change tolerated before flagging a regression (Dft: 0.2)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    config = {}
+    for option in args.set:
+        key, _, value = option.partition("=")
+        config[key.strip().upper()] = value.strip().lower() in ("1", "true", "t", "yes")
+    try:
+        report = Benchmark(seed=args.seed, config=config).run(sizes, args.ingest, args.repeat, args.memory_sample)
+    except RuntimeError as exc:     # A route failed. Its timings would mean nothing
+        progress(f"Benchmark failed: {exc}")
+        sys.exit(2)
+    if args.compare:
+        with open(args.compare) as file:
+            report["regressions"] = compare(report, json.load(file), args.threshold)
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(out)
+    else:
+        print(out)
+    if report.get("regressions"):
+        progress(f"{len(report['regressions'])} regression(s) found")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
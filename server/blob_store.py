@@ -0,0 +1,102 @@
+"""Blob store for large entry bodies, enabled by 'logger_config["BLOBS"]'. A body that takes more than
+'defaults["BLOBS"]["THRESHOLD"]' bytes once pickled is compressed and kept once, addressed by its digest, so identical
+bodies (config dumps, repeated stack traces...) share it. The entry only keeps a 'Blob' reference instead of the body.
+Bodies are decoded back when an entry is rendered or exported ('resolve'), and the latest ones are kept decoded for a
+while, as pages show the same entries over and over. A blob lives as long as an entry (or a cold segment being read)
+references it
+"""
+import hashlib
+import pickle
+import threading
+import weakref
+import zlib
+
+from cache_lru import ByteBudgetLRU
+from server_config import defaults, logger_config
+
+blobs = weakref.WeakValueDictionary()   # Every blob in use, as {digest: Blob}
+blobs_lock = threading.Lock()
+decoded = ByteBudgetLRU("blob_decode", defaults["BLOBS"]["DECODED_BYTES"])     # Recently decoded bodies
+counters = {"offloaded": 0,     # Bodies replaced by a reference
+            "unique": 0,        # Blobs made. The rest of the bodies offloaded were duplicates of one of them
+            "raw_bytes": 0,     # Serialized size of every body offloaded
+            "stored_bytes": 0}  # Compressed size of every blob made
+
+
+class Blob:
+    __slots__ = ("digest", "data", "size", "__weakref__")
+
+    def __init__(self, digest: bytes, data: bytes, size: int):
+        self.digest = digest
+        self.data = data    # The pickled body, compressed
+        self.size = size    # Bytes of the pickled body, before compression
+
+    def __reduce__(self):   # Cold segments keep the compressed body, and share the blob again once read
+        return intern, (self.digest, self.data, self.size)
+
+    def __repr__(self):
+        return f"<Blob {self.digest.hex()} ({self.size} bytes)>"
+
+
+def intern(digest: bytes, data: bytes, size: int) -> Blob:
+    """Returns the blob of 'digest', making it from 'data' if it's not in use"""
+    with blobs_lock:
+        blob = blobs.get(digest)
+        if blob is None:
+            blob = blobs[digest] = Blob(digest, data, size)
+        return blob
+
+
+def offload(body):
+    """
+    Replaces a large body by its blob
+    :param body: Any picklable object
+    :return: A 'Blob', or 'body' itself if it's small enough (or blobs are off)
+    """
+    if logger_config["BLOBS"] is False or body is None or isinstance(body, (int, float, bool)):
+        return body
+    if isinstance(body, (str, bytes)) and len(body) < defaults["BLOBS"]["THRESHOLD"]:
+        return body
+    raw = pickle.dumps(body, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(raw) < defaults["BLOBS"]["THRESHOLD"]:
+        return body
+    digest = hashlib.blake2b(raw, digest_size=16).digest()
+    with blobs_lock:
+        counters["offloaded"] += 1
+        counters["raw_bytes"] += len(raw)
+        blob = blobs.get(digest)
+        if blob is not None:
+            return blob
+    data = zlib.compress(raw, defaults["BLOBS"]["LEVEL"])   # Outside the lock. Only new bodies are compressed
+    with blobs_lock:
+        blob = blobs.get(digest)
+        if blob is None:
+            blob = blobs[digest] = Blob(digest, data, len(raw))
+            counters["unique"] += 1
+            counters["stored_bytes"] += len(data)
+    return blob
+
+
+def resolve(body):
+    """Returns the body a 'Blob' stands for, decoding it if it wasn't recently. Other bodies are returned as they are"""
+    if not isinstance(body, Blob):
+        return body
+    value = decoded.get(body.digest, 0)
+    if value is None:
+        value = pickle.loads(zlib.decompress(body.data))
+        decoded.put(body.digest, 0, value, body.size)
+    return value
+
+
+def stats() -> dict:
+    """Returns how many bodies were offloaded and how much deduplication and compression saved, or None if off"""
+    if logger_config["BLOBS"] is False:
+        return None
+    with blobs_lock:
+        live = list(blobs.values())
+        out = dict(counters)
+    out["live_blobs"] = len(live)
+    out["live_bytes"] = sum(len(blob.data) for blob in live)
+    out["dedup_ratio"] = round(out["offloaded"] / out["unique"], 3) if out["unique"] > 0 else None
+    out["bytes_saved"] = out["raw_bytes"] - out["stored_bytes"]
+    return out
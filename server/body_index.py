@@ -0,0 +1,145 @@
+"""Field-path indexes over entry bodies. Senders put correlation data (a request id, a tenant, a trace id...) in their
+bodies, so some paths of them can be declared as indexed: on 'defaults["BODY_INDEX"]["PATHS"]', or on '/set' with
+'{"type": "index", "path": "request_id"}'. Paths are dotted keys of the body ('ctx.trace_id'). Every entry stored from
+then on has the value on each indexed path (if it's a scalar) read on ingest, into a hash index of the ids holding it.
+Entries stored before the path was declared are indexed once, in the background. Paths declared on '/set' are kept on
+snapshots ('snapshot'), so they're declared again on restart.
+Pages and the JSON API take 'body.<path>=<value>' arguments, resolved through those indexes. Paths that aren't
+indexed are matched by reading the body of every entry in scope instead. Values are compared as text: numbers as
+written in JSON, and booleans as 'true' or 'false'.
+Every function here, but 'extract', 'value_text', 'value_key', 'matches' and 'build', must be called under the store
+lock
+"""
+import json
+from bisect import insort
+
+from blob_store import resolve
+from server_config import defaults
+
+MISSING = object()
+
+indexes = {path: {} for path in defaults["BODY_INDEX"]["PATHS"]}   # {path: {value: [ids holding it, in id order]}}
+building = set()    # Paths declared whose older entries are still being indexed. They can't answer queries yet
+
+
+def extract(body, path: str):
+    """
+    Reads the value on 'path' of 'body'
+    :param body: A decoded body
+    :param path: Dotted keys. Numeric keys also index lists
+    :return: The value, or 'MISSING'
+    """
+    value = body
+    for key in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(key, MISSING)
+        elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+def value_text(value):
+    """Returns the text 'value' is compared as, or None if it's not a scalar"""
+    if isinstance(value, str):
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return json.dumps(value)
+    return None
+
+
+def value_key(value):
+    """Returns the text 'value' is indexed as, or None if it's not a scalar (or it's too long to be indexed)"""
+    key = value_text(value)
+    return key if key is not None and len(key) <= defaults["BODY_INDEX"]["MAX_VALUE_LENGTH"] else None
+
+
+def matches(body, path: str, value: str) -> bool:
+    """Tells if 'body' holds 'value' on 'path'"""
+    return value_text(extract(body, path)) == value
+
+
+def add(msg_id: int, body):
+    """Indexes the body of a new entry on every indexed path"""
+    if not isinstance(body, (dict, list)):
+        return
+    for path, index in indexes.items():
+        key = value_key(extract(body, path))
+        if key is None:
+            continue
+        ids = index.get(key)
+        if ids is None:
+            index[key] = [msg_id]
+        elif ids[-1] < msg_id:
+            ids.append(msg_id)
+        else:   # Replicated entries may arrive older than stored ones
+            insort(ids, msg_id)
+
+
+def declare(path: str) -> bool:
+    """
+    Starts indexing 'path'. Entries stored before aren't indexed until 'backfill' is done
+    :return: False if it was indexed already
+    """
+    if not isinstance(path, str) or path == "":
+        raise ValueError(f"Body path '{path}' is invalid")
+    if path in indexes:
+        return False
+    if len(indexes) >= defaults["BODY_INDEX"]["MAX_PATHS"]:
+        raise ValueError(f"At most {defaults['BODY_INDEX']['MAX_PATHS']} body paths can be indexed")
+    indexes[path] = {}
+    building.add(path)
+    return True
+
+
+def backfill(path: str, older: dict):
+    """
+    Joins the index of the entries stored before 'path' was declared to the one built since, making it usable
+    :param older: The index of the older entries, as built by 'build'
+    """
+    index = indexes.get(path)
+    if index is None:   # Dropped meanwhile
+        return
+    for key, ids in older.items():
+        newer = index.get(key)
+        if newer is None:
+            index[key] = ids
+        elif newer[0] > ids[-1]:
+            index[key] = ids + newer
+        else:
+            index[key] = sorted(set(ids + newer))
+    building.discard(path)
+
+
+def build(path: str, entries) -> dict:
+    """Indexes 'path' of 'entries' (in id order), apart from the live index. Can run outside the store lock"""
+    older = {}
+    for entry in entries:
+        key = value_key(extract(resolve(entry.body), path))
+        if key is not None:
+            older.setdefault(key, []).append(entry.msg_id)
+    return older
+
+
+def lookup(path: str, value: str):
+    """Returns the ids of the entries holding 'value' on 'path', in id order, or None if 'path' isn't indexed (yet)"""
+    index = indexes.get(path)
+    if index is None or path in building:
+        return None
+    return index.get(value, [])
+
+
+def detach() -> dict:
+    """Empties every index, keeping the paths, and returns what they held so it can be freed elsewhere"""
+    global indexes
+    old, indexes = indexes, {path: {} for path in indexes}
+    building.clear()    # Backfills in progress belong to the old entries
+    return old
+
+
+def stats() -> dict:
+    return {path: {"values": len(index), "ids": sum(len(ids) for ids in index.values()), "ready": path not in building}
+            for path, index in indexes.items()}
@@ -0,0 +1,63 @@
+"""Byte budgeted LRU cache, shared by the caches of rendered entries ('render_cache') and of filter results
+('entry_manager')
+"""
+import threading
+from collections import OrderedDict
+
+import metrics
+
+
+class ByteBudgetLRU:
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.revision = None    # Registry revision the cached values were computed against
+        self.items = OrderedDict()  # {key: (value, size)}
+        self.lock = threading.Lock()
+
+    def get(self, key, revision: int):
+        """
+        Returns the cached value of 'key', or None if missing. A 'revision' different from the cached one drops
+        everything first, as every cached value was computed against an outdated registry
+        """
+        with self.lock:
+            if revision != self.revision:
+                self.items.clear()
+                self.used_bytes = 0
+                self.revision = revision
+            item = self.items.get(key)
+            if item is not None:
+                self.items.move_to_end(key)
+        metrics.cache_lookups.inc((self.name, "miss" if item is None else "hit"))
+        return None if item is None else item[0]
+
+    def put(self, key, revision: int, value, size: int):
+        """Stores 'value' for 'key', evicting the least recently used values until it fits the budget"""
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if revision != self.revision:
+                return  # Registry changed while 'value' was being computed
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old[1]
+            self.items[key] = (value, size)
+            self.used_bytes += size
+            while self.used_bytes > self.max_bytes:
+                self.used_bytes -= self.items.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.used_bytes = 0
+
+    def detach(self) -> OrderedDict:
+        """Empties the cache in constant time, returning what it held so it can be freed elsewhere"""
+        with self.lock:
+            items, self.items = self.items, OrderedDict()
+            self.used_bytes = 0
+        return items
+
+    def stats(self) -> dict:
+        return {"items": len(self.items), "bytes": self.used_bytes, "max_bytes": self.max_bytes}
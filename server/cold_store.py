@@ -0,0 +1,322 @@
+"""Cold tier of the list store, enabled by 'logger_config["TIERED"]'. Only the newest entries are kept as objects (the
+hot tier), up to 'defaults["TIER"]["HOT_BYTES"]'. The oldest ones are spilled into segment files, read through 'mmap':
+  - A segment holds a run of consecutive entries. Each record is a fixed header (payload length, id, creation time,
+    sender id and severity) followed by the pickled remaining fields. Headers are enough to filter by sender or
+    severity, so only the entries actually returned are decoded
+  - Every 'INDEX_EVERY' records, a sparse index keeps the record's id, creation time and offset. A position, an id or
+    a time is found with a binary search on it and a walk of at most 'INDEX_EVERY' headers
+  - Each segment counts its entries per severity and sender, as the store does, so pages skip whole segments
+Segments are written by this process, for this process, and deleted along with their generation (or at exit). They're
+never read from elsewhere, so, like snapshots, they must not be taken from untrusted sources
+"""
+import atexit
+import itertools
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+
+from server_config import defaults
+
+HEADER = struct.Struct("<IqdIH")    # Payload length, id, creation time, sender id, severity code
+
+segment_names = itertools.count()
+created_dir = None      # The folder made for the segments, if it wasn't configured. Removed at exit
+
+
+def tier_dir() -> str:
+    """Returns the folder segments are written to: 'LOG_TIER_DIR', 'defaults["TIER"]["PATH"]' or a temporary one"""
+    global created_dir
+    path = os.environ.get("LOG_TIER_DIR", defaults["TIER"]["PATH"])
+    if path is None:
+        if created_dir is None:
+            created_dir = tempfile.mkdtemp(prefix="log_tier_")
+            atexit.register(shutil.rmtree, created_dir, True)
+        return created_dir
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def counted(counts: tuple, severity: str = None, sender_set: set = None, total: int = 0) -> int:
+    """
+    Counts the entries matching every given criteria, from per severity and per sender counters
+    :param counts: '(severity_counts, sender_counts, pair_counts)', as kept by the store and by each segment
+    :param severity: Only entries of this severity (case insensitive)
+    :param sender_set: Only entries sent by one of these sender ids
+    :param total: The count of every entry, returned when not filtered
+    """
+    if severity is not None:
+        severity = severity.casefold()
+        if sender_set is None:
+            return counts[0].get(severity, 0)
+        return sum(counts[2].get((sender_id, severity), 0) for sender_id in sender_set)
+    if sender_set is not None:
+        return sum(counts[1].get(sender_id, 0) for sender_id in sender_set)
+    return total
+
+
+class Segment:
+    def __init__(self, entries: list):
+        """Writes 'entries' (in id order) to a new segment file, and maps it"""
+        every = defaults["TIER"]["INDEX_EVERY"]
+        self.severities = []        # Code to severity, as written
+        codes = {}
+        self.counts = ({}, {}, {})  # As the store's '(severity_counts, sender_counts, pair_counts)'
+        self.index_ids = array("q")
+        self.index_times = array("d")
+        self.index_offsets = array("Q")
+        data = bytearray()
+        for position, entry in enumerate(entries):
+            code = codes.get(entry.severity)
+            if code is None:
+                code = codes[entry.severity] = len(self.severities)
+                self.severities.append(entry.severity)
+            if position % every == 0:
+                self.index_ids.append(entry.msg_id)
+                self.index_times.append(entry.created)
+                self.index_offsets.append(len(data))
+            payload = pickle.dumps((entry.comment, entry.body, entry.is_internal, entry.repeats, entry.last_seen,
+                                    entry.nickname), protocol=pickle.HIGHEST_PROTOCOL)
+            data += HEADER.pack(len(payload), entry.msg_id, entry.created, entry.sender_id, code)
+            data += payload
+            severity = entry.severity.casefold()
+            pair = (entry.sender_id, severity)
+            self.counts[0][severity] = self.counts[0].get(severity, 0) + 1
+            self.counts[1][entry.sender_id] = self.counts[1].get(entry.sender_id, 0) + 1
+            self.counts[2][pair] = self.counts[2].get(pair, 0) + 1
+        self.length = len(entries)
+        self.size = len(data)
+        self.first_id = entries[0].msg_id
+        self.last_id = entries[-1].msg_id
+        self.path = os.path.join(tier_dir(), f"segment_{os.getpid()}_{next(segment_names)}.bin")
+        with open(self.path, "wb") as file:
+            file.write(data)
+        with open(self.path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.length
+
+    def close(self):
+        self.map.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def count(self, severity: str = None, sender_set: set = None) -> int:
+        return counted(self.counts, severity, sender_set, self.length)
+
+    def offset_of(self, position: int) -> int:
+        """Returns where the record at 'position' starts"""
+        block = position // defaults["TIER"]["INDEX_EVERY"]
+        offset = self.index_offsets[block]
+        for _ in range(position - block * defaults["TIER"]["INDEX_EVERY"]):
+            offset += HEADER.size + HEADER.unpack_from(self.map, offset)[0]
+        return offset
+
+    def run(self, position: int, amount: int) -> list:
+        """Returns where each of the 'amount' records from 'position' on start"""
+        offsets = [self.offset_of(position)] if amount > 0 else []
+        for _ in range(amount - 1):
+            offsets.append(offsets[-1] + HEADER.size + HEADER.unpack_from(self.map, offsets[-1])[0])
+        return offsets
+
+    def seek(self, index: array, key, value) -> int:
+        """Returns the position of the first record whose 'key' (a header field) is greater than 'value'"""
+        block = bisect_right(index, value) - 1
+        if block < 0:
+            return 0
+        position = block * defaults["TIER"]["INDEX_EVERY"]
+        offset = self.index_offsets[block]
+        while position < self.length:
+            header = HEADER.unpack_from(self.map, offset)
+            if header[key] > value:
+                break
+            offset += HEADER.size + header[0]
+            position += 1
+        return position
+
+    def position_of_id(self, msg_id: int) -> int:
+        """Returns the position of the first record with an id greater than 'msg_id'"""
+        return self.seek(self.index_ids, 1, msg_id)
+
+    def position_of_time(self, timestamp: float) -> int:
+        """
+        Returns the position of the first record created after 'timestamp'. Creation times follow the wall clock, so
+        it's exact only as long as the clock never went back
+        """
+        return self.seek(self.index_times, 2, timestamp)
+
+    def matches(self, severity: str = None, sender_set: set = None, position: int = 0) -> list:
+        """Returns where each record matching every given criteria (from 'position' on) starts, reading only headers"""
+        codes = None if severity is None else \
+            {code for code, name in enumerate(self.severities) if name.casefold() == severity.casefold()}
+        offsets = []
+        offset = self.offset_of(position) if position < self.length else self.size
+        while offset < self.size:
+            length, _, _, sender_id, code = HEADER.unpack_from(self.map, offset)
+            if (codes is None or code in codes) and (sender_set is None or sender_id in sender_set):
+                offsets.append(offset)
+            offset += HEADER.size + length
+        return offsets
+
+    def entry(self, offset: int, factory):
+        """Decodes the record at 'offset' into an entry, through 'factory' (as 'LogEntry.restore')"""
+        length, msg_id, created, sender_id, code = HEADER.unpack_from(self.map, offset)
+        start = offset + HEADER.size
+        comment, body, is_internal, repeats, last_seen, nick = pickle.loads(self.map[start:start + length])
+        return factory(msg_id, created, self.severities[code], sender_id, is_internal, repeats, comment, body, nick,
+                       last_seen)
+
+
+class ColdTier:
+    def __init__(self, entry_factory):
+        """
+        :param entry_factory: Rebuilds an entry from its fields, as 'LogEntry.restore'
+        """
+        self.entry_factory = entry_factory
+        self.segments = []          # In id order. Every cold entry is older than every hot one
+        self.length = 0
+        self.size = 0               # Bytes of every segment
+        self.counts = ({}, {}, {})  # As the store's '(severity_counts, sender_counts, pair_counts)', cold entries only
+        self.readers = 0            # Reads in progress outside the store lock. It isn't closed until they finish
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.length
+
+    def write(self, entries: list) -> list:
+        """Writes 'entries' (in id order) to new segments, which aren't part of the tier until 'add'ed"""
+        per_segment = defaults["TIER"]["SEGMENT_ENTRIES"]
+        return [Segment(entries[i:i + per_segment]) for i in range(0, len(entries), per_segment)]
+
+    def add(self, segments: list):
+        """Appends segments made by 'write'. Must be called under the store lock"""
+        for segment in segments:
+            self.segments.append(segment)
+            self.length += segment.length
+            self.size += segment.size
+            for mine, theirs in zip(self.counts, segment.counts):
+                for key, amount in theirs.items():
+                    mine[key] = mine.get(key, 0) + amount
+
+    def entry_bytes(self) -> float:
+        """Average bytes an entry takes on the segments, to estimate what it costs as an object"""
+        return self.size / self.length if self.length > 0 else 0
+
+    def first_id(self):
+        return self.segments[0].first_id if self.segments else None
+
+    def last_id(self):
+        return self.segments[-1].last_id if self.segments else None
+
+    def entry_of(self, msg_id: int):
+        """Returns the entry with 'msg_id', or None if it's not on the tier. Only its segment's index is searched"""
+        at = bisect_left(self.segments, msg_id, key=lambda seg: seg.last_id)
+        if at == len(self.segments) or self.segments[at].first_id > msg_id:
+            return None
+        segment = self.segments[at]
+        position = segment.position_of_id(msg_id - 1)
+        if position == segment.length:
+            return None
+        offset = segment.offset_of(position)
+        if HEADER.unpack_from(segment.map, offset)[1] != msg_id:
+            return None
+        return segment.entry(offset, self.entry_factory)
+
+    @contextmanager
+    def reading(self):
+        """Keeps the segments from being closed while reading them outside the store lock"""
+        with self.lock:
+            self.readers += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.readers -= 1
+
+    def close(self):
+        """Deletes every segment, once nothing is reading them"""
+        while self.readers > 0:
+            time.sleep(defaults["ARCHIVE"]["GRACE"])
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+    def count(self, severity: str = None, sender_set: set = None, since: int = None) -> int:
+        """
+        Counts the cold entries matching every given criteria
+        :param since: Only entries with an id greater than this
+        """
+        if since is None or self.first_id() is None or since < self.first_id():
+            return counted(self.counts, severity, sender_set, self.length)
+        total = 0
+        for segment in self.segments[bisect_left(self.segments, since, key=lambda seg: seg.last_id):]:
+            if segment.first_id > since:
+                total += segment.count(severity, sender_set)
+            else:
+                total += len(segment.matches(severity, sender_set, segment.position_of_id(since)))
+        return total
+
+    def window(self, severity: str = None, sender_set: set = None, offset: int = 0, limit: int = None,
+               newest_first: bool = False, since: int = None) -> list:
+        """
+        Same as 'entry_manager.entry_window', on the cold entries. Whole segments are skipped through their counters,
+        and only the entries returned are decoded
+        """
+        entries = []
+        for segment in reversed(self.segments) if newest_first else self.segments:
+            wanted = None if limit is None else limit - len(entries)
+            if wanted == 0:
+                break
+            position = 0
+            if since is not None and not newest_first:
+                if segment.last_id <= since:
+                    continue
+                position = segment.position_of_id(since)
+            if position == 0:
+                total = segment.count(severity, sender_set)
+                if offset >= total:
+                    offset -= total
+                    continue
+            if severity is None and sender_set is None:
+                total = segment.length - position
+                if offset >= total:
+                    offset -= total
+                    continue
+                amount = total - offset if wanted is None else min(wanted, total - offset)
+                if newest_first:
+                    offsets = segment.run(segment.length - offset - amount, amount)[::-1]
+                else:
+                    offsets = segment.run(position + offset, amount)
+            else:
+                offsets = segment.matches(severity, sender_set, position)
+                if offset >= len(offsets):
+                    offset -= len(offsets)
+                    continue
+                if newest_first:
+                    offsets.reverse()
+                offsets = offsets[offset:None if wanted is None else offset + wanted]
+            offset = 0
+            entries.extend(segment.entry(at, self.entry_factory) for at in offsets)
+        return entries
+
+    def iterate(self, severity: str = None, sender_set: set = None, segments: list = None):
+        """
+        Lazily iterates the cold entries matching every given criteria, in id order
+        :param segments: Only these segments. Defaults to every segment, as they are once iterating starts
+        """
+        for segment in list(self.segments) if segments is None else segments:
+            for offset in segment.matches(severity, sender_set):
+                yield segment.entry(offset, self.entry_factory)
+
+    def stats(self) -> dict:
+        return {"entries": self.length, "segments": len(self.segments), "bytes": self.size}
@@ -0,0 +1,192 @@
+"""Optional columnar entry store, enabled by 'logger_config["COLUMNAR"]'. Instead of a list of 'LogEntry' objects, each
+field is kept on its own typed array ('msg_id', timestamp, severity code, sender id, internal flag and repeat count)
+and comments, bodies and nicknames on plain side lists. Filters and counts run as mask operations over the arrays
+(vectorized with NumPy, if it's installed) and 'LogEntry' objects are only built for the rows actually read
+"""
+import heapq
+import sys
+from array import array
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:  # Optional dependency. Without it, filters run as plain loops over the arrays
+    numpy = None
+
+
+class ColumnStore:
+    def __init__(self, entry_factory):
+        """
+        :param entry_factory: Builds an entry out of a row. Called as 'entry_factory(msg_id, created, severity,
+        sender_id, is_internal, repeats, comment, body, nickname, last_seen)'
+        """
+        self.entry_factory = entry_factory
+        self.severity_codes = {}    # {severity name: code}
+        self.severity_names = []    # Code to severity name
+        self.columns = Columns(self)
+
+    def clear(self):
+        """
+        Drops every row. Columns are replaced, not emptied, so views taken before keep reading the rows they selected
+        """
+        self.columns = Columns(self)
+
+    def __len__(self):
+        return len(self.columns.msg_ids)
+
+    def __getitem__(self, item):
+        return EntryView(self.columns, range(len(self)))[item]
+
+    def __iter__(self):
+        return iter(EntryView(self.columns, range(len(self))))
+
+    def append(self, entry):
+        """
+        Decomposes 'entry' into the columns. The object itself isn't kept. A new severity is only given its code once
+        the row is in
+        """
+        code = self.severity_codes.get(entry.severity)
+        if code is None:
+            self.columns.append(entry, len(self.severity_names))
+            self.severity_codes[entry.severity] = len(self.severity_names)
+            self.severity_names.append(entry.severity)
+        else:
+            self.columns.append(entry, code)
+
+    def repeat(self, entry):
+        """Copies the repeat count and last seen time of 'entry' (already stored) onto its row"""
+        self.columns.repeat(entry)
+
+    def select(self, severity: str = None, sender_ids: set = None):
+        """
+        Selects the rows matching every given criteria. Must run under the store lock: appends can't resize a column
+        while NumPy is reading it
+        :param severity: Only rows of this severity (case insensitive)
+        :param sender_ids: Only rows sent by one of these sender ids
+        :return: An 'EntryView' of the matching rows, in id order
+        """
+        codes = None
+        if severity is not None:
+            target = severity.casefold()
+            codes = [code for name, code in self.severity_codes.items() if name.casefold() == target]
+        return self.columns.select(codes, sender_ids)
+
+    def memory_bytes(self) -> int:
+        """Approximate bytes held by the columns (bodies and comments are counted as pointers only)"""
+        return self.columns.memory_bytes()
+
+
+class Columns:
+    """The arrays of a 'ColumnStore'. Replaced as a whole when the store is cleared"""
+
+    def __init__(self, store: ColumnStore):
+        self.store = store
+        self.msg_ids = array("q")
+        self.created = array("d")
+        self.severity = array("I")     # Clients choose their severities, so there may be more than 65536
+        self.sender = array("I")
+        self.internal = array("b")
+        self.repeats = array("I")
+        self.comments = []
+        self.bodies = []
+        self.nicknames = []
+        self.last_seen = {}     # {row: timestamp}. Only rows that were repeated
+        self.partitions = {}    # Rows of each sender, as {sender id: array of rows}
+
+    def append(self, entry, code: int):
+        """
+        Appends a row. If a value doesn't fit its array ('OverflowError' or 'TypeError'), the arrays are cut back to
+        where they were before raising, so they never go out of step
+        """
+        row = len(self.msg_ids)
+        try:
+            self.msg_ids.append(entry.msg_id)
+            self.created.append(entry.created)
+            self.severity.append(code)
+            self.sender.append(entry.sender_id)
+            self.internal.append(entry.is_internal)
+            self.repeats.append(entry.repeats)
+        except (OverflowError, TypeError):
+            for column in (self.msg_ids, self.created, self.severity, self.sender, self.internal, self.repeats):
+                del column[row:]
+            raise
+        partition = self.partitions.get(entry.sender_id)
+        if partition is None:
+            partition = self.partitions[entry.sender_id] = array("q")
+        partition.append(row)
+        self.comments.append(entry.comment)
+        self.bodies.append(entry.body)
+        self.nicknames.append(None if entry.nickname is None else sys.intern(entry.nickname))
+
+    def repeat(self, entry):
+        row = self.row_of(entry.msg_id)
+        if row is not None:
+            self.repeats[row] = entry.repeats
+            self.last_seen[row] = entry.last_seen
+
+    def row_of(self, msg_id: int):
+        """Returns the row holding 'msg_id', or None. Ids are appended in order, so it's a binary search"""
+        row = bisect_left(self.msg_ids, msg_id)
+        if row < len(self.msg_ids) and self.msg_ids[row] == msg_id:
+            return row
+        return None
+
+    def materialize(self, row: int):
+        """Builds the 'LogEntry' of 'row'"""
+        return self.store.entry_factory(self.msg_ids[row], self.created[row],
+                                        self.store.severity_names[self.severity[row]], self.sender[row],
+                                        bool(self.internal[row]), self.repeats[row], self.comments[row],
+                                        self.bodies[row], self.nicknames[row], self.last_seen.get(row))
+
+    def select(self, codes: list = None, sender_ids: set = None):
+        """
+        Returns an 'EntryView' of the rows whose severity code is in 'codes' and sender id in 'sender_ids'. Selecting by
+        sender only reads the partitions of those senders
+        """
+        rows = len(self.msg_ids)
+        if sender_ids is not None:
+            parts = [self.partitions[sid] for sid in sender_ids if sid in self.partitions]
+            if numpy is not None:
+                selected = numpy.sort(numpy.concatenate([numpy.array(part, dtype=numpy.int64) for part in parts])) \
+                    if parts else numpy.zeros(0, dtype=numpy.int64)
+                if codes is not None:
+                    severity = numpy.frombuffer(self.severity, dtype=numpy.uint32, count=rows)
+                    selected = selected[numpy.isin(severity[selected], codes)]
+                return EntryView(self, selected)
+            selected = list(heapq.merge(*parts))
+            if codes is not None:
+                codes = set(codes)
+                selected = [row for row in selected if self.severity[row] in codes]
+            return EntryView(self, selected)
+        if codes is not None:
+            if numpy is not None:
+                severity = numpy.frombuffer(self.severity, dtype=numpy.uint32, count=rows)
+                return EntryView(self, numpy.flatnonzero(numpy.isin(severity, codes)))
+            codes = set(codes)
+            return EntryView(self, [row for row, code in enumerate(self.severity) if code in codes])
+        return EntryView(self, range(rows))
+
+    def memory_bytes(self) -> int:
+        return sum(col.itemsize * len(col) for col in (self.msg_ids, self.created, self.severity, self.sender,
+                                                       self.internal, self.repeats)) + \
+            sys.getsizeof(self.comments) + sys.getsizeof(self.bodies) + sys.getsizeof(self.nicknames)
+
+
+class EntryView:
+    """A read-only sequence of selected rows of a 'ColumnStore'. Slicing is free, entries are built when accessed"""
+
+    def __init__(self, columns: Columns, rows):
+        self.columns = columns
+        self.rows = rows    # A range, a list or a NumPy array of row numbers
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return EntryView(self.columns, self.rows[item])
+        return self.columns.materialize(int(self.rows[item]))
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.columns.materialize(int(row))
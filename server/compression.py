@@ -0,0 +1,88 @@
+"""Negotiated compression of dynamic responses. Responses above 'defaults["COMPRESSION"]["MIN_SIZE"]' are compressed
+with brotli (if the 'brotli' package is installed) or gzip, following the client's 'Accept-Encoding'. Streamed
+(generator) responses are compressed chunk by chunk, flushing each one so the client still gets them as they come
+"""
+import zlib
+
+import flask
+
+from server_config import defaults, logger_config
+
+try:
+    import brotli
+except ImportError:  # Optional dependency. Without it, only gzip is offered
+    brotli = None
+
+
+def negotiate() -> str:
+    """Returns the best encoding both the client and the server support, or None"""
+    offers = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return flask.request.accept_encodings.best_match(offers)
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compresses 'data' in one go"""
+    if encoding == "br":
+        return brotli.compress(data, quality=defaults["COMPRESSION"]["BR_QUALITY"])
+    compressor = gzip_compressor()
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_compressor():
+    """Returns a zlib compressor that writes the gzip container"""
+    return zlib.compressobj(defaults["COMPRESSION"]["LEVEL"], zlib.DEFLATED, 31)   # 16 + 15: gzip header, 32K window
+
+
+def gzip_stream(chunks):
+    """Compresses an iterable of chunks into a single gzip stream, flushing each chunk as it comes"""
+    compressor = gzip_compressor()
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        out = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def brotli_stream(chunks):
+    """Compresses an iterable of chunks into a single brotli stream, flushing each chunk as it comes"""
+    compressor = brotli.Compressor(quality=defaults["COMPRESSION"]["BR_QUALITY"])
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        out = compressor.process(chunk) + compressor.flush()
+        if out:
+            yield out
+    yield compressor.finish()
+
+
+def compressible(response: flask.Response) -> bool:
+    """Returns True if 'response' is worth (and safe) compressing"""
+    return (200 <= response.status_code < 300 and response.status_code != 204 and
+            response.mimetype in defaults["COMPRESSION"]["MIMETYPES"] and
+            "Content-Encoding" not in response.headers and
+            not response.direct_passthrough)   # Files. Static assets are precompressed by 'assets'
+
+
+def init_app(app: flask.Flask):
+    """Compresses every eligible response of 'app'"""
+    @app.after_request
+    def compress_response(response):
+        if logger_config["COMPRESS"] is False or not compressible(response):
+            return response
+        encoding = negotiate()
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            body = response.response
+            response.response = brotli_stream(body) if encoding == "br" else gzip_stream(body)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < defaults["COMPRESSION"]["MIN_SIZE"]:
+                return response
+            response.set_data(compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
@@ -1,18 +1,117 @@
 import flask
+import heapq
+import json
+import queue
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from datetime import datetime
+from itertools import chain, islice
+from operator import attrgetter, itemgetter
 
 from typing import Tuple
 
+import alerts
+import blob_store
+import body_index
+import metrics
+import scan
+from cache_lru import ByteBudgetLRU
+from cold_store import ColdTier, counted
+from columnar import ColumnStore
 from flask_wrappers import authenticated_user_is
+from metrics import timed
 from server_config import defaults, logger_config, print_verbose
 
 entry_list = []     # All of our entries
+partitions = {}     # The same entries, partitioned by sender, as {sender id: [entries]}. Only for the list store
 global_id = 0       # Global Entry Identifier
 # Severities classes (FG Color, BG Color). The key is the severity
 # This here ensure the severities AND server's lists are filled with at least default values
 severities = defaults["SEVERITIES"]            # Severity name, color and backcolor
 servers_list = defaults["SERVERS"]             # User list with proper name, color, backcolor and expected URL
-db_entries = []                                # DB Fetched past entries
+# Senders seen but never defined (by default, the database or 'add_server'), as {s_from: (None, None, ip)}. Least
+# recently active first, and capped at 'defaults["REGISTRY"]["MAX_DISCOVERED"]'
+discovered = OrderedDict()
+discovered_pending = []                        # Senders discovered since the last notice, as [(s_from, ip)]
+discovered_evicted = 0                         # Senders evicted from 'discovered' since the last notice
+notice_timer = None                            # Logs the pending notice once 'NOTICE_INTERVAL' is over
+last_notice = None                             # 'time.monotonic()' of the last notice
+db_entries = None                              # Past entries of the database, as 'models.DbHistory', once reached
+registry_rev = 0                               # Bumped whenever a severity or server changes. Keys render caches
+store_lock = threading.RLock()                 # Guards id assignment and every change to the entry store
+sender_ids = {}                                # Every sender ever seen, interned as {s_from: sender id}
+sender_names = []                              # Sender id to sender ('s_from'). None for ids freed by 'sender_compact'
+sender_free = []                               # Ids freed by 'sender_compact', given to new senders first
+sender_matches = {}                            # Cached 'from' filters, as {target: ids of senders containing target}
+store_rev = 0                                  # Bumped on every change to the stored entries, repeats included
+coalesce_last = {}                             # Last entry of each sender, as {s_from: (digest, entry)}
+id_clock = None                                # A 'hlc.HybridClock' when replication is on. Entry ids come from it
+local_entries = []                             # Entries taken here (not replicated, nor internal). Only if replicating
+late_entries = []                              # Replicated entries merged behind the delta cursors, as [(stamp, entry)]
+late_ids = {}                                  # The stamps of 'late_entries', as {msg_id: stamp}
+severity_counts = {}                           # Entries stored per severity, as {casefolded severity: count}
+sender_counts = {}                             # Entries stored per sender, as {sender id: count}
+pair_counts = {}                               # Entries stored per sender and severity, as {(sender id, sev): count}
+store_gen = 0                                  # Bumped when stored entries are removed or inserted out of order
+filter_cache = ByteBudgetLRU("log_filter", defaults["CACHE"]["FILTER_BYTES"])   # Filter results of the list store
+generation = 0                                 # Number of the current generation. Every purge starts a new one
+archives = []                                  # Purged generations still queryable, as 'Generation', oldest first
+reap_queue = queue.Queue()                     # What's left to free, as (queued at, [garbage])
+reaper = None                                  # The thread freeing it
+cold_tier = None                               # Spilled entries, as a 'ColdTier'. Only if 'logger_config["TIERED"]'
+spill_at = 0                                   # Hot entries that trigger a spill to the cold tier
+spill_wanted = threading.Event()               # Wakes the spiller thread
+spiller = None
+
+
+def store_init():
+    """Picks the entry store. Columnar if 'logger_config["COLUMNAR"]' is True. Must be called before adding entries"""
+    global entry_list, cold_tier, spill_at
+    if logger_config["REPLICATION"] is True:
+        # Replicated entries arrive out of order and must be inserted mid-store, which the columns don't support, nor
+        # segments already written
+        for store in ("COLUMNAR", "TIERED"):
+            if logger_config[store] is True:
+                logger_config[store] = False
+                print_verbose(sender=__name__, message=f"{store.capitalize()} store disabled: it doesn't support "
+                                                       f"replication")
+    if logger_config["TIERED"] is True and logger_config["COLUMNAR"] is True:
+        logger_config["COLUMNAR"] = False   # Only the list store spills to the cold tier
+        print_verbose(sender=__name__, message="Columnar store disabled: the tiered store is a list")
+    with store_lock:
+        if logger_config["TIERED"] is True and cold_tier is None:
+            cold_tier = ColdTier(LogEntry.restore)
+            spill_at = hot_capacity()
+        if logger_config["COLUMNAR"] is True and not isinstance(entry_list, ColumnStore):
+            entry_list = ColumnStore(LogEntry.restore)
+        elif logger_config["COLUMNAR"] is False and isinstance(entry_list, ColumnStore):
+            entry_list = []
+        else:
+            return
+    print_verbose(sender=__name__, message=f"Entry store is {'columnar' if logger_config['COLUMNAR'] else 'a list'}")
+
+
+def id_clock_set(clock):
+    """
+    Takes entry ids from 'clock' (a 'hlc.HybridClock') from now on, instead of the sequential ones
+    :param clock: The clock, or None to go back to sequential ids
+    """
+    global id_clock
+    with store_lock:
+        id_clock = clock
+        if clock is not None and len(entry_list) > 0:     # Entries restored from a snapshot
+            clock.observe(entry_list[-1].msg_id)
+
+
+def next_id() -> int:
+    """Returns the id of a new entry. Must be called under the store lock"""
+    global global_id
+    if id_clock is not None:
+        return id_clock.now()
+    global_id += 1
+    return global_id - 1
 
 
 def lists_count() -> Tuple[int, int, int]:
@@ -20,19 +119,292 @@ def lists_count() -> Tuple[int, int, int]:
     Returns the current length of all lists
     :return: A tuple containing the lengths of (severity, server, entry) lists
     """
-    return len(severities), len(servers_list), len(entry_list)
+    return len(severities), len(servers_list), log_count()
+
+
+def registry_version():
+    """Returns the current registry revision. Anything derived from the severities or servers is stale once it moves"""
+    return registry_rev
+
+
+def sender_intern(s_from: str) -> int:
+    """
+    Returns the integer id of the sender 's_from', assigning a new one if it was never seen before. Cached 'from'
+    filters are extended with the new sender, instead of being recomputed
+    :param s_from: Who sent the entry
+    """
+    sender_id = sender_ids.get(s_from)
+    if sender_id is None:
+        with store_lock:
+            sender_id = sender_ids.get(s_from)
+            if sender_id is None:
+                if sender_free:
+                    sender_id = sender_free.pop()
+                    sender_names[sender_id] = s_from
+                else:
+                    sender_id = len(sender_names)
+                    sender_names.append(s_from)
+                sender_ids[s_from] = sender_id
+                for target, ids in sender_matches.items():
+                    if target in s_from:
+                        ids.add(sender_id)
+    return sender_id
+
+
+def sender_compact() -> int:
+    """
+    Forgets the senders that no entry references anymore (stored, archived or waiting to be freed), so senders that
+    come and go (per-pod hostnames...) don't grow the intern table, and the cost of new 'from' filters, for good. Their
+    ids are given to new senders. Senders only go away with purged entries, so it's run once they're freed
+    :return: How many senders were forgotten
+    """
+    with store_lock:
+        if not reap_queue.empty():  # Generations waiting to be freed still reference theirs
+            return 0
+        used = {sender_id for sender_id, count in sender_counts.items() if count > 0}
+        for old in archives:
+            used.update(old.counts[1])
+        if db_entries is not None:
+            used.update(db_entries.user_senders.values())
+        used.add(sender_ids.get(defaults["INTERNAL"]["SERVER_NAME"]))
+        unused = [sender_id for sender_id in sender_ids.values() if sender_id not in used]
+        for sender_id in unused:
+            del sender_ids[sender_names[sender_id]]
+            sender_names[sender_id] = None
+        sender_free.extend(unused)
+        if unused:  # Cached sender sets may hold the ids freed, which will be given to other senders
+            sender_matches.clear()
+            filter_cache.clear()
+    if unused:
+        print_verbose(sender=__name__, message=f"{len(unused)} senders no longer referenced were forgotten")
+    return len(unused)
+
+
+def sender_match(target: str) -> set:
+    """
+    Returns the ids of every sender whose name contains 'target'. Computed once against the distinct senders and kept
+    up to date by 'sender_intern', so 'from' filters become an integer membership test per entry
+    :param target: The substring to look for. Same semantics as 'target in entry.log_from'
+    :return: A set of sender ids. It's shared, so it must not be modified
+    """
+    ids = sender_matches.get(target)
+    if ids is None:
+        with store_lock:
+            if len(sender_matches) >= defaults["CACHE"]["SENDER_MATCHES"]:
+                sender_matches.clear()
+            ids = {sender_id for s_from, sender_id in sender_ids.items() if target in s_from}
+            sender_matches[target] = ids
+    return ids
 
 
 def log_count():
-    """Returns the entry list length"""
-    return len(entry_list)
+    """Returns how many entries are stored, on both tiers"""
+    return len(entry_list) + (len(cold_tier) if cold_tier is not None else 0)
+
+
+def log_revision():
+    """Returns the store revision. It moves whenever an entry is added, repeated or purged, even if the count doesn't"""
+    return store_rev
+
+
+def log_purge(archive: bool = True):
+    """
+    Starts a new, empty generation of the store. The old one isn't cleared in place: its containers are swapped for
+    new ones, so purging costs the same whatever the store size. It's then kept as a read-only 'Generation' (see
+    'defaults["ARCHIVE"]'), or handed to the reaper thread, which frees it in the background
+    :param archive: If False, the old generation is freed instead of archived
+    :return: The archived 'Generation', or None
+    """
+    global entry_list, partitions, local_entries, severity_counts, sender_counts, pair_counts, coalesce_last, \
+        store_rev, store_gen, generation, cold_tier, late_entries, late_ids
+    with store_lock:
+        old = Generation(generation, entry_list, partitions, (severity_counts, sender_counts, pair_counts), cold_tier)
+        filtered = {key: cached[0]["entries"] for key, cached in filter_cache.detach().items()}
+        garbage = [local_entries, coalesce_last, filtered, body_index.detach()]
+        entry_list = ColumnStore(LogEntry.restore) if isinstance(entry_list, ColumnStore) else []
+        cold_tier = ColdTier(LogEntry.restore) if cold_tier is not None else None
+        partitions = {}
+        local_entries = []
+        late_entries, late_ids = [], {}
+        severity_counts, sender_counts, pair_counts = {}, {}, {}
+        coalesce_last = {}
+        generation += 1
+        store_rev += 1
+        store_gen += 1
+        if archive and defaults["ARCHIVE"]["GENERATIONS"] > 0 and old.length() > 0:
+            archives.append(old)
+        else:
+            garbage.append(old)
+            old = None
+        while len(archives) > defaults["ARCHIVE"]["GENERATIONS"]:
+            garbage.append(archives.pop(0))
+        reap(garbage)
+    return old
+
+
+def hot_capacity() -> int:
+    """
+    Returns how many entries fit the hot tier budget. An entry is estimated as 'ENTRY_OVERHEAD' (the object itself)
+    plus what it takes once encoded on the cold tier, which grows with its comment and body
+    """
+    encoded = cold_tier.entry_bytes() if cold_tier is not None and len(cold_tier) > 0 else 200
+    return max(int(defaults["TIER"]["HOT_BYTES"] / (defaults["TIER"]["ENTRY_OVERHEAD"] + encoded)),
+               defaults["TIER"]["SEGMENT_ENTRIES"])
+
+
+def spill_check():
+    """Wakes the spiller thread if the hot tier is over its budget. Must be called under the store lock"""
+    global spiller
+    if cold_tier is None or len(entry_list) <= spill_at:
+        return
+    spill_wanted.set()
+    if spiller is None or not spiller.is_alive():     # Also after a fork, which doesn't carry the thread over
+        spiller = threading.Thread(target=spill_run, name="tier_spiller", daemon=True)
+        spiller.start()
+
+
+def spill_run():
+    while True:
+        spill_wanted.wait()
+        spill_wanted.clear()
+        try:
+            tier_spill()
+        except OSError as exc:  # Disk full, most likely. The entries stay hot, and it's tried again on the next check
+            print_verbose(sender=__name__, message=f"Spilling to the cold tier failed: '{exc}'")
+
+
+def tier_spill() -> int:
+    """
+    Moves the oldest hot entries to the cold tier, until the hot tier is down to 'LOW_WATER' of its budget. They're
+    encoded and written without the store lock, and only swapped in under it
+    :return: How many entries were moved
+    """
+    global store_gen, spill_at
+    with store_lock:
+        cold, number = cold_tier, generation
+        excess = len(entry_list) - int(spill_at * defaults["TIER"]["LOW_WATER"])
+        if cold is None or excess <= 0:
+            return 0
+        moving = entry_list[:excess]
+        last_id = moving[-1].msg_id
+        for s_from, (_, entry) in list(coalesce_last.items()):
+            if entry.msg_id <= last_id:     # Moving entries must not be repeated anymore, it wouldn't be written
+                del coalesce_last[s_from]
+    start = time.perf_counter()
+    segments = cold.write(moving)
+    with store_lock:
+        if number != generation:    # Purged meanwhile
+            for segment in segments:
+                segment.close()
+            return 0
+        del entry_list[:excess]
+        for part in partitions.values():
+            del part[:bisect_right(part, last_id, key=attrgetter("msg_id"))]
+        cold.add(segments)
+        store_gen += 1  # Cached filter results point into the hot tier
+        spill_at = hot_capacity()
+    print_verbose(sender=__name__, message=f"Spilled {excess} entries to {len(segments)} cold segment(s) in "
+                                           f"{round((time.perf_counter() - start) * 1000, 3)}ms")
+    return excess
+
+
+def history_set(history):
+    """
+    Lets pages go on into the past entries of the database once they're past the stored ones
+    :param history: A 'models.DbHistory', or None to stop
+    """
+    global db_entries
+    db_entries = history
+
+
+def history_stats() -> dict:
+    """Returns what's known and cached of the past entries of the database, or None if they aren't reachable"""
+    return None if db_entries is None else db_entries.stats()
+
+
+def tier_stats() -> dict:
+    """Returns the size of both tiers, or None if the store isn't tiered"""
+    if cold_tier is None:
+        return None
+    return {"hot": len(entry_list), "spill_at": spill_at, "cold": cold_tier.stats()}
+
 
+def archive_list() -> list:
+    """Returns the archived generations still kept, oldest first, after dropping those that aged out"""
+    with store_lock:
+        max_age = defaults["ARCHIVE"]["MAX_AGE"]
+        if max_age is not None:
+            expired = [old for old in archives if time.time() - old.purged > max_age]
+            if expired:
+                archives[:] = [old for old in archives if old not in expired]
+                reap(expired)
+        return list(archives)
 
-def log_purge():
-    """Clears the entry list"""
-    entry_list.clear()
 
+def archive_get(number: int):
+    """Returns the archived generation 'number', or None if it isn't kept (or never existed)"""
+    for old in archive_list():
+        if old.number == number:
+            return old
+    return None
+
+
+def reap(garbage: list):
+    """
+    Frees 'garbage' on the reaper thread, after 'defaults["ARCHIVE"]["GRACE"]' seconds, so requests still reading it
+    finish first. Must be called under the store lock
+    """
+    global reaper
+    reap_queue.put((time.monotonic(), garbage))
+    if reaper is None or not reaper.is_alive():    # Also after a fork, which doesn't carry the thread over
+        reaper = threading.Thread(target=reap_run, name="store_reaper", daemon=True)
+        reaper.start()
+
+
+def reap_run():
+    while True:
+        queued, garbage = reap_queue.get()
+        time.sleep(max(queued + defaults["ARCHIVE"]["GRACE"] - time.monotonic(), 0))
+        start = time.perf_counter()
+        for item in garbage:
+            release(item)
+        print_verbose(sender=__name__,
+                      message=f"Purged entries freed in {round((time.perf_counter() - start) * 1000, 3)}ms")
+        del garbage
+        reap_queue.task_done()
+        sender_compact()
 
+
+def release(item):
+    """
+    Empties 'item' a chunk at a time. Freeing millions of entries at once would hold the interpreter lock for as long,
+    stalling every request
+    :param item: A 'Generation', a 'ColumnStore', a list, or a dict whose list values are emptied the same way. Cold
+    tiers are deleted
+    """
+    if isinstance(item, Generation):
+        while item.readers > 0:     # Being exported. Waits for it to finish
+            time.sleep(defaults["ARCHIVE"]["GRACE"])
+        release(item.partitions)
+        release(item.entries)
+        if item.cold is not None:
+            item.cold.close()
+    elif isinstance(item, ColumnStore):     # Only the text columns hold objects. Arrays are freed at once
+        for column in (item.columns.comments, item.columns.bodies, item.columns.nicknames):
+            release(column)
+        item.clear()
+    elif isinstance(item, dict):
+        while item:
+            value = item.popitem()[1]
+            if isinstance(value, list):
+                release(value)
+    elif isinstance(item, list):
+        while item:
+            del item[-defaults["ARCHIVE"]["REAP_CHUNK"]:]
+            time.sleep(0)   # Lets other threads run between chunks
+
+
+@timed("log_get")
 def log_get(filter_by=None, target=None):
     """ Returns a list of entries based on the filter
     :param filter_by: Will filter by whom sent the entry or the severity of the entry (default to 'off')
@@ -40,54 +412,721 @@ def log_get(filter_by=None, target=None):
     :returns: A list with only the selected severity, or the server + internal messages or everything if 'off'.
     If 'target' is invalid, still returns everything, but add an entry regarding the error
     """
+    return entry_select(*log_scope(filter_by, target))
+
+
+def log_scope(filter_by=None, target=None) -> Tuple[str, set]:
+    """
+    Resolves a filter, and the scope of the current user, into the criteria of 'entry_select', 'entry_count' and
+    'entry_window'
+    :param filter_by: Will filter by whom sent the entry or the severity of the entry (default to 'off')
+    :param target: The value to match against. if 'log_config["PUBLIC"] is True, target will be the user
+    :return: A '(severity, sender set)' tuple. None on either means it's not filtered by it
+    """
     if filter_by is None:
         filter_by = "off"
-    server_name = defaults["INTERNAL"]["SERVER_NAME"]
+    internal_id = sender_intern(defaults["INTERNAL"]["SERVER_NAME"])
     cur_user = authenticated_user_is()
     if logger_config["PUBLIC"] is False and logger_config["LOGIN"] is True and cur_user is not None:
-        user = cur_user.url
+        user_ids = sender_match(cur_user.url) | {internal_id}   # Anyone containing the user's url, plus internals
         if filter_by != "off":
             if filter_by == 'severity':      # Filter by severity and user + internal
-                return [entry for entry in entry_list if entry.severity.casefold() == target.casefold() and
-                        (entry.log_from == user or entry.log_from == server_name)]
+                return target, {sender_ids.get(cur_user.url), internal_id}
             elif filter_by == 'from':        # Filter by name, but always include internals
-                return [entry for entry in entry_list if (user in entry.log_from or entry.log_from == server_name)]
+                return None, user_ids
             else:                            # Unknown filter
                 log_internal(severity="Error", comment=f"Filter '{filter_by}' targeting '{target}' is invalid")
-                return [entry for entry in entry_list if (user in entry.log_from or entry.log_from == server_name)]
+                return None, user_ids
         else:
-            return [entry for entry in entry_list if (user in entry.log_from or entry.log_from == server_name)]
+            return None, user_ids
     else:
         if filter_by.casefold() != "off":
             if filter_by == 'severity':      # Filter by severity
-                return [entry for entry in entry_list if entry.severity.casefold() == target.casefold()]
+                return target, None
             elif filter_by == 'from':        # Filter by name, but always include internals
-                return [entry for entry in entry_list if (target in entry.log_from or entry.log_from == server_name)]
+                return None, sender_match(target) | {internal_id}
             else:                            # Unknown filter
                 log_internal(severity="Error", comment=f"Filter '{filter_by}' targeting '{target}' is invalid")
-                return entry_list
+                return None, None
+        else:
+            return None, None
+
+
+def entry_count(severity: str = None, sender_set: set = None) -> int:
+    """
+    Counts the stored entries matching every given criteria, from the per severity and per sender counters. Costs as
+    much as the senders in 'sender_set', not the entries
+    :param severity: Only entries of this severity (case insensitive)
+    :param sender_set: Only entries sent by one of these sender ids
+    """
+    return counted((severity_counts, sender_counts, pair_counts), severity, sender_set, log_count())
+
+
+def entry_counted(entry, amount: int = 1):
+    """Adds 'entry' to the counters ('amount' = -1 removes it). Must be called under the store lock"""
+    severity = entry.severity.casefold()
+    severity_counts[severity] = severity_counts.get(severity, 0) + amount
+    sender_counts[entry.sender_id] = sender_counts.get(entry.sender_id, 0) + amount
+    pair = (entry.sender_id, severity)
+    pair_counts[pair] = pair_counts.get(pair, 0) + amount
+
+
+@timed("log_get")
+def entry_window(severity: str = None, sender_set: set = None, offset: int = 0, limit: int = None,
+                 newest_first: bool = False, since: int = None) -> list:
+    """
+    Returns only a window of the entries matching every given criteria. Entries out of it are never built, and, on the
+    list store, never visited past 'offset'
+    :param severity: Only entries of this severity (case insensitive)
+    :param sender_set: Only entries sent by one of these sender ids
+    :param offset: How many matching entries to skip
+    :param limit: Most entries to return. None for all of them
+    :param newest_first: If True, counts from the newest entry backwards
+    :param since: Only entries with an id greater than this. Ignored if 'newest_first'
+    :return: A list of entries
+    """
+    if isinstance(entry_list, ColumnStore):
+        view = entry_select(severity=severity, sender_set=sender_set)
+        if since is not None and not newest_first:
+            view = log_since(view, since)
+        return slice_window(view, offset, limit, newest_first)
+
+    def hot_window(hot_offset: int, hot_limit: int = None) -> list:
+        entries = filter_result(severity, sender_set)
+        if entries is None:
+            return list(islice(entry_iter(severity, sender_set, newest_first, since), hot_offset,
+                               None if hot_limit is None else hot_offset + hot_limit))
+        if since is not None and not newest_first:
+            entries = log_since(entries, since)
+        return slice_window(entries, hot_offset, hot_limit, newest_first)
+
+    with store_lock:
+        if cold_tier is None or len(cold_tier) == 0:
+            return hot_window(offset, limit)
+        return tiered_window(cold_tier, hot_window, entry_count(severity, sender_set), severity, sender_set, offset,
+                             limit, newest_first, since)
+
+
+def body_select(fields: dict, severity: str = None, sender_set: set = None) -> list:
+    """
+    Returns the stored entries matching every given criteria, in id order. Entries are looked up through the indexes
+    of the body paths that have one. Others are matched by reading the bodies of the entries selected by the rest, or
+    by a parallel scan of the entries in scope if no path is indexed
+    :param fields: What the bodies must hold, as {path: value} (see 'body_index')
+    :param severity: Only entries of this severity (case insensitive)
+    :param sender_set: Only entries sent by one of these sender ids
+    """
+    with store_lock:
+        found = {path: body_index.lookup(path, value) for path, value in fields.items()}
+        indexed = sorted((ids for ids in found.values() if ids is not None), key=len)
+        if indexed:
+            others = [set(ids) for ids in indexed[1:]]
+            entries = entries_of([msg_id for msg_id in indexed[0] if all(msg_id in ids for ids in others)])
+    if indexed:
+        if severity is not None:
+            entries = [entry for entry in entries if entry.severity.casefold() == severity.casefold()]
+        if sender_set is not None:
+            entries = [entry for entry in entries if entry.sender_id in sender_set]
+    predicate = scan.Predicate(fields={path: fields[path] for path, ids in found.items() if ids is None})
+    if not indexed:
+        return log_search(predicate, severity, sender_set)["entries"]
+    if predicate.fields:
+        entries = [entry for entry in entries if predicate.test_body(entry.body)]
+    return entries
+
+
+def log_search(predicate, severity: str = None, sender_set: set = None, newest_first: bool = False,
+               limit: int = None, budget: float = None, after: int = None, before: int = None) -> dict:
+    """
+    Scans the stored entries for those matching 'predicate', in parallel (see 'scan'). The entries in scope are taken
+    under the store lock, and scanned after it's released. Cold segments are kept open meanwhile. If the predicate
+    has values on indexed body paths, only the entries found through those indexes are tested instead
+    :param predicate: A 'scan.Predicate'
+    :param severity: Only entries of this severity (case insensitive)
+    :param sender_set: Only entries sent by one of these sender ids
+    :param newest_first: If True, scans from the newest entry backwards
+    :param limit: Stops once this many entries matched. None for all of them
+    :param budget: Seconds the scan may take. None for no limit
+    :param after: Only entries with an id greater than this
+    :param before: Only entries with an id lower than this
+    :return: As 'scan.run'
+    """
+    with store_lock:
+        indexed = any(body_index.lookup(path, value) is not None for path, value in predicate.fields.items())
+    if indexed:
+        start = time.monotonic()
+        deadline = None if budget is None else start + budget
+        found = body_select(predicate.fields, severity, sender_set)
+        entries = []
+        complete = True
+        cursor = None   # The last entry tested
+        for entry in reversed(found) if newest_first else found:
+            if scan.expired(deadline) or (limit is not None and len(entries) > limit):
+                complete = False
+                break
+            if (after is None or entry.msg_id > after) and (before is None or entry.msg_id < before) and \
+                    predicate.test_comment(entry.comment):
+                entries.append(entry)
+            cursor = entry.msg_id
+        if limit is not None and len(entries) > limit:
+            entries = entries[:limit]
+            complete = False
+            cursor = entries[-1].msg_id
+        return {"entries": entries, "complete": complete, "scanned": len(found), "cursor": None if complete else cursor,
+                "elapsed_ms": round((time.monotonic() - start) * 1000, 3)}
+    with store_lock:
+        hot = entry_select(severity, sender_set)[:]    # A copy of the list, or a view of the rows so far
+        cold = cold_tier
+        segments = [segment for segment in cold.segments if segment.count(severity, sender_set) > 0 and
+                    (after is None or segment.last_id > after) and (before is None or segment.first_id < before)] \
+            if cold is not None else []
+    start = 0 if after is None else bisect_right(hot, after, key=attrgetter("msg_id"))
+    end = len(hot) if before is None else bisect_left(hot, before, key=attrgetter("msg_id"))
+    per_chunk = defaults["SCAN"]["CHUNK"]
+    chunks = [scan.ColdChunk(segment, cold.entry_factory, severity, sender_set, after, before) for segment in segments]
+    chunks.extend(scan.HotChunk(hot[i:min(i + per_chunk, end)]) for i in range(start, end, per_chunk))
+    if not segments:
+        return scan.run(chunks, predicate, newest_first, limit, budget)
+    with cold.reading():
+        return scan.run(chunks, predicate, newest_first, limit, budget)
+
+
+def entries_of(ids: list) -> list:
+    """Returns the stored entries with these ids, in id order, on either tier. Must be called under the store lock"""
+    cold_last = cold_tier.last_id() if cold_tier is not None else None
+    entries = []
+    for msg_id in ids:
+        if cold_last is not None and msg_id <= cold_last:
+            entry = cold_tier.entry_of(msg_id)
+        elif isinstance(entry_list, ColumnStore):
+            row = entry_list.columns.row_of(msg_id)
+            entry = None if row is None else entry_list.columns.materialize(row)
+        else:
+            pos = bisect_left(entry_list, msg_id, key=attrgetter("msg_id"))
+            entry = entry_list[pos] if pos < len(entry_list) and entry_list[pos].msg_id == msg_id else None
+        if entry is not None:
+            entries.append(entry)
+    return entries
+
+
+def body_index_declare(path: str, wait: bool = False) -> bool:
+    """
+    Indexes 'path' of the bodies from now on (see 'body_index'). Entries already stored are indexed on a background
+    thread, outside the store lock, and the path is only looked up once they are. Raises 'ValueError' if it's invalid
+    :param wait: If True, returns once they are indexed
+    :return: False if it was indexed already
+    """
+    with store_lock:
+        if body_index.declare(path) is False:
+            return False
+        number = generation
+        entries = entry_list[:]
+        cold = cold_tier
+        segments = list(cold.segments) if cold is not None else []
+    thread = threading.Thread(target=body_index_backfill, args=(path, number, entries, cold, segments),
+                              name="body_index_backfill", daemon=True)
+    thread.start()
+    if wait:
+        thread.join()
+    return True
+
+
+def body_index_backfill(path: str, number: int, entries: list, cold: ColdTier, segments: list):
+    """Indexes 'path' of the entries stored before it was declared (those of generation 'number'), making it usable"""
+    start = time.perf_counter()
+    if segments:
+        with cold.reading():
+            older = body_index.build(path, chain(cold.iterate(segments=segments), entries))
+    else:
+        older = body_index.build(path, entries)
+    with store_lock:
+        if number == generation:    # Otherwise, purged meanwhile. Those entries are gone
+            body_index.backfill(path, older)
+    log_internal(severity="Success", comment=f"Body path '{path}' indexed",
+                 body={"values": len(older), "ms": round((time.perf_counter() - start) * 1000, 3)})
+
+
+def body_index_stats() -> dict:
+    """Returns how many values and entries each indexed body path holds"""
+    with store_lock:
+        return body_index.stats()
+
+
+def alert_set(spec: dict) -> bool:
+    """
+    Sets (or, with '"drop": true', drops) an alert rule (see 'alerts'). Raises 'ValueError' if it's invalid
+    :param spec: The rule, as described in 'alerts.Rule'
+    :return: False if it was dropped, but there was no such rule
+    """
+    with store_lock:
+        if isinstance(spec, dict) and spec.get("drop") is True:
+            done = alerts.drop(spec.get("name"))
+            action = "dropped"
+        else:
+            alerts.declare(spec)
+            done = True
+            action = "set"
+    if done:
+        log_internal(severity="Success", comment=f"Alert rule '{spec['name']}' {action}", body=spec)
+    return done
+
+
+def alert_stats() -> dict:
+    """Returns the rules set and how many times they triggered, or None if alerts are off"""
+    if logger_config["ALERTS"] is False:
+        return None
+    with store_lock:
+        return alerts.stats()
+
+
+def full_count(severity: str = None, sender_set: set = None) -> int:
+    """Same as 'entry_count', plus the past entries of the database (if reachable)"""
+    history = db_entries
+    return entry_count(severity, sender_set) + (history.count(severity, sender_set) if history is not None else 0)
+
+
+def full_window(severity: str = None, sender_set: set = None, offset: int = 0, limit: int = None,
+                newest_first: bool = False) -> list:
+    """
+    Same as 'entry_window', going on into the past entries of the database (if reachable) once past the stored ones.
+    They're all older than the stored entries, so they come last when 'newest_first', and first otherwise
+    """
+    history = db_entries
+    if history is None:
+        return entry_window(severity, sender_set, offset, limit, newest_first)
+
+    def stored_window(stored_offset: int, stored_limit: int = None) -> list:
+        return entry_window(severity, sender_set, stored_offset, stored_limit, newest_first)
+
+    return tiered_window(history, stored_window, full_count(severity, sender_set), severity, sender_set, offset, limit,
+                         newest_first)
+
+
+def tiered_window(cold: ColdTier, hot_window, total: int, severity: str = None, sender_set: set = None,
+                  offset: int = 0, limit: int = None, newest_first: bool = False, since: int = None) -> list:
+    """
+    Joins the windows of both tiers into an 'entry_window'. Every cold entry is older than every hot one, so the
+    window starts on one of them and, if it's not filled there, goes on to the other
+    :param cold: The cold tier, or anything older than every hot entry with the same 'count' and 'window' (as
+    'db_entries')
+    :param hot_window: Returns the window of the hot tier, as 'hot_window(offset, limit)', same criteria and order
+    :param total: How many entries match, on both tiers
+    """
+    if newest_first:
+        hot_total = total - cold.count(severity, sender_set)
+        entries = hot_window(offset, limit) if offset < hot_total else []
+        if limit is None or len(entries) < limit:
+            entries.extend(cold.window(severity, sender_set, max(offset - hot_total, 0),
+                                       None if limit is None else limit - len(entries), newest_first=True))
+        return entries
+    cold_total = cold.count(severity, sender_set, since)
+    entries = cold.window(severity, sender_set, offset, limit, since=since) if offset < cold_total else []
+    if limit is None or len(entries) < limit:
+        entries.extend(hot_window(max(offset - cold_total, 0), None if limit is None else limit - len(entries)))
+    return entries
+
+
+def slice_window(entries, offset: int, limit: int = None, newest_first: bool = False) -> list:
+    """Returns the 'entry_window' of an already selected list (or 'EntryView') of entries, in id order"""
+    if newest_first:
+        end = max(len(entries) - offset, 0)
+        return list(entries[0 if limit is None else max(end - limit, 0):end])[::-1]
+    return list(entries[offset:None if limit is None else offset + limit])
+
+
+def filter_result(severity: str = None, sender_set: set = None):
+    """
+    Returns every entry of the list store matching the criteria, from 'filter_cache' when possible. A cached result is
+    extended with the entries appended since it was made, testing only those. Must be called under the store lock
+    :param severity: Only entries of this severity (case insensitive)
+    :param sender_set: Only entries sent by one of these sender ids
+    :return: A list of entries in id order, shared with the cache, so it must not be modified. None if the criteria
+    are cheap enough to be walked directly (no filter, or a single sender)
+    """
+    if severity is None and (sender_set is None or len(sender_set) == 1):
+        return None
+    severity = None if severity is None else severity.casefold()
+    key = (severity, None if sender_set is None else frozenset(sender_set))
+    cached = filter_cache.get(key, store_gen)
+    if cached is None:
+        cached = {"covered": len(entry_list), "entries": list(entry_iter(severity, sender_set))}
+    elif cached["covered"] < len(entry_list):
+        cached["entries"].extend(entry for entry in (entry_list[i] for i in range(cached["covered"], len(entry_list)))
+                                 if (sender_set is None or entry.sender_id in sender_set) and
+                                 (severity is None or entry.severity.casefold() == severity))
+        cached["covered"] = len(entry_list)
+        metrics.cache_lookups.inc(("log_filter", "extend"))
+    else:
+        return cached["entries"]
+    filter_cache.put(key, store_gen, cached, 8 * len(cached["entries"]) + 200)
+    return cached["entries"]
+
+
+def entry_iter(severity: str = None, sender_set: set = None, newest_first: bool = False, since: int = None,
+               store: tuple = None):
+    """
+    Lazily iterates the entries of the list store matching every given criteria, in id order (or reversed)
+    :param store: The '(entry list, partitions)' to iterate. Defaults to the current generation
+    """
+    store_list, store_parts = (entry_list, partitions) if store is None else store
+
+    def tail(entries: list):
+        start = 0 if since is None else bisect_right(entries, since, key=attrgetter("msg_id"))
+        return (entries[i] for i in range(start, len(entries)))
+
+    if sender_set is not None:
+        parts = [store_parts[sender_id] for sender_id in sender_set if sender_id in store_parts]
+        if newest_first:
+            entries = heapq.merge(*[reversed(part) for part in parts], key=attrgetter("msg_id"), reverse=True)
+        else:
+            entries = heapq.merge(*[tail(part) for part in parts], key=attrgetter("msg_id"))
+    else:
+        entries = reversed(store_list) if newest_first else tail(store_list)
+    if severity is not None:
+        severity = severity.casefold()
+        return (entry for entry in entries if entry.severity.casefold() == severity)
+    return entries
+
+
+def entry_select(severity: str = None, sender_set: set = None):
+    """
+    Selects the stored entries matching every given criteria. Selecting by sender only reads the partitions of those
+    senders, so its cost depends on how many entries they have, not on the whole store
+    :param severity: Only entries of this severity (case insensitive)
+    :param sender_set: Only entries sent by one of these sender ids
+    :return: A list of entries, or an 'EntryView' of them if the store is columnar. Both in id order
+    """
+    if isinstance(entry_list, ColumnStore):
+        with store_lock:
+            return entry_list.select(severity=severity, sender_ids=sender_set)
+    if sender_set is not None:
+        entries = partition_merge(sender_set)
+        if severity is not None:
+            severity = severity.casefold()
+            return [entry for entry in entries if entry.severity.casefold() == severity]
+        return entries
+    if severity is not None:
+        severity = severity.casefold()
+        return [entry for entry in entry_list if entry.severity.casefold() == severity]
+    return entry_list
+
+
+def log_since(entries, since_id: int):
+    """
+    Returns the entries added after 'since_id'. Entries are in id order, so it's a binary search
+    :param entries: Entries in id order, as returned by 'log_get'
+    :param since_id: The last id the caller already has
+    :return: A slice of 'entries'
+    """
+    return entries[bisect_right(entries, since_id, key=attrgetter("msg_id")):]
+
+
+def log_delta(since: int, limit: int, severity: str = None, sender_set: set = None, matched: list = None) -> list:
+    """
+    Returns the entries a '/log/delta' client doesn't have yet. The cursor of an entry is its id, but for replicated
+    entries merged behind newer ones ('log_merge'): theirs is the stamp they were given on arrival, so clients already
+    past their id still get them
+    :param since: The last cursor the client has
+    :param limit: Most entries to return
+    :param severity: Only entries of this severity (case insensitive)
+    :param sender_set: Only entries sent by one of these sender ids
+    :param matched: The entries to take from, in id order, instead of every stored one. Filters don't apply to them
+    :return: '(cursor, entry)' pairs, in cursor order
+    """
+    def selected(entry) -> bool:
+        if matched is not None:
+            pos = bisect_left(matched, entry.msg_id, key=attrgetter("msg_id"))
+            return pos < len(matched) and matched[pos].msg_id == entry.msg_id
+        return (severity is None or entry.severity.casefold() == severity.casefold()) and \
+            (sender_set is None or entry.sender_id in sender_set)
+
+    with store_lock:
+        late = [(stamp, entry) for stamp, entry in late_entries[bisect_right(late_entries, since, key=itemgetter(0)):]
+                if selected(entry)]
+        skipped = sum(1 for msg_id in late_ids if msg_id > since)     # Late entries come with their stamp instead
+        if matched is not None:
+            entries = log_since(matched, since)[:limit + skipped]
         else:
-            return entry_list
+            entries = entry_window(severity, sender_set, limit=limit + skipped, since=since)
+        if late_ids:
+            entries = [entry for entry in entries if entry.msg_id not in late_ids]
+    return list(islice(heapq.merge(((entry.msg_id, entry) for entry in entries), late, key=itemgetter(0)), limit))
+
+
+def partition_merge(sender_set: set) -> list:
+    """
+    Merges the partitions of every sender in 'sender_set' in id order
+    :param sender_set: Sender ids. Unknown ones (or None) are ignored
+    :return: A list of entries. If a single partition matched it's the partition itself, so it must not be modified
+    """
+    with store_lock:
+        parts = [partitions[sender_id] for sender_id in sender_set if sender_id in partitions]
+        if len(parts) == 0:
+            return []
+        if len(parts) == 1:
+            return parts[0]
+        return list(heapq.merge(*parts, key=attrgetter("msg_id")))
+
 
+def registry_swap(new_severities: dict, new_servers: dict):
+    """
+    Adds or replaces a whole batch of severities and servers at once. Each registry is updated in a single step (a
+    'dict.update' with a dict argument never releases the GIL), so readers never see a half loaded registry
+    :param new_severities: Severities to add or replace, as '{name: (color, backcolor)}'
+    :param new_servers: Servers to add or replace, as '{url: (color, backcolor, name)}'
+    """
+    global registry_rev
+    with store_lock:
+        severities.update(new_severities)
+        servers_list.update(new_servers)
+        for url in new_servers:     # Defined now
+            discovered.pop(url, None)
+        registry_rev += 1
+    print_verbose(sender=__name__,
+                  message=f"Registries swapped ({len(new_severities)} severities, {len(new_servers)} servers)")
 
-def log_add(s_from="Unknown", severity="Information", comment="Not Specified", body=None):
+
+def log_add(s_from="Unknown", severity="Information", comment="Not Specified", body=None, internal=False, ip=None):
     """
     Add an entry log onto the server
     :param s_from: Who sent the entry. It's recommended that it's the url or name in the database
     :param severity: How important is this entry, overall. Database may overwrite the defaults
     :param comment: A brief comment about this entry
     :param body: A JSON body, but in reality, any string, or object, can be used here
+    :param internal: True only if the entry was made by the server itself. Use 'log_internal' instead
+    :param ip: The sender's address. If None, it's taken from the current request (if any)
+    :return: The new entry
     """
     global entry_list
-    if s_from not in defaults["INTERNAL"]["SERVER_NAME"] and s_from not in servers_list:
-        ip = flask.request.remote_addr
-        if add_server(s_from, None, None, ip) is True:  # New server, but unknown one
-            log_internal(severity="Warning", comment=f"Server {servers_list[s_from][2]} from '{s_from}' was set",
-                         body={s_from: servers_list[s_from]})
-            print_verbose(sender=__name__,
-                          message=f"Server {servers_list[s_from][2]} from '{s_from}' was set")
-    print_verbose(sender=__name__, message=f"Added entry: '{s_from}' -> ('{severity}', '{comment}', '{body}')")
-    entry_list.append(LogEntry(s_from, severity, comment, body))
+    sender_register(s_from, ip)
+    if logger_config["VERBOSE"] is True:    # Formatting a large body costs more than storing it
+        print_verbose(sender=__name__, message=f"Added entry: '{s_from}' -> ('{severity}', '{comment}', '{body}')")
+    global store_rev
+    with store_lock:
+        store_rev += 1
+        if internal is False and logger_config["ALERTS"] is True:     # Repeats count too, even if coalesced
+            alerts.observe(s_from, severity, comment)
+        if logger_config["COALESCE"] is True:
+            digest = coalesce_digest(s_from, severity, comment, body)
+            last = coalesce_last.get(s_from)
+            if last is not None and last[0] == digest and last[1].severity == severity and \
+                    last[1].comment == comment and \
+                    time.time() - last[1].created <= defaults["COALESCE"]["WINDOW"]:
+                last[1].repeat()
+                if isinstance(entry_list, ColumnStore):
+                    entry_list.repeat(last[1])
+                return last[1]
+        entry = LogEntry(s_from, severity, comment, body, internal)
+        entry_list.append(entry)
+        if not isinstance(entry_list, ColumnStore):
+            partitions.setdefault(entry.sender_id, []).append(entry)
+        entry_counted(entry)
+        body_index.add(entry.msg_id, body)
+        if id_clock is not None and internal is False:
+            local_entries.append(entry)
+        if logger_config["COALESCE"] is True:
+            coalesce_last[s_from] = (digest, entry)
+        spill_check()
+    return entry
+
+
+def sender_register(s_from: str, ip=None):
+    """
+    Registers 's_from' as a discovered server, if it's unknown, or marks it as recently active if it was discovered
+    already. Discovered servers are kept apart from the defined ones, evicting the least recently active past
+    'defaults["REGISTRY"]["MAX_DISCOVERED"]', and are announced together, at most once every 'NOTICE_INTERVAL'
+    :param s_from: Who sent the entry
+    :param ip: The sender's address. If None, it's taken from the current request (if any)
+    """
+    global notice_timer, discovered_evicted
+    if s_from in defaults["INTERNAL"]["SERVER_NAME"] or s_from in servers_list:
+        return
+    with store_lock:
+        if s_from in discovered:
+            discovered.move_to_end(s_from)
+            return
+        if ip is None:
+            ip = flask.request.remote_addr if flask.has_request_context() else "Unknown"
+        discovered[s_from] = (None, None, ip)
+        while len(discovered) > defaults["REGISTRY"]["MAX_DISCOVERED"]:
+            discovered.popitem(last=False)
+            discovered_evicted += 1
+        discovered_pending.append((s_from, ip))
+        if notice_timer is not None:    # A notice is due already
+            return
+        wait = 0 if last_notice is None else last_notice + defaults["REGISTRY"]["NOTICE_INTERVAL"] - time.monotonic()
+        if wait > 0:
+            notice_timer = threading.Timer(wait, discovery_notice)
+            notice_timer.daemon = True
+            notice_timer.start()
+            return
+    discovery_notice()
+
+
+def discovery_notice():
+    """Logs the servers discovered since the last notice as a single internal entry"""
+    global notice_timer, last_notice, discovered_evicted
+    with store_lock:
+        pending = discovered_pending[:]
+        discovered_pending.clear()
+        evicted, discovered_evicted = discovered_evicted, 0
+        notice_timer = None
+        last_notice = time.monotonic()
+    if len(pending) == 1:
+        s_from, ip = pending[0]
+        log_internal(severity="Warning", comment=f"Server {ip} from '{s_from}' was set",
+                     body={s_from: (None, None, ip)})
+        print_verbose(sender=__name__, message=f"Server {ip} from '{s_from}' was set")
+    elif len(pending) > 1:
+        shown = pending[:defaults["REGISTRY"]["NOTICE_MAX"]]
+        log_internal(severity="Warning", comment=f"{len(pending)} new servers were set",
+                     body={"servers": {s_from: (None, None, ip) for s_from, ip in shown},
+                           "not_shown": len(pending) - len(shown), "evicted": evicted})
+        print_verbose(sender=__name__, message=f"{len(pending)} new servers were set ({evicted} evicted)")
+
+
+def server_info(url: str):
+    """Returns the '(color, backcolor, name)' of a defined or discovered server, or None if it's unknown"""
+    info = servers_list.get(url)
+    return info if info is not None else discovered.get(url)
+
+
+def registry_stats() -> dict:
+    """Returns how many servers are defined and discovered, and how many discoveries are yet to be announced"""
+    with store_lock:
+        return {"defined": len(servers_list), "discovered": len(discovered),
+                "max_discovered": defaults["REGISTRY"]["MAX_DISCOVERED"], "pending_notice": len(discovered_pending)}
+
+
+def page_servers() -> dict:
+    """
+    Returns the servers offered as filters on pages: every defined one, and only the most recently active of the
+    discovered ones ('defaults["REGISTRY"]["PAGE_DISCOVERED"]'), so pages don't grow with them
+    """
+    servers = dict(servers_list)
+    with store_lock:
+        for s_from in islice(reversed(discovered), defaults["REGISTRY"]["PAGE_DISCOVERED"]):
+            servers.setdefault(s_from, discovered[s_from])
+    return servers
+
+
+def log_merge(records: list) -> int:
+    """
+    Inserts entries replicated from other nodes, in id order. Entries already stored are skipped
+    :param records: A list of dicts, as made by 'LogEntry.record'
+    :return: How many entries were inserted
+    """
+    global store_rev, store_gen
+    inserted = 0
+    with store_lock:
+        for record in records:
+            msg_id = record["id"]
+            if id_clock is not None:
+                id_clock.observe(msg_id)
+            sender_register(record["from"], record.get("ip") or "Unknown")     # May add an internal entry
+            pos = bisect_right(entry_list, msg_id, key=attrgetter("msg_id"))
+            if pos > 0 and entry_list[pos - 1].msg_id == msg_id:
+                continue
+            sender_id = sender_intern(record["from"])
+            entry = LogEntry.restore(msg_id, record["created"], record["severity"], sender_id, False,
+                                     record.get("repeats", 1), record["comment"], blob_store.offload(record["body"]),
+                                     nickname(record["from"]), record.get("last_seen"))
+            if pos < len(entry_list):   # Not at the tail: cached filter results can't just be extended
+                store_gen += 1
+            mark = late_mark()
+            if mark is not None and msg_id <= mark:     # Delta clients may be past its id already
+                late_add(entry, mark)
+            entry_list.insert(pos, entry)
+            partition = partitions.setdefault(sender_id, [])
+            partition.insert(bisect_right(partition, msg_id, key=attrgetter("msg_id")), entry)
+            entry_counted(entry)
+            body_index.add(msg_id, record["body"])
+            inserted += 1
+        if inserted > 0:
+            store_rev += 1
+    return inserted
+
+
+def late_mark():
+    """Returns the highest delta cursor handed out so far: the newest stored id, or the newest stamp. Or None"""
+    newest = entry_list[-1].msg_id if len(entry_list) > 0 else (cold_tier.last_id() if cold_tier is not None else None)
+    marks = [mark for mark in (newest, late_entries[-1][0] if late_entries else None) if mark is not None]
+    return max(marks) if marks else None
+
+
+def late_add(entry, mark: int):
+    """
+    Stamps a replicated entry merged behind 'mark' with a cursor greater than every one handed out, so '/log/delta'
+    sends it again. Only the last 'defaults["REPLICATION"]["LATE_MAX"]' are kept
+    """
+    stamp = mark + 1 if id_clock is None else max(id_clock.now(), mark + 1)
+    late_entries.append((stamp, entry))
+    late_ids[entry.msg_id] = stamp
+    excess = len(late_entries) - defaults["REPLICATION"]["LATE_MAX"]
+    if excess > 0:
+        for _, old in late_entries[:excess]:
+            del late_ids[old.msg_id]
+        del late_entries[:excess]
+
+
+def log_restore(records: list, local_ids: set, next_global_id: int):
+    """
+    Refills the store from a snapshot. Partitions (and the columns, if columnar) are rebuilt as entries are added
+    :param records: '(msg_id, created, s_from, severity, comment, body, is_internal, repeats, last_seen)' tuples, in
+    id order
+    :param local_ids: Ids of the entries taken by this node, if replicating
+    :param next_global_id: The sequential id counter, as it was when the snapshot was taken
+    """
+    global global_id, store_rev, store_gen
+    senders = {}    # {s_from: (sender id, nickname)}. Resolved once per sender
+    with store_lock:
+        for msg_id, created, s_from, severity, comment, body, is_internal, repeats, last_seen in records:
+            sender = senders.get(s_from)
+            if sender is None:
+                sender = senders[s_from] = (sender_intern(s_from), nickname(s_from))
+            sender_id = sender[0]
+            entry = LogEntry.restore(msg_id, created, severity, sender_id, is_internal, repeats, comment,
+                                     blob_store.offload(body), sender[1], last_seen)
+            entry_list.append(entry)
+            if not isinstance(entry_list, ColumnStore):
+                partitions.setdefault(sender_id, []).append(entry)
+            entry_counted(entry)
+            body_index.add(msg_id, body)
+            if msg_id in local_ids:
+                local_entries.append(entry)
+            if id_clock is not None:
+                id_clock.observe(msg_id)
+        global_id = max(global_id, next_global_id)
+        store_rev += 1
+        store_gen += 1
+        spill_check()
+
+
+def log_add_batch(entries: list) -> int:
+    """
+    Adds many entries at once, taking the store lock a single time
+    :param entries: A list of '(s_from, severity, comment, body, ip)' tuples
+    :return: How many entries were added
+    """
+    with store_lock:
+        for s_from, severity, comment, body, ip in entries:
+            log_add(s_from=s_from, severity=severity, comment=comment, body=body, ip=ip)
+    return len(entries)
+
+
+def coalesce_digest(s_from: str, severity: str, comment: str, body) -> int:
+    """
+    Hashes what makes two entries identical for coalescing purposes. The body is only considered if
+    'defaults["COALESCE"]["BODY"]' is True
+    :return: The digest of the entry
+    """
+    if defaults["COALESCE"]["BODY"] is True:
+        try:
+            body_key = json.dumps(body, sort_keys=True, default=str)
+        except (TypeError, ValueError):
+            body_key = str(body)
+        return hash((s_from, severity, comment, body_key))
+    return hash((s_from, severity, comment))
 
 
 def log_internal(severity="Information", comment="Not Specified", body=None):
@@ -97,8 +1136,8 @@ def log_internal(severity="Information", comment="Not Specified", body=None):
     :param comment: A brief comment about this entry
     :param body: A JSON body, but in reality, any string, or object, can be used here
     """
-    log_add(s_from=defaults["INTERNAL"]["SERVER_NAME"], severity=severity, comment=comment, body=body)
-    entry_list[-1].is_internal = True
+    return log_add(s_from=defaults["INTERNAL"]["SERVER_NAME"], severity=severity, comment=comment, body=body,
+                   internal=True)
 
 
 def log_internal_echo(severity="Information", comment="Not Specified", body=None, sender=__name__):
@@ -141,11 +1180,12 @@ def add_severity(severity_name: str, color, backcolor, allow_replace=False, log_
     (Will still produce verbose if enabled)
     :returns: True if the severity was added (new) and False if it didn't
     """
-    global severities
+    global severities, registry_rev
     try:
         if severity_name is not None:
             if severity_name.lower() not in severities or allow_replace is True:
                 severities[severity_name] = (color, backcolor)
+                registry_rev += 1
                 msg = f"Added new severity class"
                 if allow_replace:
                     msg = f"Set severity class"
@@ -189,11 +1229,13 @@ def add_server(url: str, color, backcolor, name: str, allow_replace=False, log_s
     (Will still produce verbose if enabled)
     :returns: True if the server was added (new) and False if it didn't
     """
-    global servers_list
+    global servers_list, registry_rev
     try:
         if url is not None:
             if url not in servers_list or allow_replace:  # New server, but unknown one. Add it temporarily
                 servers_list[url] = (color, backcolor, name)
+                discovered.pop(url, None)
+                registry_rev += 1
                 change_type = "Added new"
                 if allow_replace:
                     change_type = "Set"
@@ -224,18 +1266,119 @@ def add_server(url: str, color, backcolor, name: str, allow_replace=False, log_s
         return False
 
 
+class Generation:
+    """A purged generation of the store. Nothing is added to it anymore, so it's read without the store lock"""
+    def __init__(self, number: int, entries, parts: dict, counts: tuple, cold: ColdTier = None):
+        self.number = number
+        self.entries = entries      # The entry list, or 'ColumnStore'. Only the hot entries, if tiered
+        self.partitions = parts     # Empty on the columnar store, which keeps its own
+        self.counts = counts        # '(severity_counts, sender_counts, pair_counts)' as they were when purged
+        self.cold = cold            # The spilled entries, if tiered
+        self.purged = time.time()
+        self.readers = 0            # Exports in progress. It isn't freed until they finish
+
+    def length(self) -> int:
+        return len(self.entries) + (len(self.cold) if self.cold is not None else 0)
+
+    def info(self) -> dict:
+        first_id = self.cold.first_id() if self.cold is not None else None
+        if first_id is None and len(self.entries) > 0:
+            first_id = self.entries[0].msg_id
+        last_id = self.entries[-1].msg_id if len(self.entries) > 0 else None
+        if last_id is None and self.cold is not None:
+            last_id = self.cold.last_id()
+        return {"generation": self.number, "purged": self.purged, "entries": self.length(), "first_id": first_id,
+                "last_id": last_id}
+
+    def count(self, severity: str = None, sender_set: set = None) -> int:
+        """Same as 'entry_count', on this generation"""
+        return counted(self.counts, severity, sender_set, self.length())
+
+    def window(self, severity: str = None, sender_set: set = None, offset: int = 0, limit: int = None,
+               newest_first: bool = False) -> list:
+        """Same as 'entry_window', on this generation"""
+        if isinstance(self.entries, ColumnStore):
+            return slice_window(self.entries.select(severity=severity, sender_ids=sender_set), offset, limit,
+                                newest_first)
+
+        def hot_window(hot_offset: int, hot_limit: int = None) -> list:
+            return list(islice(entry_iter(severity, sender_set, newest_first, store=(self.entries, self.partitions)),
+                               hot_offset, None if hot_limit is None else hot_offset + hot_limit))
+
+        if self.cold is None or len(self.cold) == 0:
+            return hot_window(offset, limit)
+        return tiered_window(self.cold, hot_window, self.count(severity, sender_set), severity, sender_set, offset,
+                             limit, newest_first)
+
+    def export(self, severity: str = None, sender_set: set = None):
+        """
+        Iterates 'record()' of every entry matching the criteria, in id order. Keeps the generation from being freed
+        until it's done (or closed)
+        """
+        with store_lock:
+            self.readers += 1
+        try:
+            if isinstance(self.entries, ColumnStore):
+                entries = self.entries.select(severity=severity, sender_ids=sender_set)
+            else:
+                entries = entry_iter(severity, sender_set, store=(self.entries, self.partitions))
+                if self.cold is not None:
+                    entries = chain(self.cold.iterate(severity, sender_set), entries)
+            for entry in entries:
+                yield entry.record()
+        finally:
+            with store_lock:
+                self.readers -= 1
+
+
 class LogEntry:
-    def __init__(self, s_from="Unknown", severity="Information", comm="Not Specified", body=None):
-        global global_id
-        self.msg_id = global_id
+    def __init__(self, s_from="Unknown", severity="Information", comm="Not Specified", body=None, is_internal=False):
+        self.msg_id = next_id()
         self.log_from = s_from
+        self.sender_id = sender_intern(s_from)
         self.nickname = nickname(s_from)
         self.severity = severity
         self.comment = comm
-        self.timestamp = datetime.now().strftime("%H:%M:%S.%f - %d/%m/%Y")
-        self.body = body
-        self.is_internal = False    # Only true if the entry was sent BY THE SERVER. Don't manually change this
-        global_id += 1
+        self.created = time.time()
+        self.timestamp = datetime.fromtimestamp(self.created).strftime("%H:%M:%S.%f - %d/%m/%Y")
+        self.body = blob_store.offload(body)    # A 'blob_store.Blob' if it's large. Read it through 'resolve'
+        self.is_internal = is_internal  # Only true if the entry was sent BY THE SERVER. Don't manually change this
+        self.repeats = 1            # How many times this entry was received. Only grows if 'COALESCE' is True
+        self.last_seen = None       # Timestamp of the latest repeat, if any
+
+    @classmethod
+    def restore(cls, msg_id, created, severity, sender_id, is_internal, repeats, comment, body, nick, last_seen):
+        """
+        Rebuilds an entry that was already stored, keeping its id. Used by stores that don't keep the objects. 'body'
+        is taken as it was stored, so it's not offloaded again
+        """
+        entry = cls.__new__(cls)
+        entry.msg_id = msg_id
+        entry.log_from = sender_names[sender_id]
+        entry.sender_id = sender_id
+        entry.nickname = nick
+        entry.severity = severity
+        entry.comment = comment
+        entry.created = created     # None if unknown, as for the past entries of the database
+        entry.timestamp = "Unknown" if created is None else datetime.fromtimestamp(created).strftime(
+            "%H:%M:%S.%f - %d/%m/%Y")
+        entry.body = body
+        entry.is_internal = is_internal
+        entry.repeats = repeats
+        entry.last_seen = last_seen
+        return entry
+
+    def record(self) -> dict:
+        """Returns the entry as sent to other nodes. Unlike 'json', it keeps the sender and creation time as they are"""
+        return {"id": self.msg_id, "from": self.log_from, "severity": self.severity, "comment": self.comment,
+                "body": blob_store.resolve(self.body), "created": self.created, "repeats": self.repeats,
+                "last_seen": self.last_seen,
+                "ip": server_info(self.log_from)[2] if server_info(self.log_from) is not None else None}
+
+    def repeat(self):
+        """Marks this entry as received once more, instead of storing an identical copy"""
+        self.repeats += 1
+        self.last_seen = datetime.now().strftime("%H:%M:%S.%f - %d/%m/%Y")
 
     # Returns the whole entry as a JSON object to be used when rendering the page
     def json(self):
@@ -246,7 +1389,9 @@ class LogEntry:
             "severity": self.severity,
             "comment": self.comment,
             "timestamp": self.timestamp,
-            "body": self.body,
+            "body": blob_store.resolve(self.body),
+            "repeats": self.repeats,
+            "last_seen": self.last_seen,
             # Cosmetic hints
             "flavor": {"severity": severity_flavor_keys(self.severity),
                        "user_shade": user_shade_flavor_keys(self.log_from) if
@@ -286,8 +1431,8 @@ def user_shade_flavor_keys(user_shade: str):
     """
     flavor = ""
     try:
-        if user_shade in servers_list:
-            colors = servers_list[user_shade]
+        colors = server_info(user_shade)
+        if colors is not None:
             if colors[0] is not None:
                 flavor += f"color:{colors[0]};"
             if colors[1] is not None:
@@ -306,8 +1451,9 @@ def nickname(url: str):
     :return: '( {Nickname / User's name} )'
     """
     try:
-        if url in servers_list:
-            return " (" + servers_list[url][2] + ")"
+        info = server_info(url)
+        if info is not None:
+            return " (" + info[2] + ")"
     except KeyError:
         log_internal(severity="Error", comment="Known server list's 'url' key is missing!")
     except Exception as exc:
@@ -0,0 +1,70 @@
+"""Hybrid logical clock ids, used as entry ids when replication is on. Each id packs, from the highest bits down:
+  - 41 bits: wall clock, in milliseconds since 'EPOCH_MS' (enough until 2089)
+  - 14 bits: a counter, ordering ids taken on the same millisecond (or while the wall clock lags behind)
+  -  8 bits: the node that took it
+Ids are plain integers, so they sort like the existing sequential ones. Every node orders the same set of ids the same
+way, and a node that has seen an id only takes greater ones from then on
+"""
+import threading
+import time
+
+EPOCH_MS = 1577836800000    # 2020-01-01 00:00:00 UTC
+COUNTER_BITS = 14
+NODE_BITS = 8
+MAX_NODES = 1 << NODE_BITS
+MAX_DRIFT_MS = 60000        # Remote clocks further ahead than this aren't followed (their ids are still accepted)
+
+
+def wall_ms() -> int:
+    return time.time_ns() // 1000000 - EPOCH_MS
+
+
+def pack(wall: int, counter: int, node: int) -> int:
+    return (wall << (COUNTER_BITS + NODE_BITS)) | (counter << NODE_BITS) | node
+
+
+def unpack(hlc_id: int) -> tuple:
+    """Splits an id into its '(wall ms, counter, node)'"""
+    return hlc_id >> (COUNTER_BITS + NODE_BITS), (hlc_id >> NODE_BITS) & ((1 << COUNTER_BITS) - 1), \
+        hlc_id & (MAX_NODES - 1)
+
+
+def id_node(hlc_id: int) -> int:
+    """Returns the node that took 'hlc_id'"""
+    return hlc_id & (MAX_NODES - 1)
+
+
+def id_time(hlc_id: int) -> float:
+    """Returns the wall clock time of 'hlc_id', as a Unix timestamp"""
+    return ((hlc_id >> (COUNTER_BITS + NODE_BITS)) + EPOCH_MS) / 1000
+
+
+class HybridClock:
+    def __init__(self, node: int):
+        if not 0 <= node < MAX_NODES:
+            raise ValueError(f"Node ids must be between 0 and {MAX_NODES - 1}, not {node}")
+        self.node = node
+        self.wall = 0
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def now(self) -> int:
+        """Takes a new id, greater than every id taken or observed so far"""
+        with self.lock:
+            physical = wall_ms()
+            if physical > self.wall:
+                self.wall, self.counter = physical, 0
+            else:
+                self.counter += 1
+                if self.counter >> COUNTER_BITS:     # Counter overflow. Borrow the next millisecond
+                    self.wall, self.counter = self.wall + 1, 0
+            return pack(self.wall, self.counter, self.node)
+
+    def observe(self, hlc_id: int):
+        """Moves the clock past an id taken by another node"""
+        wall, counter, _ = unpack(hlc_id)
+        with self.lock:
+            if wall - wall_ms() > MAX_DRIFT_MS:
+                return
+            if (wall, counter) > (self.wall, self.counter):
+                self.wall, self.counter = wall, counter
@@ -0,0 +1,152 @@
+"""Low overhead instrumentation of the server. Timings are recorded into fixed-bucket histograms and counters and are
+exposed in the Prometheus text exposition format through '/server/metrics'.
+When 'logger_config["METRICS"]' is False every hook returns right away, without touching the clock or any lock
+"""
+import time
+import threading
+from functools import wraps
+
+import flask
+
+from server_config import logger_config
+
+# Upper bounds (in seconds) of each histogram bucket. '+Inf' is always implied
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_PREFIX = "logserver"
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, label_names: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = f"{METRIC_PREFIX}_{name}"
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}    # {label values: [bucket counts..., +Inf count, sum]}
+        self.lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        """
+        Records a single observation
+        :param labels: The label values, in the same order as 'label_names'
+        :param value: The observed value (seconds, for latencies)
+        """
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[-2] += 1
+            series[-1] += value
+
+    def exposition(self) -> list:
+        """Returns this histogram's lines in the text exposition format"""
+        out = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            snapshot = {labels: list(series) for labels, series in self.series.items()}
+        for labels, series in sorted(snapshot.items()):
+            base = format_labels(self.label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                out.append(f"{self.name}_bucket{{{base}{',' if base else ''}le=\"{bound}\"}} {cumulative}")
+            out.append(f"{self.name}_sum{{{base}}} {series[-1]}")
+            out.append(f"{self.name}_count{{{base}}} {cumulative}")
+        return out
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: tuple):
+        self.name = f"{METRIC_PREFIX}_{name}"
+        self.description = description
+        self.label_names = label_names
+        self.series = {}    # {label values: count}
+        self.lock = threading.Lock()
+
+    def inc(self, labels: tuple, amount: int = 1):
+        """Increments the counter of 'labels' by 'amount'"""
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def exposition(self) -> list:
+        """Returns this counter's lines in the text exposition format"""
+        out = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            snapshot = dict(self.series)
+        for labels, count in sorted(snapshot.items()):
+            out.append(f"{self.name}{{{format_labels(self.label_names, labels)}}} {count}")
+        return out
+
+
+request_latency = Histogram("request_duration_seconds", "Time spent serving each request, by route",
+                            ("method", "route"))
+request_count = Counter("requests_total", "Requests served, by route and status code", ("method", "route", "code"))
+stage_latency = Histogram("stage_duration_seconds", "Time spent on each internal stage", ("stage",))
+cache_lookups = Counter("cache_lookups_total", "Cache lookups, by cache and result (hit / miss)", ("cache", "result"))
+registry = [request_latency, request_count, stage_latency, cache_lookups]     # Everything exposed on '/server/metrics'
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    """Formats label pairs as 'name="value",...', escaping values as the exposition format requires"""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return ",".join(pairs)
+
+
+def timed(stage: str):
+    """
+    Decorator that records the duration of every call of the decorated function on 'stage_latency'
+    :param stage: The stage name, used as the 'stage' label
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if logger_config["METRICS"] is False:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stage_latency.observe((stage,), time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def init_app(app: flask.Flask):
+    """Hooks the request lifecycle of 'app', timing and counting every request"""
+    @app.before_request
+    def metrics_request_start():
+        if logger_config["METRICS"] is True:
+            flask.g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def metrics_request_end(response):
+        start = flask.g.pop("metrics_start", None)
+        if start is not None:
+            rule = flask.request.url_rule
+            route = rule.rule if rule is not None else "unmatched"
+            method = flask.request.method
+            request_latency.observe((method, route), time.perf_counter() - start)
+            request_count.inc((method, route, str(response.status_code)))
+        return response
+
+
+def exposition(gauges: dict = None) -> str:
+    """
+    Renders every registered metric in the text exposition format
+    :param gauges: Optional '{name: (description, value)}' of point-in-time values to append
+    :return: The full exposition text
+    """
+    out = []
+    for metric in registry:
+        out.extend(metric.exposition())
+    for name, (description, value) in (gauges or {}).items():
+        out.append(f"# HELP {METRIC_PREFIX}_{name} {description}")
+        out.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+        out.append(f"{METRIC_PREFIX}_{name} {value}")
+    return "\n".join(out) + "\n"
@@ -1,14 +1,23 @@
+import argparse
+import json
+import os
 import sqlalchemy
+import threading
+import time
+from collections import OrderedDict
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
+from sqlalchemy import func, text
 from typing import Tuple
 
-from entry_manager import add_server, add_severity, log_internal, log_uncaught_exception, log_internal_echo, \
-                          lists_count, servers_list, severities
+from cache_lru import ByteBudgetLRU
+from entry_manager import log_internal, log_uncaught_exception, log_internal_echo, lists_count, registry_swap, \
+                          servers_list, severities, history_set, sender_intern, nickname, LogEntry
+from metrics import timed
 from server_config import defaults, logger_config, print_verbose
 
 db = SQLAlchemy()
+db_ready = threading.Event()    # Set once the registries were loaded from the database (or it failed to)
 
 
 # Models ---------------------------------------------------------------------------------------------------------------
@@ -20,6 +29,7 @@ class Severity(db.Model):
 
 
 class Entry(db.Model):
+    __tablename__ = "entries"
     id = db.Column(db.Integer, primary_key=True)
     id_user = db.Column(db.Integer)
     severity = db.Column(db.String)
@@ -27,6 +37,12 @@ class Entry(db.Model):
     details = db.Column(db.String)
 
 
+# Keyset lookups of 'DbHistory' filtered by sender or severity. Created by 'python models.py --create-indexes', as
+# building them locks the table for writes (except on PostgreSQL, where they're built concurrently)
+db.Index("ix_entries_user_id", Entry.id_user, Entry.id, postgresql_concurrently=True)
+db.Index("ix_entries_severity_id", func.lower(Entry.severity), Entry.id, postgresql_concurrently=True)
+
+
 class Users(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, unique=True)
@@ -53,20 +69,248 @@ class Users(UserMixin, db.Model):
         return self.id, self.name, self.url, self.forecolor, self.backcolor
 
 
+# History --------------------------------------------------------------------------------------------------------------
+class DbHistory:
+    """
+    Past entries of the 'entries' table, read 'defaults["HISTORY"]["CHUNK"]' rows at a time and never all at once.
+    Chunks are reached with keyset queries on 'id' (the rows after, or before, a known id), never with an offset over
+    the table: the id bounding each chunk is kept per filter once found, so a page is one indexed query away when its
+    chunk was reached before, and a walk of id-only hops from the nearest known one otherwise. Chunks are counted from
+    whichever end of the table is closer, and the latest ones read are cached. It answers 'count' and 'window' as
+    'cold_store.ColdTier' does, so the store falls through to it ('entry_manager.full_window'). Past entries are older
+    than every stored one, and take negative ids, so they never collide with them (nor with their cached renders)
+    """
+    def __init__(self, user_urls: dict):
+        """
+        :param user_urls: The url of each user, as {user id: url}, to resolve 'id_user'
+        """
+        self.user_urls = user_urls
+        self.user_senders = {user: sender_intern(url) for user, url in user_urls.items()}
+        self.table = None           # '(rows, highest id)' of the table, as last checked
+        self.checked = None         # 'time.monotonic()' of the last check
+        self.revision = 0           # Bumped whenever the table changed. Drops every count, bound and chunk known
+        self.counts = OrderedDict()     # Rows per filter, as {scope: rows}
+        self.bounds = OrderedDict()     # Ids bounding each chunk, as {(scope, descending): [None, id, id...]}
+        self.chunks = ByteBudgetLRU("db_history", defaults["HISTORY"]["CACHE_BYTES"])  # {(scope, desc, n): [rows]}
+        self.queries = 0
+        self.lock = threading.Lock()
+
+    def scope(self, severity: str = None, sender_set: set = None) -> tuple:
+        """Translates the store criteria into the table's: '(casefolded severity, user ids)'. None isn't filtered"""
+        users = None
+        if sender_set is not None:
+            users = frozenset(user for user, sender_id in self.user_senders.items() if sender_id in sender_set)
+        return None if severity is None else severity.casefold(), users
+
+    def query(self, scope: tuple, *columns):
+        """Returns a query of 'columns' over the rows within 'scope'"""
+        severity, users = scope
+        rows = db.session.query(*columns)
+        if severity is not None:
+            rows = rows.filter(func.lower(Entry.severity) == severity)
+        if users is not None:
+            rows = rows.filter(Entry.id_user.in_(users))
+        self.queries += 1
+        return rows
+
+    def check(self):
+        """Forgets everything known of the table if it changed. Checked once every 'CHECK_INTERVAL' seconds at most"""
+        if self.checked is not None and time.monotonic() - self.checked < defaults["HISTORY"]["CHECK_INTERVAL"]:
+            return
+        self.queries += 1
+        table = tuple(db.session.query(func.count(Entry.id), func.max(Entry.id)).one())
+        with self.lock:
+            self.checked = time.monotonic()
+            if table != self.table:
+                self.table = table
+                self.revision += 1
+                self.counts.clear()
+                self.bounds.clear()
+
+    def count(self, severity: str = None, sender_set: set = None, since: int = None) -> int:
+        """
+        Counts the past entries matching every given criteria
+        :param since: Only entries with an id greater than this. Past entries are older than any, so none is
+        """
+        scope = self.scope(severity, sender_set)
+        if since is not None or scope[1] == frozenset():
+            return 0
+        self.check()
+        rows = self.counts.get(scope)
+        if rows is None:
+            rows = self.query(scope, func.count(Entry.id)).scalar()
+            with self.lock:
+                self.counts[scope] = rows
+                while len(self.counts) > defaults["HISTORY"]["MAX_SCOPES"]:
+                    self.counts.popitem(last=False)
+        return rows
+
+    def bound(self, scope: tuple, descending: bool, chunk: int):
+        """
+        Returns the id bounding (exclusively) the start of 'chunk', walking from the nearest bound known. Each hop reads
+        only ids, from the index, up to the next chunk
+        :return: The id, None for the first chunk, or False if the table ends before 'chunk'
+        """
+        key = (scope, descending)
+        with self.lock:
+            bounds = self.bounds.get(key)
+            if bounds is None:
+                bounds = self.bounds[key] = [None]
+                while len(self.bounds) > defaults["HISTORY"]["MAX_SCOPES"]:
+                    self.bounds.popitem(last=False)
+            self.bounds.move_to_end(key)
+        while len(bounds) <= chunk:
+            known = len(bounds)
+            found = self.after(self.query(scope, Entry.id), bounds[-1], descending) \
+                .offset(defaults["HISTORY"]["CHUNK"] - 1).limit(1).scalar()
+            if found is None:
+                return False
+            with self.lock:
+                if len(bounds) == known:    # Unless another request found it meanwhile
+                    bounds.append(found)
+        return bounds[chunk]
+
+    @staticmethod
+    def after(rows, bound, descending: bool):
+        """Orders 'rows' by id, from the one right after 'bound' (in that order) on"""
+        if descending:
+            rows = rows if bound is None else rows.filter(Entry.id < bound)
+            return rows.order_by(Entry.id.desc())
+        rows = rows if bound is None else rows.filter(Entry.id > bound)
+        return rows.order_by(Entry.id)
+
+    def chunk(self, scope: tuple, descending: bool, chunk: int) -> list:
+        """Returns the rows of 'chunk', counted from the oldest row, or from the newest if 'descending'"""
+        revision = self.revision
+        key = (scope, descending, chunk)
+        rows = self.chunks.get(key, revision)
+        if rows is not None:
+            return rows
+        bound = self.bound(scope, descending, chunk)
+        if bound is False:
+            return []
+        rows = [tuple(row) for row in self.after(self.query(scope, Entry.id, Entry.id_user, Entry.severity, Entry.comm,
+                                                            Entry.details), bound, descending)
+                .limit(defaults["HISTORY"]["CHUNK"])]
+        size = sum(defaults["HISTORY"]["ROW_OVERHEAD"] + len(row[3] or "") + len(row[4] or "") for row in rows)
+        self.chunks.put(key, revision, rows, size)
+        if len(rows) == defaults["HISTORY"]["CHUNK"]:
+            with self.lock:
+                bounds = self.bounds.get((scope, descending))
+                if bounds is not None and len(bounds) == chunk + 1:   # The next chunk starts right after this one
+                    bounds.append(rows[-1][0])
+        return rows
+
+    def window(self, severity: str = None, sender_set: set = None, offset: int = 0, limit: int = None,
+               newest_first: bool = False, since: int = None) -> list:
+        """Same as 'entry_manager.entry_window', on the past entries. Only the chunks holding the window are read"""
+        total = self.count(severity, sender_set, since)
+        if newest_first:
+            end = total - offset
+            start = 0 if limit is None else max(end - limit, 0)
+        else:
+            start = offset
+            end = total if limit is None else min(offset + limit, total)
+        if start >= end:
+            return []
+        scope = self.scope(severity, sender_set)
+        per_chunk = defaults["HISTORY"]["CHUNK"]
+        descending = total - end < start    # Closer to the newest row
+        first, last = (total - end, total - start) if descending else (start, end)
+        rows = []
+        for chunk in range(first // per_chunk, (last - 1) // per_chunk + 1):
+            rows.extend(self.chunk(scope, descending, chunk))
+        skip = first - first // per_chunk * per_chunk
+        rows = rows[skip:skip + last - first]
+        if descending != newest_first:
+            rows.reverse()
+        return [self.entry(row) for row in rows]
+
+    def entry(self, row: tuple):
+        """Builds an entry out of a row. Its body is decoded if it's JSON"""
+        msg_id, user, severity, comment, details = row
+        url = self.user_urls.get(user, "Unknown")
+        try:
+            body = json.loads(details) if details is not None else None
+        except ValueError:
+            body = details
+        return LogEntry.restore(-msg_id, None, severity or "Unknown", sender_intern(url), False, 1, comment, body,
+                                nickname(url), None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            bounds = sum(len(known) - 1 for known in self.bounds.values())
+        return {"rows": None if self.table is None else self.table[0], "revision": self.revision,
+                "scopes": len(self.counts), "bounds": bounds, "queries": self.queries, "cache": self.chunks.stats()}
+
+
+def history_indexes(engine) -> list:
+    """
+    Creates the indexes of the keyset lookups that are missing. Not run by the server: building them on a large table
+    takes a while, and blocks its writes (except on PostgreSQL)
+    :param engine: An engine of the database, in autocommit mode ('CREATE INDEX CONCURRENTLY' can't be in a transaction)
+    :return: The names of the indexes created
+    """
+    missing = missing_indexes(engine)
+    with engine.connect() as connection:
+        for index in Entry.__table__.indexes:
+            if index.name in missing:
+                connection.execute(sqlalchemy.schema.CreateIndex(index, if_not_exists=True))
+    return missing
+
+
+def missing_indexes(engine) -> list:
+    """Returns the names of the indexes of the keyset lookups the table doesn't have"""
+    if engine.dialect.name == "sqlite":     # Its expression indexes can't be reflected
+        with engine.connect() as connection:
+            existing = set(connection.scalars(text("SELECT name FROM sqlite_master WHERE type = 'index'")))
+    else:
+        existing = {index["name"] for index in sqlalchemy.inspect(engine).get_indexes(Entry.__tablename__)}
+    return [index.name for index in Entry.__table__.indexes if index.name not in existing]
+
+
+def history_init(user_urls: dict):
+    """
+    Makes the past entries of the database reachable from pages, once it's known the table can be read. Missing
+    indexes (see 'history_indexes') are only reported, as lookups still work without them, only slower
+    :param user_urls: The url of each user, as {user id: url}
+    """
+    try:
+        missing = missing_indexes(db.engine)
+    except sqlalchemy.exc.SQLAlchemyError:
+        missing = []    # The table itself is checked below
+    if missing:
+        log_internal_echo(severity="Attention", sender=__name__,
+                          comment=f"Indexes {', '.join(missing)} of '{Entry.__tablename__}' are missing, so filtered "
+                                  f"pages of past entries scan the table. Run 'python models.py --create-indexes'")
+    history = DbHistory(user_urls)
+    try:
+        rows = history.count()
+    except sqlalchemy.exc.SQLAlchemyError:
+        db.session.rollback()
+        log_internal_echo(severity="Attention", sender=__name__,
+                          comment=f"The table {Entry.__tablename__} does not exist or is invalid. "
+                                  f"Past entries won't be shown")
+        return
+    history_set(history)
+    log_internal(severity="Information", comment=f"{rows} past entries can be browsed from the database")
+
+
 # Methods --------------------------------------------------------------------------------------------------------------
 # noinspection PyUnresolvedReferences
+@timed("fetch_db")
 def fetch_db(db_uri):
     """
     Fetches from the database all severities and users. If unable, will use default values defined on 'server_config'.
-    Called only on 'server_boot', on startup
+    Called only by 'fetch_db_async', on startup
     """
     db.create_engine(db_uri, {})
     # Fetching Severities classes, since they are atomic
     db_sev = {}
     db_users = {}
+    user_urls = {}      # {user id: url}, to resolve the sender of past entries
     table_sev = "severities"
     table_usr = "users"
-    # table_entry = "entries"
     try:
         stmt = text(f"SELECT * FROM {table_sev};")
         for sev in Severity.query.from_statement(stmt):
@@ -89,15 +333,14 @@ def fetch_db(db_uri):
         print_verbose(sender=__name__,
                       message=f"The table {table_sev} did not had valid or new severities labels."
                               f" Keeping default values")
-    else:
-        for key in list(db_sev.keys()):
-            add_severity(key, db_sev[key][0], db_sev[key][1], allow_replace=True, log_suppress=True)
+        db_sev.clear()
     # Fetching users and their colors
     try:
         stmt = text(f"SELECT * FROM {table_usr};")
         for usr in Users.query.from_statement(stmt):
             if usr.url is not None:
                 db_users[usr.url] = (usr.forecolor, usr.backcolor, usr.name if usr.name is not None else usr.url)
+                user_urls[usr.id] = usr.url
             else:
                 log_internal_echo(severity="Error", sender=__name__,
                                   comment=f"User id {usr.id} didn't have a valid url and was ignored")
@@ -111,12 +354,61 @@ def fetch_db(db_uri):
     if len(db_users) == 0 or db_users == defaults["SERVERS"]:
         print_verbose(sender=__name__,
                       message=f"The table {table_usr} did not had valid or new users. Keeping default values")
-    else:
-        for key in list(db_users.keys()):
-            add_server(key, db_users[key][0], db_users[key][1], db_users[key][2],
-                       allow_replace=True, log_suppress=True)
+        db_users.clear()
+    registry_swap(db_sev, db_users)     # Everything loaded is swapped in at once
     sev, serv, entry = lists_count()
     log_internal(severity="Success", comment=f"Loaded {serv} servers and {sev} severities from the database",
                  body={"servers": servers_list, "severities": severities})
-    # Fetch past entries
+    # Fetch past entries. Only how many there are: pages read them from the table as they're reached
+    if logger_config["DB_HISTORY"] is True and logger_config["USE_DB"] is True:
+        history_init(user_urls)
     db.engine.dispose()
+
+
+def fetch_db_async(app, db_uri):
+    """
+    Runs 'fetch_db' on a background thread, so the server can take requests while the database is slow or unreachable.
+    Until it's done the default severities and servers are used, and 'db_ready' is set once it finishes
+    :param app: The Flask app, whose context the thread runs on
+    :param db_uri: The database uri
+    :return: The started thread
+    """
+    def bootstrap():
+        start = time.perf_counter()
+        with app.app_context():
+            try:
+                # A process forked mid-fetch inherits the parent's pooled connections. They can't be shared
+                db.engine.dispose(close=False)
+                fetch_db(db_uri)
+            except Exception as exc:
+                log_uncaught_exception(str(exc), None, __name__)
+            finally:
+                db_ready.set()
+        log_internal_echo(severity="Information", sender=__name__,
+                          comment=f"Database bootstrap finished in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    db_ready.clear()
+    thread = threading.Thread(target=bootstrap, name="db_bootstrap", daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database maintenance of the log server")
+    parser.add_argument("--create-indexes", action="store_true",
+                        help="Creates the indexes that pages of past entries use, if they're missing")
+    parser.add_argument("--url", default=os.environ.get("DATABASE_URL", defaults["FALLBACK"]["DB_URL"]),
+                        help="Database url (Dft: 'DATABASE_URL')")
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("No database url was given")
+    if args.create_indexes:
+        engine = sqlalchemy.create_engine(args.url.replace("postgres://", "postgresql://", 1),
+                                          isolation_level="AUTOCOMMIT")
+        created = history_indexes(engine)
+        print(f"Created {', '.join(created)}" if created else "Every index exists already")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
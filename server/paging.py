@@ -1,13 +1,16 @@
 import psutil
 from datetime import datetime
+from urllib.parse import urlencode
 from flask import request, render_template
 from typing import Tuple
 
 from flask_wrappers import authenticated_user_is
 from server_config import defaults, logger_config
-from entry_manager import log_count, severities, servers_list
+from entry_manager import full_count, log_revision, page_servers, severities
+from metrics import timed
 
 
+@timed("prepare_page")
 def prepare_page(entry_count, filter_type, filter_target) -> Tuple[dict, int, int, int]:
     """Compute and prepares the variables used when rendering the page.
     :returns:
@@ -39,12 +42,14 @@ def prepare_page(entry_count, filter_type, filter_target) -> Tuple[dict, int, in
     except ValueError:  # Field 'p=' wasn't an integer
         cur_page = 1
 
-    entries_total = log_count()
+    body_args = {key: value for key, value in request.args.items() if key.startswith("body.")}
+    entries_total = full_count()    # Same as the unfiltered 'count', past entries of the database included
     cur_user = authenticated_user_is()
     # Page data
     out = {
         # 'about' section is an optional tuple
         "about": (),
+        "body_query": "&" + urlencode(body_args) if body_args else "",     # Body criteria, kept across pages
         "count": entry_count,
         "dia_ram": psutil.virtual_memory().percent,
         "entries": [],
@@ -59,8 +64,9 @@ def prepare_page(entry_count, filter_type, filter_target) -> Tuple[dict, int, in
         "page_max": max_page,
         "prod_name": defaults["INTERNAL"]["PRODUCT_NAME"],
         "public": logger_config["PUBLIC"],
+        "revision": log_revision(),
         "severities": severities,
-        "servers": servers_list,
+        "servers": page_servers(),
         "total": entries_total,
         "user": None if cur_user is None else cur_user.as_tuple(),
         "version": defaults["INTERNAL"]["VERSION"],
@@ -68,6 +74,7 @@ def prepare_page(entry_count, filter_type, filter_target) -> Tuple[dict, int, in
     return out, cur_page, max_page, per_page
 
 
+@timed("render")
 def serve_page(json_data, return_code):
     """Renders a page template"""
     return render_template("log_table_flask.html", data=json_data), return_code
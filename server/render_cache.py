@@ -0,0 +1,64 @@
+"""Caches of the rendered form of entries. A 'LogEntry' never changes once created (besides its repeat count), so both
+its 'json()' dict and its table row markup only go stale when the severities or servers registries change.
+Both caches are keyed by ('msg_id', repeats), dropped whenever 'registry_version()' moves and bounded by a byte budget
+"""
+import sys
+
+from flask import current_app
+from markupsafe import Markup
+
+from cache_lru import ByteBudgetLRU
+from entry_manager import registry_version
+from server_config import defaults, logger_config
+
+ROW_TEMPLATE = "log_row.html"
+
+json_cache = ByteBudgetLRU("entry_json", defaults["CACHE"]["JSON_BYTES"])
+row_cache = ByteBudgetLRU("entry_row", defaults["CACHE"]["ROW_BYTES"])
+
+
+def entry_json(entry) -> dict:
+    """
+    Returns 'entry.json()', from the cache when possible. The returned dict is shared, so it must not be modified
+    :param entry: A 'LogEntry'
+    """
+    if logger_config["RENDER_CACHE"] is False:
+        return entry.json()
+    rev = registry_version()
+    key = (entry.msg_id, entry.repeats)
+    out = json_cache.get(key, rev)
+    if out is None:
+        out = entry.json()
+        json_cache.put(key, rev, out, json_size(out))
+    return out
+
+
+def entry_row(entry) -> Markup:
+    """
+    Returns the table row markup of 'entry', from the cache when possible. Requires an application context
+    :param entry: A 'LogEntry'
+    """
+    rev = registry_version()
+    key = (entry.msg_id, entry.repeats)
+    if logger_config["RENDER_CACHE"] is True:
+        row = row_cache.get(key, rev)
+        if row is not None:
+            return row
+    row = Markup(current_app.jinja_env.get_template(ROW_TEMPLATE).render(entry=entry_json(entry)))
+    if logger_config["RENDER_CACHE"] is True:
+        row_cache.put(key, rev, row, sys.getsizeof(row))
+    return row
+
+
+def json_size(out: dict) -> int:
+    """Cheap estimate of how many bytes a 'json()' dict holds. The body is what usually dominates"""
+    size = sys.getsizeof(out) + sys.getsizeof(out["flavor"])
+    for value in out.values():
+        size += sys.getsizeof(value) if isinstance(value, (str, int)) else len(str(value))
+    return size
+
+
+def cache_clear():
+    """Drops every cached value"""
+    json_cache.clear()
+    row_cache.clear()
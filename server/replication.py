@@ -0,0 +1,205 @@
+"""Multi-node replication, enabled by 'logger_config["REPLICATION"]'. Every node accepts entries on its own and pulls
+the entries other nodes took from them, so each node's '/log' shows the merged log of all of them:
+  - Entry ids are hybrid logical clock ids ('hlc'), unique across nodes and ordered the same way on every one of them
+  - Each node serves the entries it took itself on 'GET /replication/entries?since=<id>', in batches, as MessagePack
+    (or JSON) and compressed like any other response
+  - A background thread pulls every peer in turn, keeping a cursor (the last id received) per peer, and merges what
+    it gets into the store, in id order
+Internal entries stay on the node that made them, and purges aren't replicated. Late entries from a peer are inserted
+before newer local ones. '/log/delta' clients (and the long-polls and streams of 'async_server') still get them: they
+are stamped with a cursor past every one handed out, up to 'LATE_MAX' of them ('entry_manager.log_delta').
+Nodes are set through the environment: 'LOG_NODE_ID', 'LOG_PEERS' (comma separated base urls) and
+'LOG_REPLICATION_SECRET'. Entries are served to peers without a login, so replication isn't enabled without a secret.
+To try it with several local processes (they share a random secret):
+    python replication.py --nodes 3 --port 5101
+"""
+import argparse
+import gzip
+import hmac
+import json
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import flask
+from flask import Blueprint, request
+
+import entry_manager
+import wire
+from entry_manager import log_internal_echo, log_merge
+from hlc import HybridClock, id_node
+from server_config import defaults, logger_config, print_verbose
+
+replication = Blueprint("replication", __name__)
+puller = None       # The running 'Puller', if any
+
+
+@replication.route('/replication/entries', methods=["GET"])
+def serve_entries():
+    secret = defaults["REPLICATION"]["SECRET"]
+    if secret is None or not hmac.compare_digest(request.headers.get("X-Replication-Token", ""), secret):
+        return "Forbidden", 403
+    since = request.args.get("since", 0, type=int)
+    limit = min(request.args.get("limit", defaults["REPLICATION"]["BATCH"], type=int), defaults["REPLICATION"]["BATCH"])
+    with entry_manager.store_lock:
+        entries = entry_manager.log_since(entry_manager.local_entries, since)[:limit + 1]
+    out = {"node": defaults["REPLICATION"]["NODE_ID"], "more": len(entries) > limit,
+           "entries": [entry.record() for entry in entries[:limit]]}
+    return wire.respond(out)
+
+
+class Puller:
+    def __init__(self, peers: list):
+        self.peers = {peer.rstrip("/"): {"cursor": 0, "pulled": 0, "errors": 0, "invalid": 0, "last_pull": None,
+                                         "node": None} for peer in peers}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="replication_puller", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(defaults["REPLICATION"]["TIMEOUT"] + 1)
+
+    def run(self):
+        while not self.stopped.is_set():
+            more = False
+            for peer in self.peers:
+                try:
+                    more = self.pull(peer) or more
+                except Exception as exc:    # Peer down, or it sent garbage. Retried later, the thread must go on
+                    self.peers[peer]["errors"] += 1
+                    print_verbose(sender=__name__, message=f"Pulling from '{peer}' failed: '{exc}'")
+            if not more:
+                self.stopped.wait(defaults["REPLICATION"]["INTERVAL"])
+
+    def pull(self, peer: str) -> bool:
+        """
+        Pulls a batch of entries from 'peer' and merges them
+        :return: True if the peer has more to send
+        """
+        state = self.peers[peer]
+        headers = {"Accept": wire.MSGPACK if wire.msgpack is not None else wire.JSON, "Accept-Encoding": "gzip"}
+        if defaults["REPLICATION"]["SECRET"] is not None:
+            headers["X-Replication-Token"] = defaults["REPLICATION"]["SECRET"]
+        req = urllib.request.Request(f"{peer}/replication/entries?since={state['cursor']}", headers=headers)
+        with urllib.request.urlopen(req, timeout=defaults["REPLICATION"]["TIMEOUT"]) as response:
+            data = response.read()
+            if response.headers.get("Content-Encoding") == "gzip":
+                data = gzip.decompress(data)
+            if wire.is_msgpack(response.headers.get_content_type()):
+                batch = wire.msgpack.unpackb(data, raw=False, strict_map_key=False)
+            else:
+                batch = json.loads(data)
+        records = batch["entries"]
+        entries = [record for record in records if valid_record(record) and id_node(record["id"]) == batch["node"]]
+        state["invalid"] += sum(1 for record in records if not valid_record(record))
+        if entries:
+            log_merge(entries)
+            state["pulled"] += len(entries)
+        cursors = [record["id"] for record in records if isinstance(record, dict) and isinstance(record.get("id"), int)]
+        if cursors:     # Past invalid records too: they'd be sent again otherwise
+            state["cursor"] = max(state["cursor"], max(cursors))
+        state["node"] = batch["node"]
+        state["last_pull"] = time.time()
+        return batch["more"]
+
+    def stats(self) -> dict:
+        return {peer: dict(state) for peer, state in self.peers.items()}
+
+
+def valid_record(record) -> bool:
+    """Tells if a record sent by a peer can be merged, as made by 'LogEntry.record'"""
+    return isinstance(record, dict) and isinstance(record.get("id"), int) and isinstance(record.get("from"), str) and \
+        isinstance(record.get("severity"), str) and isinstance(record.get("comment"), str) and \
+        isinstance(record.get("created"), (int, float)) and isinstance(record.get("repeats", 1), int) and \
+        isinstance(record.get("ip"), (str, type(None))) and isinstance(record.get("last_seen"), (str, type(None)))
+
+
+def start():
+    """Starts pulling from the peers, if not yet"""
+    global puller
+    if puller is None and defaults["REPLICATION"]["PEERS"]:
+        puller = Puller(defaults["REPLICATION"]["PEERS"])
+        puller.start()
+
+
+def stop():
+    """Stops pulling from the peers, if running"""
+    global puller
+    if puller is not None:
+        puller.stop()
+        puller = None
+
+
+def stats() -> dict:
+    """Returns the node id and the state of each peer, or None if replication is off"""
+    if logger_config["REPLICATION"] is False:
+        return None
+    return {"node": defaults["REPLICATION"]["NODE_ID"], "peers": None if puller is None else puller.stats()}
+
+
+def init_app(app: flask.Flask):
+    """Switches entry ids to the node's clock, serves this node's entries and starts pulling from the peers"""
+    config = defaults["REPLICATION"]
+    config["NODE_ID"] = int(os.environ.get("LOG_NODE_ID", config["NODE_ID"]))
+    if "LOG_PEERS" in os.environ:
+        config["PEERS"] = [peer.strip() for peer in os.environ["LOG_PEERS"].split(",") if peer.strip()]
+    config["SECRET"] = os.environ.get("LOG_REPLICATION_SECRET", config["SECRET"])
+    if not config["SECRET"]:
+        logger_config["REPLICATION"] = False
+        logger_config["POST_INIT"].append((log_internal_echo, ("Error", "Replication wasn't enabled: it needs a "
+                                                                        "secret ('LOG_REPLICATION_SECRET')")))
+        return
+    entry_manager.id_clock_set(HybridClock(config["NODE_ID"]))
+    app.register_blueprint(replication)
+    start()
+    # As with the syslog listener, the pulling thread must run on the process that serves
+    os.register_at_fork(before=stop, after_in_child=start)
+    logger_config["POST_INIT"].append((log_internal_echo, ("Information", f"Replicating as node {config['NODE_ID']}, "
+                                                                          f"with {len(config['PEERS'])} peer(s)")))
+
+
+def run_node(node_id: int, port: int, peers: list):
+    """Runs a single node, without database nor login, on 'port'"""
+    os.environ["LOG_NODE_ID"] = str(node_id)
+    os.environ["LOG_PEERS"] = ",".join(peers)
+    logger_config["REPLICATION"] = True
+    logger_config["USE_DB"] = False
+    logger_config["LOGIN"] = False
+    from server_boot import create_app
+    create_app().run(host="127.0.0.1", port=port, threaded=True, use_reloader=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs local log server nodes replicating between each other")
+    parser.add_argument("--nodes", type=int, default=3, help="How many nodes to start (Dft: 3)")
+    parser.add_argument("--port", type=int, default=5101, help="Port of the first node. The others follow (Dft: 5101)")
+    parser.add_argument("--node-id", type=int, help="Runs a single node with this id, instead of starting them all")
+    parser.add_argument("--peers", default="", help="With '--node-id', comma separated base urls of the other nodes")
+    args = parser.parse_args()
+    if args.node_id is not None:
+        return run_node(args.node_id, args.port, [peer for peer in args.peers.split(",") if peer])
+    urls = [f"http://127.0.0.1:{args.port + i}" for i in range(args.nodes)]
+    os.environ.setdefault("LOG_REPLICATION_SECRET", secrets.token_hex(16))     # Inherited by every node
+    nodes = [subprocess.Popen([sys.executable, __file__, "--node-id", str(i), "--port", str(args.port + i),
+                               "--peers", ",".join(url for url in urls if url != urls[i])])
+             for i in range(args.nodes)]
+    print(f"Nodes running on {', '.join(urls)}. Ctrl+C stops them")
+    try:
+        for node in nodes:
+            node.wait()
+    except KeyboardInterrupt:
+        for node in nodes:
+            node.terminate()
+
+
+if __name__ == "__main__":
+    main()
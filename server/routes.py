@@ -1,4 +1,6 @@
 import json
+import re
+import time
 from datetime import datetime
 
 import flask
@@ -9,11 +11,24 @@ from flask_login import login_required, logout_user
 from werkzeug.exceptions import BadRequest
 from flask import Blueprint, request, render_template, url_for, redirect
 
-from entry_manager import log_count, log_purge, log_add, log_uncaught_exception, log_internal, log_get, \
-                          add_server, add_severity
+import admission
+import blob_store
+import replication
+import scan
+import snapshot
+import syslog_listener
+from entry_manager import log_purge, log_add, log_uncaught_exception, log_internal, add_server, \
+                          add_severity, lists_count, log_revision, log_add_batch, log_scope, \
+                          log_delta, filter_cache, archive_get, archive_list, tier_stats, \
+                          registry_stats, full_count, full_window, history_stats, body_select, body_index_declare, \
+                          body_index_stats, slice_window, log_search, alert_set, alert_stats
+from metrics import exposition
+from models import db_ready
 from server_config import defaults, logger_config, print_verbose
 from paging import prepare_page, serve_page
+from render_cache import entry_json, entry_row
 from security import attempt_login
+from wire import is_msgpack, request_data, respond
 
 auth = Blueprint("auth", __name__)
 main = Blueprint("main", __name__)
@@ -23,14 +38,70 @@ main = Blueprint("main", __name__)
 @login_required
 def server_fetch():
     internal = {
-        "entry_count": log_count(),
+        "entry_count": full_count(),    # Compared by pages with their 'total'
+        "revision": log_revision(),
         "dia_ram": psutil.virtual_memory().percent,
         "last_update": datetime.now().strftime("%H:%M:%S - %d/%m/%Y"),
+        "db_ready": db_ready.is_set(),
+        "admission": admission.signals(),
+        "syslog": syslog_listener.stats(),
+        "replication": replication.stats(),
+        "snapshot": snapshot.stats(),
+        "tier": tier_stats(),
+        "blobs": blob_store.stats(),
+        "registry": registry_stats(),
+        "history": history_stats(),
+        "body_index": body_index_stats(),
+        "alerts": alert_stats(),
         # "services_timed_out": is_service_locked
     }
     return json.dumps(internal), 200
 
 
+@main.route('/server/metrics', methods=["GET"])  # Prometheus-style scrape target
+@login_required
+def server_metrics():
+    sev, serv, entry = lists_count()
+    gauges = {
+        "entries": ("Entries currently stored", entry),
+        "severities": ("Severity classes known", sev),
+        "servers": ("Servers known", serv),
+        "servers_discovered": ("Servers discovered, not defined", registry_stats()["discovered"]),
+        "ram_percent": ("System memory usage, in percent", psutil.virtual_memory().percent),
+        "metrics_enabled": ("1 if timings are being recorded", int(logger_config["METRICS"])),
+        "filter_cache_items": ("Filter results cached", filter_cache.stats()["items"]),
+        "filter_cache_bytes": ("Estimated bytes held by the cached filter results", filter_cache.stats()["bytes"]),
+    }
+    blobs = blob_store.stats()
+    if blobs is not None:
+        gauges["blob_bodies_offloaded"] = ("Large bodies kept as blobs", blobs["offloaded"])
+        gauges["blob_unique"] = ("Distinct blobs made", blobs["unique"])
+        gauges["blob_live_bytes"] = ("Compressed bytes of the blobs in use", blobs["live_bytes"])
+        gauges["blob_bytes_saved"] = ("Body bytes saved by deduplication and compression", blobs["bytes_saved"])
+    tier = tier_stats()
+    if tier is not None:
+        gauges["tier_hot_entries"] = ("Entries kept in memory", tier["hot"])
+        gauges["tier_cold_entries"] = ("Entries spilled to the cold segments", tier["cold"]["entries"])
+        gauges["tier_cold_bytes"] = ("Bytes of the cold segments", tier["cold"]["bytes"])
+    history = history_stats()
+    if history is not None:
+        gauges["history_queries"] = ("Queries made for past entries of the database", history["queries"])
+        gauges["history_cache_bytes"] = ("Estimated bytes of the past entries cached", history["cache"]["bytes"])
+    rules = alert_stats()
+    if rules is not None:
+        gauges["alert_rules"] = ("Alert rules set", rules["rules"])
+        gauges["alert_fired"] = ("Times the alert rules set triggered", rules["fired"])
+        gauges["alert_queued"] = ("Alert actions waiting to run", rules["queued"])
+        gauges["alert_dropped"] = ("Alert actions dropped by a full queue", rules["dropped"])
+    syslog = syslog_listener.stats()
+    if syslog is not None:
+        gauges["syslog_received"] = ("Datagrams received by the syslog listener", syslog["received"])
+        gauges["syslog_invalid"] = ("Datagrams that couldn't be parsed", syslog["invalid"])
+        gauges["syslog_dropped"] = ("Datagrams dropped by a full queue or load shedding", syslog["dropped"])
+        gauges["syslog_pending"] = ("Entries waiting to be stored", syslog["pending"])
+    return exposition(gauges), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 @main.route('/log/clear', methods=["POST"])
 @login_required
 def clear_logs():
@@ -44,7 +115,7 @@ def clear_logs():
             req_comm = req["comment"]
         except KeyError:
             req_comm = "Log Clear Request"
-        log_purge()
+        log_purge(archive=req.get("archive", True) is not False)
         log_add(s_from=req_from, severity="Information", comment=req_comm)
         return show_recent_entries()
     except BadRequest:
@@ -54,39 +125,207 @@ def clear_logs():
 @main.route('/log', methods=["POST"])
 @login_required
 def add_entry():
+    admission.ingest_started(request.headers.get("X-Request-Start"))
     try:
-        req = request.json
-        req_severity = "Unknown"
-        req_comm = "Not Specified"
-        req_body = {}
-        inputs = 3
-        try:
-            req_from = req["from"]
-            if req_from is None or req_from == "":
-                return "Bad Entry Ignored", 400
-        except KeyError:
-            return "Bad Entry Ignored", 400
-        try:
-            req_severity = req["severity"]
-        except KeyError:
-            inputs -= 1
-        try:
-            req_comm = req["comment"]
-        except KeyError:
-            inputs -= 1
-        try:
-            req_body = req["body"]
-        except KeyError:
-            inputs -= 1
-        if inputs > 0:
-            log_add(s_from=req_from, severity=req_severity, comment=req_comm, body=req_body)
-            return show_recent_entries()
-        else:
-            return "Empty Entry Ignored", 400
+        return ingest_entry()
+    finally:
+        admission.ingest_finished()
+
+
+def ingest_entry():
+    try:
+        req = request_data()
+        if isinstance(req, list):
+            return ingest_batch(req)
+        fields = entry_fields(req)
+        if isinstance(fields, str):
+            return fields, 400
+        if admission.admit(fields[1]) is False:
+            return "Entry Dropped (Server Overloaded)", 503
+        start = time.perf_counter()
+        entry = log_add(s_from=fields[0], severity=fields[1], comment=fields[2], body=fields[3])
+        admission.ingest_stored(start)
+        if is_msgpack(request.mimetype):    # Binary senders get a compact answer, instead of the page
+            return respond({"stored": 1, "id": entry.msg_id})
+        return show_recent_entries()
     except BadRequest:
         return "Bad Entry Ignored", 400
 
 
+def ingest_batch(reqs: list):
+    """Stores a list of entries sent at once. Answers with how many were stored, dropped or rejected"""
+    if len(reqs) > defaults["API"]["MAX_BATCH"]:
+        return f"Batch Too Large (Max: {defaults['API']['MAX_BATCH']})", 413
+    accepted = []
+    dropped = rejected = 0
+    for req in reqs:
+        fields = entry_fields(req)
+        if isinstance(fields, str):
+            rejected += 1
+        elif admission.admit(fields[1]) is False:
+            dropped += 1
+        else:
+            accepted.append(fields + (request.remote_addr,))
+    start = time.perf_counter()
+    log_add_batch(accepted)
+    admission.ingest_stored(start)
+    code = 503 if dropped > 0 and len(accepted) == 0 else 200
+    return respond({"stored": len(accepted), "dropped": dropped, "rejected": rejected}, code)
+
+
+def entry_fields(req):
+    """
+    Validates a single entry sent to 'POST /log'
+    :param req: The decoded entry
+    :return: A '(from, severity, comment, body)' tuple, or why it was ignored
+    """
+    if not isinstance(req, dict) or req.get("from") is None or req.get("from") == "":
+        return "Bad Entry Ignored"
+    if "severity" not in req and "comment" not in req and "body" not in req:
+        return "Empty Entry Ignored"
+    return req["from"], req.get("severity", "Unknown"), req.get("comment", "Not Specified"), req.get("body", {})
+
+
+def body_fields() -> dict:
+    """Returns the body criteria of the current request ('body.<path>=<value>' arguments), as {path: value}"""
+    return {key[len("body."):]: value for key, value in request.args.items()
+            if key.startswith("body.") and len(key) > len("body.")}
+
+
+def scoped(scope: tuple, fields: dict) -> tuple:
+    """
+    Selects the entries of a page
+    :param scope: The '(severity, sender set)' of 'log_scope'
+    :param fields: The body criteria of 'body_fields'. If any, only stored entries are matched
+    :return: How many entries match, and a 'window(offset, limit, newest_first)' returning a part of them. Without body
+    criteria, windows go on into the past entries of the database
+    """
+    if fields:
+        matched = body_select(fields, *scope)
+        return len(matched), lambda offset, limit, newest_first: slice_window(matched, offset, limit, newest_first)
+    return full_count(*scope), lambda offset, limit, newest_first: full_window(*scope, offset, limit, newest_first)
+
+
+@main.route('/log/entries', methods=['GET'])
+@login_required
+def get_entries():
+    """
+    A page of entries, newest first, as JSON or MessagePack. Takes the same 'f', 'ftgt', 'p', 'epp' and 'body.<path>'
+    as '/log'. Pages past the stored entries go on into the past entries of the database, which have negative ids
+    """
+    filter_type = None if request.args.get("f") == "None" else request.args.get("f")
+    filter_target = None if request.args.get("ftgt") == "None" else request.args.get("ftgt")
+    per_page = min(max(request.args.get("epp", defaults["INTERFACE"]["PAGE"]["EPP"], type=int), 1),
+                   defaults["API"]["MAX_ENTRIES"])
+    page = max(request.args.get("p", 1, type=int), 1)
+    count, window = scoped(log_scope(filter_type, filter_target), body_fields())
+    entries = window((page - 1) * per_page, per_page, True)
+    out = {"count": count, "revision": log_revision(), "page": page, "epp": per_page,
+           "entries": [entry_json(entry) for entry in entries]}
+    return respond(out)
+
+
+@main.route('/log/delta', methods=['GET'])
+@login_required
+def get_delta():
+    """
+    The entries added after 'since' (an entry id, or the 'last_id' of a previous delta), oldest first, as JSON or
+    MessagePack. Takes the same 'f', 'ftgt' and 'body.<path>' as '/log'. If 'more' is True, there's more to fetch: ask
+    again, since 'last_id'. Repeats of coalesced entries don't add ids, so they show up as a different 'revision' only.
+    Replicated entries that arrive behind newer ones are still sent, after them ('log_delta')
+    """
+    filter_type = None if request.args.get("f") == "None" else request.args.get("f")
+    filter_target = None if request.args.get("ftgt") == "None" else request.args.get("ftgt")
+    since = request.args.get("since", 0, type=int)
+    revision = log_revision()   # Read first: the entries can only be newer than it
+    limit = defaults["API"]["MAX_ENTRIES"]
+    fields = body_fields()
+    scope = log_scope(filter_type, filter_target)
+    delta = log_delta(since, limit + 1, *scope, matched=body_select(fields, *scope) if fields else None)
+    out = {"revision": revision, "last_id": since, "more": len(delta) > limit,
+           "entries": [entry_json(entry) for _, entry in delta[:limit]]}
+    if out["entries"]:
+        out["last_id"] = delta[len(out["entries"]) - 1][0]
+    response = respond(out)
+    # Lets 'async_server' know what it got without decoding the body
+    response.headers["X-Delta-Count"] = str(len(out["entries"]))
+    response.headers["X-Delta-Last-Id"] = str(out["last_id"])
+    response.headers["X-Delta-More"] = "1" if out["more"] else "0"
+    return response
+
+
+@main.route('/log/search', methods=['GET'])
+@login_required
+def search_entries():
+    """
+    The entries whose comment matches a regular expression ('q') and whose body holds every 'body.<path>' value, as
+    JSON or MessagePack. Takes the same 'f' and 'ftgt' as '/log'. Indexed body paths are looked up, anything else is
+    a parallel scan of the entries in scope, newest first ('order=oldest' for the opposite), which stops once 'epp'
+    entries matched or its time budget ('budget', in ms) is over. If 'complete' is False there may be more: ask
+    again with 'before' (or 'after', oldest first) set to 'cursor'. The expression ignores case, unless 'case=1'
+    """
+    filter_type = None if request.args.get("f") == "None" else request.args.get("f")
+    filter_target = None if request.args.get("ftgt") == "None" else request.args.get("ftgt")
+    pattern = request.args.get("q") or None
+    if pattern is not None and len(pattern) > defaults["SCAN"]["MAX_PATTERN"]:
+        return f"Pattern Too Long (Max: {defaults['SCAN']['MAX_PATTERN']})", 400
+    predicate = scan.Predicate(pattern, request.args.get("case") != "1", body_fields())
+    try:
+        predicate.compile()
+    except re.error as exc:
+        return f"Invalid Pattern ({exc})", 400
+    per_page = min(max(request.args.get("epp", defaults["INTERFACE"]["PAGE"]["EPP"], type=int), 1),
+                   defaults["API"]["MAX_ENTRIES"])
+    budget = min(max(request.args.get("budget", defaults["SCAN"]["BUDGET_MS"], type=int), 1),
+                 defaults["SCAN"]["MAX_BUDGET_MS"])
+    found = log_search(predicate, *log_scope(filter_type, filter_target),
+                       newest_first=request.args.get("order") != "oldest", limit=per_page, budget=budget / 1000,
+                       after=request.args.get("after", type=int), before=request.args.get("before", type=int))
+    found["entries"] = [entry_json(entry) for entry in found["entries"]]
+    return respond(found)
+
+
+@main.route('/log/archive', methods=['GET'])
+@login_required
+def get_archives():
+    """The purged generations still kept, oldest first. Each can be read on '/log/archive/<generation>'"""
+    return respond({"generations": [old.info() for old in archive_list()]})
+
+
+@main.route('/log/archive/<int:number>', methods=['GET'])
+@login_required
+def get_archive_entries(number: int):
+    """A page of entries of an archived generation, newest first. Same arguments and answer as '/log/entries'"""
+    old = archive_get(number)
+    if old is None:
+        return f"Generation {number} Isn't Archived", 404
+    filter_type = None if request.args.get("f") == "None" else request.args.get("f")
+    filter_target = None if request.args.get("ftgt") == "None" else request.args.get("ftgt")
+    per_page = min(max(request.args.get("epp", defaults["INTERFACE"]["PAGE"]["EPP"], type=int), 1),
+                   defaults["API"]["MAX_ENTRIES"])
+    page = max(request.args.get("p", 1, type=int), 1)
+    scope = log_scope(filter_type, filter_target)
+    entries = old.window(*scope, offset=(page - 1) * per_page, limit=per_page, newest_first=True)
+    out = {"generation": number, "count": old.count(*scope), "page": page, "epp": per_page,
+           "entries": [entry_json(entry) for entry in entries]}
+    return respond(out)
+
+
+@main.route('/log/archive/<int:number>/export', methods=['GET'])
+@login_required
+def export_archive(number: int):
+    """Every entry of an archived generation, oldest first, as newline delimited JSON. Takes 'f' and 'ftgt'"""
+    old = archive_get(number)
+    if old is None:
+        return f"Generation {number} Isn't Archived", 404
+    filter_type = None if request.args.get("f") == "None" else request.args.get("f")
+    filter_target = None if request.args.get("ftgt") == "None" else request.args.get("ftgt")
+    records = old.export(*log_scope(filter_type, filter_target))
+    return flask.Response((json.dumps(record, default=str) + "\n" for record in records),
+                          mimetype="application/x-ndjson",
+                          headers={"Content-Disposition": f"attachment; filename=log_generation_{number}.ndjson"})
+
+
 @main.route('/')
 @login_required
 def home_page():
@@ -99,14 +338,12 @@ def show_recent_entries():
     # handle_log_services() # Disabled on this version
     filter_type = None if request.args.get("f") == "None" else request.args.get("f")
     filter_target = None if request.args.get("ftgt") == "None" else request.args.get("ftgt")
-    entries = log_get(filter_type, filter_target)[::-1]
+    count, window = scoped(log_scope(filter_type, filter_target), body_fields())
 
-    out, cur_page, max_page, per_page = prepare_page(len(entries), filter_type, filter_target)
+    out, cur_page, max_page, per_page = prepare_page(count, filter_type, filter_target)
 
-    for entry in entries[(cur_page - 1) * per_page:]:
-        out["entries"].append(entry.json())
-        if len(out["entries"]) == per_page:
-            break
+    for entry in window((cur_page - 1) * per_page, per_page, True):
+        out["entries"].append(entry_row(entry))
     return serve_page(out, 200)
 
 
@@ -116,18 +353,17 @@ def show_entries():
     # handle_log_services() # Disabled on this version
     filter_type = None if request.args.get("f") == "None" else request.args.get("f")
     filter_target = None if request.args.get("ftgt") == "None" else request.args.get("ftgt")
-    entries = log_get(filter_type, filter_target)
+    count, window = scoped(log_scope(filter_type, filter_target), body_fields())
 
-    out, cur_page, max_page, per_page = prepare_page(len(entries), filter_type, filter_target)
+    out, cur_page, max_page, per_page = prepare_page(count, filter_type, filter_target)
 
-    for entry in entries[(cur_page - 1) * per_page:]:
-        out["entries"].append(entry.json())
-        if len(out["entries"]) == per_page:
-            break
+    for entry in window((cur_page - 1) * per_page, per_page, False):
+        out["entries"].append(entry_row(entry))
     return serve_page(out, 200)
 
 
 @main.route('/set', methods=['POST'])
+@login_required
 def set_info():
     try:
         req = request.json
@@ -145,6 +381,10 @@ def set_info():
             elif req_type == "server":
                 add_server(req[key_url], req[key_color], req[key_backcolor], req[key_name], allow_replace=True)
                 log_internal(severity="Success", comment=f"Added a new server '{req[key_url]}' ({req[key_name]})")
+            elif req_type == "index":
+                body_index_declare(req["path"])
+            elif req_type == "rule":
+                alert_set(req)
         except KeyError:
             return redirect(url_for("main.show_recent_entries"))
     except ValueError:
@@ -0,0 +1,342 @@
+"""Parallel scans, for questions no index answers: a regular expression over comments, or values on body paths that
+aren't indexed ('body_index'). The entries in scope are split into immutable chunks: each cold segment is one, and the
+hot entries are cut every 'defaults["SCAN"]["CHUNK"]'. Chunks are handed to a pool of workers a few at a time, and
+their matches are collected in order, so they come back in id order (or reversed), and the scan stops as soon as enough
+were found, or once its time budget is over. The pool is made of processes ('MODE': "process"), which evaluate
+predicates in parallel: they read cold segments straight from their files, and hot chunks are sent to them as
+'(comment, body)' rows. Processes are started from a fresh interpreter (not forked from the server), so the server's
+threads and fork hooks aren't involved. With 'MODE': "thread", chunks only overlap with each other's decoding.
+Small scans ('MIN_PARALLEL'), and every scan on a single CPU, run right away on the calling thread.
+Nothing here reads the store: 'entry_manager.log_search' takes the chunks under the store lock, and passes them in
+"""
+import atexit
+import mmap
+import multiprocessing
+import os
+import pickle
+import re
+import time
+from collections import deque
+from concurrent.futures import BrokenExecutor, Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+
+import body_index
+from blob_store import resolve
+from cold_store import HEADER
+from columnar import EntryView
+from server_config import defaults
+
+pool = None     # The running executor, made on the first parallel scan
+
+
+class Predicate:
+    def __init__(self, pattern: str = None, ignore_case: bool = True, fields: dict = None):
+        """
+        What an entry must match. It's sent to the worker processes, so the pattern is compiled where it's used
+        :param pattern: A regular expression searched for in the comment
+        :param ignore_case: If True, the pattern ignores case
+        :param fields: What the body must hold, as {path: value} (see 'body_index')
+        """
+        self.pattern = pattern
+        self.flags = re.IGNORECASE if ignore_case else 0
+        self.fields = fields or {}
+        self.regex = None
+
+    def __getstate__(self):
+        return {"pattern": self.pattern, "flags": self.flags, "fields": self.fields, "regex": None}
+
+    def compile(self):
+        """Compiles the pattern. Raises 're.error' if it's invalid"""
+        if self.pattern is not None and self.regex is None:
+            self.regex = re.compile(self.pattern, self.flags)
+        return self
+
+    def test(self, comment, body) -> bool:
+        return self.test_comment(comment) and self.test_body(body)
+
+    def test_comment(self, comment) -> bool:
+        return self.pattern is None or self.compile().regex.search(str(comment)) is not None
+
+    def test_body(self, body) -> bool:
+        if self.fields:
+            body = resolve(body)
+            return all(body_index.matches(body, path, value) for path, value in self.fields.items())
+        return True
+
+
+def expired(deadline: float) -> bool:
+    """
+    Tells if 'deadline' ('time.monotonic()', the same clock on every process) is over. Checked before every row: a
+    single row may take long enough to matter, on a slow pattern
+    """
+    return deadline is not None and time.monotonic() > deadline
+
+
+def scan_rows(rows: list, predicate: Predicate, deadline: float = None):
+    """
+    Returns the positions of the '(comment, body)' rows matching 'predicate', or None if 'deadline' was over first
+    """
+    positions = []
+    for position, (comment, body) in enumerate(rows):
+        if expired(deadline):
+            return None
+        if predicate.test(comment, body):
+            positions.append(position)
+    return positions
+
+
+def scan_hot(entries, predicate: Predicate, deadline: float = None):
+    """Same as 'scan_rows', on hot entries"""
+    rows = hot_rows(entries, predicate, deadline)
+    return None if rows is None else scan_rows(rows, predicate, deadline)
+
+
+def hot_rows(entries, predicate: Predicate, deadline: float = None):
+    """
+    Returns the '(comment, body)' rows of hot entries, or None if 'deadline' was over first. Only the fields
+    'predicate' tests are read (the others are None), as rows are pickled for worker processes. Entries of a columnar
+    store are read from its columns, not built
+    """
+    comments = predicate.pattern is not None
+    bodies = bool(predicate.fields)
+    if isinstance(entries, EntryView):
+        columns = entries.columns
+        source = ((columns.comments[row], columns.bodies[row]) for row in map(int, entries.rows))
+    else:
+        source = ((entry.comment, entry.body) for entry in entries)
+    rows = []
+    for comment, body in source:
+        if expired(deadline):
+            return None
+        rows.append((comment if comments else None, body if bodies else None))
+    return rows
+
+
+def scan_buffer(buffer, size: int, codes: set, sender_set: set, predicate: Predicate, deadline: float = None):
+    """
+    Returns where each record of a segment matching every criteria starts, or None if 'deadline' was over first.
+    Severity and sender are read from headers, and only the records passing them are decoded
+    :param codes: Severity codes of the segment to match. None for any
+    :param sender_set: Sender ids to match. None for any
+    """
+    offsets = []
+    offset = 0
+    while offset < size:
+        if expired(deadline):
+            return None
+        length, _, _, sender_id, code = HEADER.unpack_from(buffer, offset)
+        if (codes is None or code in codes) and (sender_set is None or sender_id in sender_set):
+            start = offset + HEADER.size
+            comment, body = pickle.loads(buffer[start:start + length])[:2]
+            if predicate.test(comment, body):
+                offsets.append(offset)
+        offset += HEADER.size + length
+    return offsets
+
+
+def scan_file(path: str, codes: set, sender_set: set, predicate: Predicate, deadline: float = None):
+    """Same as 'scan_buffer', mapping the segment from its file. Used by worker processes"""
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return scan_buffer(buffer, len(buffer), codes, sender_set, predicate, deadline)
+
+
+class HotChunk:
+    def __init__(self, entries):
+        """
+        :param entries: Hot entries (a list or an 'EntryView'), in id order, that won't change meanwhile
+        """
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def task(self, processes: bool, predicate: Predicate, deadline: float = None):
+        """Returns the function scanning the chunk and its arguments, or None if 'deadline' was over first"""
+        if processes:
+            rows = hot_rows(self.entries, predicate, deadline)
+            return None if rows is None else (scan_rows, rows)
+        return scan_hot, self.entries   # Read on the worker thread, so chunks not needed anymore are never read
+
+    def matched(self, result: list) -> list:
+        return [self.entries[position] for position in result]
+
+
+class ColdChunk:
+    def __init__(self, segment, entry_factory, severity: str = None, sender_set: set = None, after: int = None,
+                 before: int = None):
+        """
+        :param segment: A 'cold_store.Segment', kept open meanwhile
+        :param entry_factory: Rebuilds the entries matched, as 'LogEntry.restore'
+        :param after: Only entries with an id greater than this
+        :param before: Only entries with an id lower than this
+        """
+        self.segment = segment
+        self.entry_factory = entry_factory
+        self.codes = None if severity is None else \
+            {code for code, name in enumerate(segment.severities) if name.casefold() == severity.casefold()}
+        self.sender_set = sender_set
+        self.after = after
+        self.before = before
+
+    def __len__(self):
+        return len(self.segment)
+
+    def task(self, processes: bool, predicate: Predicate, deadline: float = None):
+        if processes:
+            return scan_file, self.segment.path, self.codes, self.sender_set
+        return scan_buffer, self.segment.map, self.segment.size, self.codes, self.sender_set
+
+    def matched(self, result: list) -> list:
+        entries = [self.segment.entry(offset, self.entry_factory) for offset in result]
+        return [entry for entry in entries if (self.after is None or entry.msg_id > self.after) and
+                (self.before is None or entry.msg_id < self.before)]
+
+
+def worker_count() -> int:
+    """Returns how many workers scan at once. With a single one, scans run on the calling thread instead"""
+    if defaults["SCAN"]["WORKERS"]:
+        return defaults["SCAN"]["WORKERS"]
+    if hasattr(os, "sched_getaffinity"):    # The CPUs this process may run on
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def executor():
+    """Returns the pool, starting it if needed"""
+    global pool
+    if pool is None:
+        workers = worker_count()
+        if defaults["SCAN"]["MODE"] == "process":
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["scan"])    # Workers fork from a process that only imported this
+            else:
+                context = multiprocessing.get_context("spawn")
+            pool = ProcessPoolExecutor(workers, mp_context=context)
+        else:
+            pool = ThreadPoolExecutor(workers, thread_name_prefix="scan_worker")
+    return pool
+
+
+def shutdown():
+    """Stops the pool, if running. Scans in progress finish on their own"""
+    global pool
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool = None
+
+
+def recycle():
+    """
+    Stops the pool, killing its workers. Tasks already running can't be cancelled otherwise: a scan over its budget
+    does it, so those it abandoned don't delay the next scans. The next parallel scan starts a new pool
+    """
+    global pool
+    old, pool = pool, None
+    if old is None:
+        return
+    workers = list((getattr(old, "_processes", None) or {}).values())    # No public way to stop them before 3.14
+    old.shutdown(wait=False, cancel_futures=True)
+    for worker in workers:
+        worker.terminate()
+
+
+def forget():
+    """After a fork, the child can't use the parent's workers"""
+    global pool
+    pool = None
+
+
+def run(chunks: list, predicate: Predicate, newest_first: bool = False, limit: int = None,
+        budget: float = None) -> dict:
+    """
+    Scans 'chunks' for the entries matching 'predicate'
+    :param chunks: 'HotChunk' and 'ColdChunk', in id order
+    :param newest_first: If True, chunks are scanned (and matches returned) from the newest one backwards
+    :param limit: Stops once this many entries matched. None for all of them
+    :param budget: Seconds the scan may take. None for no limit. It's checked before every row: a single comment can't
+    be interrupted, which is why patterns are capped ('MAX_PATTERN')
+    :return: The 'entries' matched, whether the scan was 'complete' (every chunk scanned), how many entries were
+    'scanned', and the 'cursor' to resume from (the id of the last entry returned or scanned) if it wasn't. A cursor
+    of None on an incomplete scan means no chunk could be scanned within the budget
+    """
+    predicate.compile()
+    start = time.monotonic()
+    deadline = None if budget is None else start + budget
+    order = list(reversed(chunks)) if newest_first else list(chunks)
+    window = 2 * worker_count()
+    parallel = window > 2 and sum(len(chunk) for chunk in order) >= defaults["SCAN"]["MIN_PARALLEL"]
+    processes = parallel and defaults["SCAN"]["MODE"] == "process"
+    workers = executor() if parallel else None
+    pending = deque()
+    entries = []
+    scanned = 0
+    cursor = None
+    complete = False
+    timed_out = False
+    upcoming = iter(order)
+    try:
+        while not timed_out:
+            while len(pending) < (window if parallel else 1):
+                chunk = next(upcoming, None)
+                if chunk is None:
+                    break
+                task = chunk.task(processes, predicate, deadline)
+                if task is None:
+                    timed_out = True
+                    break
+                fn, *args = task
+                future = None
+                if workers is not None:
+                    try:
+                        future = workers.submit(fn, *args, predicate, deadline)
+                    except RuntimeError:    # Recycled by another scan over its budget. Goes on here
+                        workers = None
+                if future is None:
+                    future = Future()
+                    future.set_result(fn(*args, predicate, deadline))
+                pending.append((chunk, future))
+            if timed_out or not pending:
+                complete = not timed_out
+                break
+            chunk, future = pending.popleft()
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                result = future.result(remaining)
+            except (TimeoutError, BrokenExecutor):     # Over the budget, or recycled by another scan
+                pending.appendleft((chunk, future))
+                timed_out = True
+                break
+            if result is None:  # Cut by the deadline
+                timed_out = True
+                break
+            matched = chunk.matched(result)
+            if newest_first:
+                matched.reverse()
+            scanned += len(chunk)
+            cursor = edge_id(chunk, newest_first)
+            if limit is not None and len(entries) + len(matched) >= limit:
+                taken = limit - len(entries)
+                entries.extend(matched[:taken])
+                if taken < len(matched):
+                    cursor = entries[-1].msg_id
+                complete = taken == len(matched) and not pending and next(upcoming, None) is None
+                break
+            entries.extend(matched)
+    finally:
+        running = [future for _, future in pending if not future.cancel() and not future.done()]
+        if running and timed_out and processes:    # They'd keep their workers busy, past this scan
+            recycle()
+    return {"entries": entries, "complete": complete, "scanned": scanned, "cursor": None if complete else cursor,
+            "elapsed_ms": round((time.monotonic() - start) * 1000, 3)}
+
+
+def edge_id(chunk, newest_first: bool) -> int:
+    """Returns the id of the last entry of 'chunk' in scan order"""
+    if isinstance(chunk, ColdChunk):
+        return chunk.segment.first_id if newest_first else chunk.segment.last_id
+    return chunk.entries[0].msg_id if newest_first else chunk.entries[-1].msg_id
+
+
+os.register_at_fork(after_in_child=forget)
+atexit.register(shutdown)
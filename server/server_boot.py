@@ -1,12 +1,19 @@
 import os
+import time
+import assets
+import compression
+import metrics
+import replication
 import routes
+import snapshot
+import syslog_listener
 from flask_login import LoginManager
 from flask_sslify import SSLify
 from flask import Flask
 
-from models import fetch_db, db, Users
+from models import fetch_db_async, db, db_ready, Users
 from server_config import logger_config, defaults, print_verbose
-from entry_manager import servers_list, log_uncaught_exception, log_internal
+from entry_manager import servers_list, log_uncaught_exception, log_internal, store_init
 
 
 def server_init(is_pre_init: bool):
@@ -49,8 +56,18 @@ def server_init(is_pre_init: bool):
                   message=f"{order} Initialization complete")
 
 
-def create_app():
-    """Starts, initializes the server and connects the database"""
+def create_app(boot_start: float = None):
+    """
+    Starts, initializes the server and connects the database. The database is loaded in the background, so this returns
+    (and the server can bind its port) without waiting for it
+    :param boot_start: 'time.perf_counter()' taken before the server's modules were imported, if known. Used to report
+    the startup time
+    """
+    if boot_start is None:
+        boot_start = time.perf_counter()
+    app_start = time.perf_counter()
+    store_init()
+    restored = snapshot.init() if logger_config["SNAPSHOT"] is True else None
     app = Flask(__name__)
     config_context = app.app_context()
     config_context.push()
@@ -83,6 +100,9 @@ def create_app():
 
     app.register_blueprint(routes.auth)
     app.register_blueprint(routes.main)
+    metrics.init_app(app)
+    compression.init_app(app)
+    assets.init_app(app)
 
     servers_list["LogServer"] = defaults["INTERNAL"]["SERVER_NAME"]  # Add the server as an filter option
     print_verbose(sender=__name__, message="Initializing Database...")
@@ -91,19 +111,31 @@ def create_app():
     login_manager.init_app(app)
 
     @login_manager.user_loader
+    @metrics.timed("load_user")
     def load_user(user_id):
         return Users.query.get(int(user_id))
 
     if db_uri is not None and db_uri != "" and logger_config["USE_DB"] is True:
         db.init_app(app)
 
-        fetch_db(db_uri)
-        print_verbose(sender=__name__, message="Database Initialized")
+        fetch_db_async(app, db_uri)
+        # With 'gunicorn --preload' the app is created on the master, and the worker forked from it doesn't inherit
+        # the bootstrap thread. If it didn't finish before the fork, the worker starts its own
+        os.register_at_fork(after_in_child=lambda: db_ready.is_set() or fetch_db_async(app, db_uri))
+        print_verbose(sender=__name__, message="Database Initializing in the background")
     else:
         db_msg = "Log Server running WITHOUT Database support"
         print_verbose(sender=__name__, message=db_msg)
         logger_config["POST_INIT"].append((log_internal, ("Attention", db_msg)))
         logger_config["LOGIN"] = False     # If we don't have a database, we can't login
+        db_ready.set()
+
+    if logger_config["REPLICATION"] is True:
+        replication.init_app(app)
+
+    if logger_config["SYSLOG"] is True:
+        syslog_listener.start()
+        syslog_listener.init_fork_handling()
 
     # Final checks and warnings
     if logger_config["LOGIN"] is False:
@@ -120,6 +152,15 @@ def create_app():
         logger_config["POST_INIT"].append((log_internal, ("Warning", public_mode_msg)))
 
     logger_config["POST_INIT"].append((log_internal, ("Success", "Log Server Started successfully")))
+    now = time.perf_counter()
+    startup = {"import_ms": round((app_start - boot_start) * 1000, 3),
+               "create_app_ms": round((now - app_start) * 1000, 3),
+               "total_ms": round((now - boot_start) * 1000, 3)}
+    if restored is not None:
+        startup["snapshot_ms"] = restored["load_ms"]
+        startup["snapshot_entries"] = restored["entries"]
+    logger_config["POST_INIT"].append((log_internal, ("Information", f"Log Server ready in {startup['total_ms']}ms",
+                                                      startup)))
     print_verbose(sender=__name__, message="Server Initialization complete", underline=True)
     server_init(is_pre_init=False)
     config_context.pop()
@@ -7,6 +7,19 @@ logger_config = {"PRE_INIT": [],         # Stuff to do before initialization
                  "VERBOSE": False,       # If True, each log added will produce an equivalent console output (Dft: F)
                  "LOAD_PRIVATE": False,  # If True, will try to load sensitive data (for debug purposes) (Dft: F)
                  "USE_DB": True,         # If True, will try to fetch users and severities from a database (Dft: T)
+                 "DB_HISTORY": True,     # If True, pages go on into the past entries of the database (Dft: T)
+                 "COALESCE": False,      # If True, identical entries in a row from a sender are counted once (Dft: F)
+                 "SHEDDING": True,       # If True, low priority entries are dropped when ingest is overloaded (Dft: T)
+                 "COMPRESS": True,       # If True, responses are compressed if the client supports it (Dft: T)
+                 "COLUMNAR": False,      # If True, entries are stored as typed columns instead of objects (Dft: F)
+                 "REPLICATION": False,   # If True, exchanges entries with the other nodes in 'PEERS' (Dft: F)
+                 "BLOBS": True,          # If True, large bodies are kept compressed and deduplicated (Dft: T)
+                 "TIERED": False,        # If True, older entries are spilled from memory to disk segments (Dft: F)
+                 "SNAPSHOT": False,      # If True, the state is saved periodically and restored on boot (Dft: F)
+                 "SYSLOG": False,        # If True, also ingests syslog and JSON entries over UDP (Dft: F)
+                 "ALERTS": True,         # If True, alert rules are evaluated on every entry taken (Dft: T)
+                 "RENDER_CACHE": True,   # If True, rendered entries are cached and reused between pages (Dft: T)
+                 "METRICS": True,        # If True, records request and stage timings on '/server/metrics' (Dft: T)
                  "PUBLIC": True,         # If True, all users can see each-others logs (Requires 'LOGIN'=True) (Dft: F)
                  "LOGIN": True}          # If True, all users need to login (Database dependent) (Dft: T)
 
@@ -34,6 +47,92 @@ defaults = {"SEVERITIES": {"success": ('#000000', '#00ee55'),   # Default severi
                          "LOGIN": {"MAX_TRIES": 5,      # Maximum amount of wrong guesses before locking the login
                                    "LOCKOUT": 3600}     # How many seconds should the login for that IP be locked
                          },
+            "CACHE": {"JSON_BYTES": 16 * 1024 * 1024,   # Byte budget of the cached entries' 'json()' dicts
+                      "ROW_BYTES": 32 * 1024 * 1024,    # Byte budget of the cached entries' table row markup
+                      "SENDER_MATCHES": 256,            # How many 'from' filter targets are kept resolved
+                      "FILTER_BYTES": 32 * 1024 * 1024},  # Byte budget of the cached filter results (8 per entry)
+            "COALESCE": {"WINDOW": 60,      # Seconds, from the first occurrence, in which copies are coalesced
+                         "BODY": False},    # If True, the body must also match for entries to be identical
+            "ADMISSION": {"PRIORITY": ["information", "success", "warning", "attention"],  # Low to high. Drop order
+                          "ALWAYS": ["error", "critical"],   # Severities that are never dropped
+                          "MAX_IN_FLIGHT": 32,               # Ingest requests being handled at once before shedding
+                          "MAX_LATENCY": 0.5,                # Average store time of ingests (seconds) before shedding
+                          "MAX_QUEUE_WAIT": 1.0,             # Average wait before ingests are handled (seconds)
+                          "MAX_MEMORY_MB": 450,              # Process resident memory before shedding
+                          "HARD_RATIO": 2.0,                 # Overload ratio at which everything sheddable is dropped
+                          "LATENCY_WEIGHT": 0.05,            # Weight of each new sample on the average latency
+                          "MEMORY_INTERVAL": 0.5},           # Seconds between process memory samples
+            "COMPRESSION": {"MIN_SIZE": 1024,     # Responses smaller than this (bytes) are sent as they are
+                            "LEVEL": 6,           # gzip level of dynamic responses
+                            "BR_QUALITY": 4,      # brotli quality of dynamic responses
+                            "MIMETYPES": ["text/html", "text/plain", "text/css", "application/json",
+                                          "application/x-ndjson", "application/javascript",
+                                          "application/msgpack"]},
+            "SYSLOG": {"HOST": "0.0.0.0",       # Address the UDP listener binds to
+                       "PORT": 5514,            # UDP port (514 requires privileges)
+                       "BATCH_SIZE": 500,       # Entries stored at once, under a single lock
+                       "FLUSH_INTERVAL": 0.05,  # Seconds a partial batch waits before being stored
+                       "QUEUE_MAX": 20000,      # Entries waiting to be stored before datagrams are dropped
+                       "RCVBUF": 4 * 1024 * 1024,   # Socket receive buffer (bytes). Absorbs bursts between reads
+                       # Syslog severity (0 Emergency to 7 Debug) to our severities
+                       "SEVERITIES": ["critical", "critical", "critical", "error", "warning", "attention",
+                                      "information", "information"]},
+            "API": {"MAX_BATCH": 1000,      # Most entries accepted on a single 'POST /log' batch
+                    "MAX_ENTRIES": 1000},   # Most entries returned by a single read or delta request
+            "ASYNC": {"WORKERS": 8,            # Threads running Flask views for 'async_server'. Idle clients use none
+                      "POLL_INTERVAL": 0.1,    # Seconds between checks for new entries, for waiting clients
+                      "KEEPALIVE": 15,         # Seconds between keep-alive comments on idle streams
+                      "MAX_WAIT": 60},         # Most seconds a '/log/delta?wait=' long-poll is held
+            "REPLICATION": {"NODE_ID": 0,      # Unique on every node, 0 to 255. Overridden by 'LOG_NODE_ID'
+                            "PEERS": [],       # Base urls of the other nodes. Overridden by 'LOG_PEERS' (comma list)
+                            "SECRET": None,    # Token peers must send. Overridden by 'LOG_REPLICATION_SECRET'
+                            "INTERVAL": 0.5,   # Seconds between pulls from each peer, when idle
+                            "BATCH": 2000,     # Most entries sent on a single pull
+                            "LATE_MAX": 10000, # Late entries kept for '/log/delta' clients that are past their ids
+                            "TIMEOUT": 5},     # Seconds before a pull is given up
+            "SNAPSHOT": {"PATH": "snapshot.bin",   # Snapshot file. Overridden by 'LOG_SNAPSHOT'
+                         "INTERVAL": 60,           # Seconds between snapshots (skipped if nothing changed)
+                         "LEVEL": 1},              # zlib level. Snapshots are taken often, so favor speed
+            "ARCHIVE": {"GENERATIONS": 2,    # Purged generations kept queryable on '/log/archive'. 0 frees them
+                        "MAX_AGE": 3600,     # Seconds an archived generation is kept. None keeps it until evicted
+                        "GRACE": 5,          # Seconds freed entries wait, for requests still reading them to finish
+                        "REAP_CHUNK": 10000},    # Entries freed at once, before letting other threads run
+            "BLOBS": {"THRESHOLD": 16 * 1024,    # Bodies taking more bytes than this (pickled) are offloaded
+                      "LEVEL": 6,                 # zlib level. Blobs are compressed once, and read far more often
+                      "DECODED_BYTES": 8 * 1024 * 1024},  # Byte budget of the bodies kept decoded for rendering
+            "TIER": {"HOT_BYTES": 64 * 1024 * 1024,  # Memory budget of the entries kept as objects (estimated)
+                     "LOW_WATER": 0.75,       # Fraction of the budget the hot tier is brought down to on a spill
+                     "ENTRY_OVERHEAD": 600,   # Estimated bytes of an entry object, besides its encoded fields
+                     "SEGMENT_ENTRIES": 16384,    # Most entries per segment file
+                     "INDEX_EVERY": 64,       # Records between sparse index points. Lower seeks faster, costs more RAM
+                     "PATH": None},           # Segment folder. Overridden by 'LOG_TIER_DIR'. None is a temporary one
+            "REGISTRY": {"MAX_DISCOVERED": 1000,  # Most servers discovered (not defined) kept. Least active are evicted
+                         "PAGE_DISCOVERED": 50,   # Most recently active discovered servers offered as filters on pages
+                         "NOTICE_INTERVAL": 10,   # Seconds between notices of newly discovered servers
+                         "NOTICE_MAX": 100},      # Most servers listed on a single notice
+            "BODY_INDEX": {"PATHS": [],              # Body paths indexed from boot, as 'request_id' or 'ctx.trace_id'
+                           "MAX_PATHS": 16,          # Most body paths indexed at once
+                           "MAX_VALUE_LENGTH": 256},     # Longer values aren't indexed (they're still matched by scans)
+            "SCAN": {"MODE": "process",       # "process" evaluates in parallel. "thread" only overlaps segment reads
+                     "WORKERS": None,         # Scan workers. None is one per CPU
+                     "CHUNK": 8192,           # Hot entries per chunk handed to a worker
+                     "MIN_PARALLEL": 50000,   # Scans of fewer entries run on the calling thread
+                     "BUDGET_MS": 2000,       # Time budget of a search, unless it asks for another one
+                     "MAX_BUDGET_MS": 30000,  # Most time a search can ask for
+                     "MAX_PATTERN": 512},     # Longest regular expression taken on a search
+            "ALERTS": {"RULES": [],           # Rules set from boot, as described in 'alerts'
+                       "MAX_RULES": 500,      # Most rules set at once
+                       "BUCKETS": 20,         # Buckets per window. More count closer to the window edge, cost more RAM
+                       "MAX_GROUPS": 1000,    # Senders counted apart per 'per_sender' rule. Least active are evicted
+                       "QUEUE_MAX": 1000,     # Actions, or entries waiting for patterns, queued before dropping
+                       "MAX_PATTERN": 256,    # Longest regular expression taken on a rule
+                       "TIMEOUT": 5,          # Seconds before a webhook is given up
+                       "LOCAL_ONLY": True},   # If True, webhooks can only go to this machine
+            "HISTORY": {"CHUNK": 200,                   # Past entries read from the database at once
+                        "CACHE_BYTES": 4 * 1024 * 1024,  # Byte budget of the chunks of past entries kept
+                        "CHECK_INTERVAL": 30,           # Seconds between checks of the table for changes
+                        "MAX_SCOPES": 32,               # Filters whose counts and chunk bounds are kept
+                        "ROW_OVERHEAD": 200},           # Estimated bytes of a row, besides its comment and details
             "FALLBACK": {"PORT": 5001,      # Default port
                          "DB_URL": None},   # Default Database URL
             "SERVICES": {"TIMEOUT": 10,     # How many seconds between each service request
@@ -0,0 +1,215 @@
+"""Periodic snapshots of the in-memory state, enabled by 'logger_config["SNAPSHOT"]'. A background thread writes the
+entries, the id counter and the severities and servers registries to a single compressed file, replacing the previous
+one atomically. On boot the snapshot is loaded back before the server starts answering, so a restart keeps the log.
+Partitions and columns aren't stored: they're rebuilt as the entries are restored, which is cheaper than reading them.
+The file is a 'MAGIC' header followed by a zlib compressed pickle of plain data (tuples, dicts and strings), so it
+doesn't depend on the classes of the server. It's only ever read from 'defaults["SNAPSHOT"]["PATH"]', written by this
+server, and must not be taken from untrusted sources
+"""
+import atexit
+import os
+import pickle
+import threading
+import time
+import zlib
+from itertools import chain
+
+import alerts
+import blob_store
+import body_index
+import entry_manager
+from entry_manager import log_internal, log_restore, registry_swap
+from server_config import defaults, logger_config, print_verbose
+
+MAGIC = b"LOGSNAP\x01"     # File signature plus format version
+
+writer = None       # The running 'SnapshotWriter', if any
+last_load = None    # What the boot load restored, as reported on '/server/status'
+
+
+def snapshot_path() -> str:
+    return os.environ.get("LOG_SNAPSHOT", defaults["SNAPSHOT"]["PATH"])
+
+
+def capture() -> dict:
+    """
+    Copies the state to be saved. Only the references are copied under the store lock, the entries themselves are
+    read after it's released. Cold entries (if tiered) are decoded from their segments, which are kept meanwhile
+    """
+    with entry_manager.store_lock:
+        entries = entry_manager.entry_list[:]
+        cold = entry_manager.cold_tier
+        segments = list(cold.segments) if cold is not None else []     # Later spills are in 'entries' already
+        local_ids = {entry.msg_id for entry in entry_manager.local_entries}
+        state = {"global_id": entry_manager.global_id,
+                 "store_rev": entry_manager.store_rev,
+                 "registry_rev": entry_manager.registry_rev,
+                 "senders": [s_from for s_from in entry_manager.sender_names if s_from is not None],
+                 "severities": dict(entry_manager.severities),
+                 "servers": dict(entry_manager.servers_list),
+                 "discovered": list(entry_manager.discovered.items()),
+                 "body_paths": list(body_index.indexes),
+                 "alert_rules": alerts.specs()}
+    state["local_ids"] = local_ids
+    if segments:
+        with cold.reading():
+            state["entries"] = records(chain(cold.iterate(segments=segments), entries))
+    else:
+        state["entries"] = records(entries)
+    state["taken"] = time.time()
+    return state
+
+
+def records(entries) -> list:
+    """Returns the entries as plain tuples. Large bodies are decoded, and offloaded again once restored"""
+    return [(entry.msg_id, entry.created, entry.log_from, entry.severity, entry.comment, blob_store.resolve(entry.body),
+             entry.is_internal, entry.repeats, entry.last_seen) for entry in entries]
+
+
+def write(path: str = None) -> int:
+    """
+    Writes a snapshot, replacing the previous one only once it's complete
+    :param path: Where to write it. Defaults to 'snapshot_path()'
+    :return: The snapshot size, in bytes
+    """
+    path = path or snapshot_path()
+    start = time.perf_counter()
+    state = capture()
+    data = MAGIC + zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), defaults["SNAPSHOT"]["LEVEL"])
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+    print_verbose(sender=__name__, message=f"Snapshot of {len(state['entries'])} entries written ({len(data)} bytes) "
+                                           f"in {round((time.perf_counter() - start) * 1000, 3)}ms")
+    return len(data)
+
+
+def load(path: str = None) -> dict:
+    """
+    Restores the latest snapshot, if there's one. Must run before any entry is added
+    :param path: Where to read it from. Defaults to 'snapshot_path()'
+    :return: What was restored ('entries', 'bytes', 'load_ms' and 'age_s'), or None if there was nothing to load
+    """
+    global last_load
+    path = path or snapshot_path()
+    start = time.perf_counter()
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        return None
+    if not data.startswith(MAGIC):
+        logger_config["POST_INIT"].append((log_internal, ("Error", f"Snapshot '{path}' is invalid and was ignored")))
+        return None
+    try:
+        state = pickle.loads(zlib.decompress(data[len(MAGIC):]))
+    except (zlib.error, pickle.UnpicklingError, EOFError) as exc:
+        logger_config["POST_INIT"].append((log_internal, ("Error", f"Snapshot '{path}' is damaged and was ignored",
+                                                          {"error": str(exc)})))
+        return None
+    for s_from in state["senders"]:     # Keeps the order of the sender ids
+        entry_manager.sender_intern(s_from)
+    registry_swap(state["severities"], state["servers"])
+    entry_manager.discovered.update(state.get("discovered", []))     # Least recently active first, as they were
+    with entry_manager.store_lock:
+        for path in state.get("body_paths", []):    # Before the entries, which are indexed as they're restored
+            try:
+                if body_index.declare(path):
+                    body_index.backfill(path, {})
+            except ValueError:  # Over 'MAX_PATHS', if it was lowered since
+                continue
+        for spec in state.get("alert_rules", []):
+            try:
+                alerts.declare(spec)
+            except ValueError as exc:   # Its limits may have been lowered since
+                print_verbose(sender=__name__, message=f"Alert rule '{spec.get('name')}' wasn't restored: '{exc}'")
+    log_restore(state["entries"], state["local_ids"], state["global_id"])
+    last_load = {"entries": len(state["entries"]), "bytes": len(data),
+                 "load_ms": round((time.perf_counter() - start) * 1000, 3),
+                 "age_s": round(time.time() - state["taken"])}
+    logger_config["POST_INIT"].append((log_internal, ("Information", f"Restored {last_load['entries']} entries from "
+                                                                     f"a snapshot in {last_load['load_ms']}ms",
+                                                      last_load)))
+    return last_load
+
+
+class SnapshotWriter:
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.thread = None
+        self.written = None     # '(store revision, registry revision)' of the last snapshot written
+        self.last_write = None
+        self.failures = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="snapshot_writer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(defaults["SNAPSHOT"]["INTERVAL"]):
+            self.write_if_changed()
+
+    def write_if_changed(self):
+        """Writes a snapshot, unless nothing changed since the last one"""
+        revision = (entry_manager.log_revision(), entry_manager.registry_version())
+        if revision == self.written:
+            return
+        try:
+            write()
+            self.written = revision
+            self.last_write = time.time()
+        except OSError as exc:
+            self.failures += 1
+            print_verbose(sender=__name__, message=f"Snapshot failed: '{exc}'")
+
+    def stats(self) -> dict:
+        return {"last_write": self.last_write, "failures": self.failures}
+
+
+def start():
+    """Starts writing snapshots periodically, if not yet"""
+    global writer
+    if writer is None:
+        writer = SnapshotWriter()
+        writer.start()
+
+
+def stop(final: bool = False):
+    """
+    Stops writing snapshots
+    :param final: If True, writes one last snapshot
+    """
+    global writer
+    if writer is not None:
+        writer.stop()
+        if final:
+            writer.write_if_changed()
+        writer = None
+
+
+def stats() -> dict:
+    """Returns what was restored on boot and the writer state, or None if snapshots are off"""
+    if logger_config["SNAPSHOT"] is False:
+        return None
+    return {"path": snapshot_path(), "restored": last_load, "writer": None if writer is None else writer.stats()}
+
+
+def init():
+    """Restores the latest snapshot and starts writing new ones. Returns what was restored, if anything"""
+    restored = load()
+    start()
+    # Only the process that serves writes: after a fork the parent stops, without writing its (older) state. At exit,
+    # the serving process writes a last snapshot
+    os.register_at_fork(before=stop, after_in_child=start)
+    atexit.register(lambda: stop(final=True))
+    return restored
@@ -1,6 +1,9 @@
 """Prepares to start the server, setting the configuration desired, and tasks for before and after initialization.
 Calls 'create_app' on 'server_boot', which actually starts the server
 """
+import time
+boot_start = time.perf_counter()    # Taken before the server's modules are imported, to report the startup time
+
 import os
 
 from server_config import logger_config, defaults
@@ -24,12 +27,12 @@ def main():
     set_config()
     host = "0.0.0.0"
     port = int(os.environ.get("PORT", defaults["FALLBACK"]["PORT"]))
-    app = create_app()
+    app = create_app(boot_start)
     app.run(host=host, port=port, use_reloader=False)
 
 
 if __name__ == "__main__":
     main()
-else:
+elif __name__ != "__mp_main__":     # Scan worker processes ('scan') import the main module too. They don't serve
     set_config()
-    app = create_app()
+    app = create_app(boot_start)
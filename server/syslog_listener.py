@@ -0,0 +1,213 @@
+"""Optional UDP ingestion, enabled by 'logger_config["SYSLOG"]'. Runs an asyncio datagram listener on its own thread,
+away from the Flask request path, accepting two formats:
+  - RFC 5424 syslog: '<PRI>1 TIMESTAMP HOSTNAME APP-NAME PROCID MSGID STRUCTURED-DATA MSG'. The sender is the hostname
+    and the severity is mapped through 'defaults["SYSLOG"]["SEVERITIES"]'
+  - Compact JSON, one entry per datagram, with the same fields as 'POST /log' ('from', 'severity', 'comment', 'body')
+    or their initials ('f', 's', 'c', 'b')
+Parsed messages are queued and handed to the store in batches. There's no authentication on this path, so bind it to
+a trusted network only
+"""
+import asyncio
+import json
+import os
+import re
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import admission
+from entry_manager import log_add_batch, log_internal_echo, log_uncaught_exception
+from server_config import defaults, logger_config, print_verbose
+
+RFC5424 = re.compile(r"<(?P<pri>\d{1,3})>1 (?P<timestamp>\S+) (?P<hostname>\S+) (?P<app>\S+) (?P<procid>\S+) "
+                     r"(?P<msgid>\S+) (?P<sd>-|(?:\[(?:[^\]\\]|\\.)*\])+)(?: (?P<msg>.*))?", re.DOTALL)
+LEGACY = re.compile(r"<(?P<pri>\d{1,3})>(?P<msg>.*)", re.DOTALL)    # Anything else that still carries a priority
+NIL = "-"
+
+listener = None     # The running 'SyslogListener', if any
+
+
+def syslog_severity(code: int) -> str:
+    """Maps a syslog severity (0 to 7) onto one of our severity names"""
+    names = defaults["SYSLOG"]["SEVERITIES"]
+    return names[min(max(code, 0), len(names) - 1)]
+
+
+def parse_datagram(data: bytes, ip: str):
+    """
+    Parses a single datagram
+    :param data: The raw datagram
+    :param ip: Who sent it
+    :return: A '(s_from, severity, comment, body, ip)' tuple, or None if it couldn't be parsed
+    """
+    text = data.decode("utf-8", errors="replace").strip()
+    if text.startswith("{"):
+        try:
+            msg = json.loads(text)
+        except ValueError:
+            return None
+        if not isinstance(msg, dict):
+            return None
+        s_from = msg.get("from", msg.get("f")) or ip
+        severity = msg.get("severity", msg.get("s", "Information"))
+        comment = msg.get("comment", msg.get("c", "Not Specified"))
+        if isinstance(severity, int) and not isinstance(severity, bool):
+            severity = syslog_severity(severity)
+        if isinstance(comment, (int, float)):
+            comment = str(comment)
+        if not isinstance(s_from, str) or not isinstance(severity, str) or not isinstance(comment, str):
+            return None     # A single bad field would fail its whole batch in the store
+        return s_from, severity, comment, msg.get("body", msg.get("b")), ip
+    match = RFC5424.match(text)
+    if match is not None:
+        pri = int(match["pri"])
+        body = {"facility": pri >> 3, "app": match["app"], "procid": match["procid"], "msgid": match["msgid"],
+                "timestamp": match["timestamp"], "structured_data": match["sd"]}
+        comment = (match["msg"] or "").lstrip("﻿")     # MSG may start with an UTF-8 BOM
+        s_from = match["hostname"] if match["hostname"] != NIL else ip
+        return s_from, syslog_severity(pri & 7), comment, {k: v for k, v in body.items() if v != NIL}, ip
+    match = LEGACY.match(text)
+    if match is not None:
+        pri = int(match["pri"])
+        return ip, syslog_severity(pri & 7), match["msg"], {"facility": pri >> 3}, ip
+    return None
+
+
+class SyslogProtocol(asyncio.DatagramProtocol):
+    def __init__(self, owner):
+        self.owner = owner
+
+    def datagram_received(self, data, addr):
+        self.owner.receive(data, addr[0])
+
+    def error_received(self, exc):
+        print_verbose(sender=__name__, message=f"Datagram error: '{exc}'")
+
+
+class SyslogListener:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.transport = None
+        self.thread = None
+        self.batch = []
+        self.flush_handle = None
+        self.dropped = 0            # Datagrams dropped because the queue was full, or by admission control
+        self.received = 0
+        self.invalid = 0
+        self.pending = 0            # Entries handed to the store but not yet stored
+        self.pending_lock = threading.Lock()    # 'pending' is changed from the loop thread and the store thread
+        self.store = ThreadPoolExecutor(max_workers=1, thread_name_prefix="syslog_store")  # Keeps the batch order
+        self.ready = threading.Event()
+
+    def start(self):
+        """Starts the listener on its own thread and event loop"""
+        self.thread = threading.Thread(target=self.run, name="syslog_listener", daemon=True)
+        self.thread.start()
+        self.ready.wait(5)
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.transport, _ = self.loop.run_until_complete(self.loop.create_datagram_endpoint(
+                lambda: SyslogProtocol(self), local_addr=(self.host, self.port),
+                reuse_port=hasattr(os, "fork") or None))
+        except OSError as exc:
+            log_internal_echo(severity="Error", sender=__name__,
+                              comment=f"Syslog listener couldn't bind {self.host}:{self.port}: '{exc}'")
+            self.ready.set()
+            return
+        sock = self.transport.get_extra_info("socket")
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, defaults["SYSLOG"]["RCVBUF"])
+        except OSError:
+            pass    # The OS caps it, keeping its own default
+        log_internal_echo(severity="Success", sender=__name__,
+                          comment=f"Syslog listener accepting datagrams on {self.host}:{self.port}")
+        self.ready.set()
+        self.loop.run_forever()
+        self.transport.close()
+        self.flush()
+        self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.loop.close()
+
+    def stop(self):
+        """Stops the listener, storing whatever was still queued"""
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(5)
+        self.store.shutdown(wait=True)
+
+    def receive(self, data: bytes, ip: str):
+        self.received += 1
+        if self.pending + len(self.batch) >= defaults["SYSLOG"]["QUEUE_MAX"]:
+            self.dropped += 1
+            return
+        entry = parse_datagram(data, ip)
+        if entry is None:
+            self.invalid += 1
+            return
+        if admission.admit(entry[1]) is False:
+            self.dropped += 1
+            return
+        self.batch.append(entry)
+        if len(self.batch) >= defaults["SYSLOG"]["BATCH_SIZE"]:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(defaults["SYSLOG"]["FLUSH_INTERVAL"], self.flush)
+
+    def flush(self):
+        """Hands the queued entries to the store, off the event loop"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        with self.pending_lock:
+            self.pending += len(batch)
+        self.store.submit(self.store_batch, batch)
+
+    def store_batch(self, batch: list):
+        try:
+            log_add_batch(batch)
+        except Exception as exc:
+            log_uncaught_exception(str(exc), {"batch_size": len(batch)}, __name__)
+        finally:
+            with self.pending_lock:
+                self.pending -= len(batch)
+
+    def stats(self) -> dict:
+        return {"received": self.received, "invalid": self.invalid, "dropped": self.dropped, "pending": self.pending}
+
+
+def start():
+    """Starts the syslog listener, if enabled and not running yet"""
+    global listener
+    if logger_config["SYSLOG"] is False or listener is not None:
+        return
+    listener = SyslogListener(defaults["SYSLOG"]["HOST"], defaults["SYSLOG"]["PORT"])
+    listener.start()
+
+
+def stop():
+    """Stops the syslog listener, if running"""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def stats() -> dict:
+    """Returns the listener counters, or None if it isn't running"""
+    return None if listener is None else listener.stats()
+
+
+def init_fork_handling():
+    """
+    The listener must run on the process that serves. With 'gunicorn --preload' the app is created on the master, so
+    on fork the listener moves from the parent to the child
+    """
+    os.register_at_fork(before=stop, after_in_child=start)
@@ -0,0 +1,58 @@
+"""Wire formats of the API. Requests and responses are JSON by default, or MessagePack ('application/msgpack') when
+the 'msgpack' package is installed and the client asks for it: through 'Content-Type' when sending, and through
+'Accept' when reading. MessagePack skips the text parsing of JSON, which matters most for senders with large bodies
+"""
+import json
+
+import flask
+from werkzeug.exceptions import BadRequest
+
+try:
+    import msgpack
+except ImportError:  # Optional dependency. Without it, only JSON is accepted and offered
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MSGPACK_ALIASES = (MSGPACK, "application/x-msgpack", "application/vnd.msgpack")
+
+
+def is_msgpack(mimetype: str) -> bool:
+    """Returns True if 'mimetype' is one of the MessagePack mimetypes in use"""
+    return mimetype in MSGPACK_ALIASES
+
+
+def request_data():
+    """
+    Decodes the current request's body, following its 'Content-Type'
+    :return: The decoded object (usually a dict, or a list of them on batches)
+    :raises BadRequest: If the body couldn't be decoded, or its format isn't supported
+    """
+    if is_msgpack(flask.request.mimetype):
+        if msgpack is None:
+            raise BadRequest("MessagePack isn't supported by this server")
+        try:
+            return msgpack.unpackb(flask.request.get_data(cache=False), raw=False, strict_map_key=False)
+        except (ValueError, TypeError, msgpack.UnpackException) as exc:    # Unhashable map keys raise TypeError
+            raise BadRequest(f"Invalid MessagePack body: '{exc}'")
+    return flask.request.json
+
+
+def negotiate() -> str:
+    """Returns the response mimetype the client prefers. JSON if it has no preference"""
+    offers = [JSON, MSGPACK] if msgpack is not None else [JSON]
+    return flask.request.accept_mimetypes.best_match(offers, default=JSON)
+
+
+def respond(data, status: int = 200) -> flask.Response:
+    """
+    Encodes 'data' as negotiated with the client
+    :param data: Anything JSON (or MessagePack) serializable. Unknown objects are sent as strings
+    :param status: The HTTP status code
+    """
+    if negotiate() == MSGPACK:
+        response = flask.Response(msgpack.packb(data, default=str, use_bin_type=True), status=status, mimetype=MSGPACK)
+    else:
+        response = flask.Response(json.dumps(data, default=str), status=status, mimetype=JSON)
+    response.vary.add("Accept")
+    return response